@@ -137,6 +137,69 @@ MEILI_KEY = os.getenv('MEILI_KEY', 'dq49aaqs-RYHbIfKGMOFJRrfco3jP-0Ubj4gcX9caBc'
 LOCAL_PROMPT_OPTIMIZER_URL = os.getenv('LOCAL_PROMPT_OPTIMIZER_URL', 'http://127.0.0.1:11434/api/chat')
 LOCAL_PROMPT_OPTIMIZER_MODEL = os.getenv('LOCAL_PROMPT_OPTIMIZER_MODEL', 'qwen3:14b')
 LOCAL_PROMPT_OPTIMIZER_TIMEOUT = float(os.getenv('LOCAL_PROMPT_OPTIMIZER_TIMEOUT', '120'))
+# FAISS 索引快照目录，以及增量日志累计多少条后重写快照
+GALLERY_FAISS_INDEX_DIR = os.getenv('GALLERY_FAISS_INDEX_DIR', os.path.join(BASE_DIR, 'faiss_index'))
+GALLERY_FAISS_WAL_COMPACT_ENTRIES = int(os.getenv('GALLERY_FAISS_WAL_COMPACT_ENTRIES', '2000'))
+# 删除图片先记墓碑，墓碑数超过 max(MIN, RATIO*索引规模) 时后台压缩索引
+GALLERY_FAISS_TOMBSTONE_MIN = int(os.getenv('GALLERY_FAISS_TOMBSTONE_MIN', '200'))
+GALLERY_FAISS_TOMBSTONE_RATIO = float(os.getenv('GALLERY_FAISS_TOMBSTONE_RATIO', '0.05'))
+# 近似检索：图库超过 ANN_MIN_SIZE 张后自动训练 ivf / ivfpq / hnsw 索引，小图库仍走精确检索
+GALLERY_FAISS_ANN_TYPE = os.getenv('GALLERY_FAISS_ANN_TYPE', 'ivf')
+GALLERY_FAISS_ANN_MIN_SIZE = int(os.getenv('GALLERY_FAISS_ANN_MIN_SIZE', '50000'))
+GALLERY_FAISS_IVF_NLIST = int(os.getenv('GALLERY_FAISS_IVF_NLIST', '0'))  # 0 表示按 4*sqrt(N) 自动计算
+GALLERY_FAISS_PQ_M = int(os.getenv('GALLERY_FAISS_PQ_M', '64'))
+GALLERY_FAISS_HNSW_M = int(os.getenv('GALLERY_FAISS_HNSW_M', '32'))
+GALLERY_FAISS_NPROBE = int(os.getenv('GALLERY_FAISS_NPROBE', '16'))
+GALLERY_FAISS_EF_SEARCH = int(os.getenv('GALLERY_FAISS_EF_SEARCH', '64'))
+# 以图搜图 / 以文搜图查询向量缓存（按文件 MD5 / 查询文本），过期秒数
+GALLERY_QUERY_EMBEDDING_CACHE_TIMEOUT = int(os.getenv('GALLERY_QUERY_EMBEDDING_CACHE_TIMEOUT', str(7 * 24 * 3600)))
+# 以文搜图：CLIP 文本向量与图片的余弦相似度低于该值的结果丢弃（文本-图片相似度整体低于图-图）
+GALLERY_TEXT_SEARCH_MIN_SCORE = float(os.getenv('GALLERY_TEXT_SEARCH_MIN_SCORE', '0.2'))
+# 带过滤条件的以图搜图：候选集不超过该数量时直接精确计算，否则用 IDSelector 下推到索引
+GALLERY_FAISS_FILTER_BRUTE_FORCE_MAX = int(os.getenv('GALLERY_FAISS_FILTER_BRUTE_FORCE_MAX', '5000'))
+# 视觉近似重复检测：余弦相似度阈值与每次 range_search 的查询块大小
+GALLERY_NEAR_DUPLICATE_THRESHOLD = float(os.getenv('GALLERY_NEAR_DUPLICATE_THRESHOLD', '0.95'))
+GALLERY_NEAR_DUPLICATE_CHUNK_SIZE = int(os.getenv('GALLERY_NEAR_DUPLICATE_CHUNK_SIZE', '1024'))
+# 上传查重：感知哈希 (dHash) 汉明距离不超过该值视为视觉相同
+GALLERY_PHASH_MAX_DISTANCE = int(os.getenv('GALLERY_PHASH_MAX_DISTANCE', '6'))
+# 感知哈希 BK 树与数据库核对（其他进程是否增删过图片）的最短间隔（秒）
+GALLERY_PHASH_INDEX_CHECK_INTERVAL = float(os.getenv('GALLERY_PHASH_INDEX_CHECK_INTERVAL', '5'))
+# 多进程共享索引：standalone（默认，各进程各自一份）/ owner（唯一写入进程，如 Huey consumer）/ reader（Web worker，mmap 只读）
+GALLERY_FAISS_ROLE = os.getenv('GALLERY_FAISS_ROLE', 'standalone')
+GALLERY_FAISS_RELOAD_INTERVAL = float(os.getenv('GALLERY_FAISS_RELOAD_INTERVAL', '5'))  # reader 检查新快照 / standalone 检查增量日志的最短间隔（秒）
+# 独立向量服务 (manage.py run_embedding_service)，例如 http://127.0.0.1:8765；留空则在本进程内编码与检索
+GALLERY_EMBEDDING_SERVICE_URL = os.getenv('GALLERY_EMBEDDING_SERVICE_URL', '')
+GALLERY_EMBEDDING_SERVICE_TIMEOUT = float(os.getenv('GALLERY_EMBEDDING_SERVICE_TIMEOUT', '30'))
+# 向量压缩：数据库里的 feature_vector 与 FAISS 索引内的存储精度，可选 float32 / float16 / int8
+GALLERY_FEATURE_VECTOR_FORMAT = os.getenv('GALLERY_FEATURE_VECTOR_FORMAT', 'float16')
+GALLERY_FAISS_CODEC = os.getenv('GALLERY_FAISS_CODEC', 'float16')
+# 后台批量编码：每批送入 CLIP 的图片数，以及并行解码图片的线程数
+GALLERY_EMBED_BATCH_SIZE = int(os.getenv('GALLERY_EMBED_BATCH_SIZE', '32'))
+GALLERY_EMBED_DECODE_WORKERS = int(os.getenv('GALLERY_EMBED_DECODE_WORKERS', '4'))
+# 视频按时间均匀抽取的关键帧数，多帧向量取均值作为视频的检索向量
+GALLERY_VIDEO_EMBED_FRAMES = int(os.getenv('GALLERY_VIDEO_EMBED_FRAMES', '4'))
+# 图片哈希 / 向量任务：单进程内同时编码的批次数，以及失败重试次数与间隔（秒）
+GALLERY_EMBED_CONCURRENCY = int(os.getenv('GALLERY_EMBED_CONCURRENCY', '1'))
+GALLERY_EMBED_TASK_RETRIES = int(os.getenv('GALLERY_EMBED_TASK_RETRIES', '3'))
+GALLERY_EMBED_TASK_RETRY_DELAY = int(os.getenv('GALLERY_EMBED_TASK_RETRY_DELAY', '30'))
+# 列表页总数 (COUNT) 缓存秒数：只影响页码条，翻页内容按游标 / 多取一行判断
+GALLERY_PAGINATION_COUNT_TTL = int(os.getenv('GALLERY_PAGINATION_COUNT_TTL', '60'))
+# 提示词全文索引与数据库核对（其他进程是否增删改过提示词组）的最短间隔（秒）
+GALLERY_PROMPT_INDEX_CHECK_INTERVAL = float(os.getenv('GALLERY_PROMPT_INDEX_CHECK_INTERVAL', '5'))
+# 筛选项计数缓存秒数：修改时会主动失效，这里只是其它进程缓存的过期兜底
+GALLERY_FACET_CACHE_TIMEOUT = int(os.getenv('GALLERY_FACET_CACHE_TIMEOUT', '300'))
+# 多进程部署（多个 Web worker + Huey consumer）时的共享缓存目录，让一处失效所有进程可见；留空则用进程内存缓存
+GALLERY_SHARED_CACHE_DIR = os.getenv('GALLERY_SHARED_CACHE_DIR', '')
+if GALLERY_SHARED_CACHE_DIR:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': GALLERY_SHARED_CACHE_DIR,
+        }
+    }
+
+# 测试期间 FAISS 索引目录统一指向临时目录
+TEST_RUNNER = 'gallery.test_runner.GalleryTestRunner'
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -155,6 +218,10 @@ HUEY = {
     'store_none': False,
     'immediate': False,  # 设为 False 表示真正使用异步。如果开发调试时想看报错，可临时改为 True
     'filename': os.path.join(BASE_DIR, 'huey_tasks.sqlite3'), # 在项目根目录生成独立的任务数据库
+    'consumer': {
+        'workers': int(os.getenv('HUEY_WORKERS', '2')),  # 限制并发的后台任务数
+        'worker_type': 'thread',
+    },
 }
 
 # 3. 告诉 Caddy 内部重定向的 Header 名称 (后续会用到)
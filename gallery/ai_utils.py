@@ -1,14 +1,37 @@
 import numpy as np
 from PIL import Image
-from sentence_transformers import SentenceTransformer
-import torch
 import os
-import cv2  
 import tempfile 
-import faiss  # 【新增】FAISS 内存索引引擎
 import requests # 【新增】用于请求本地 Ollama 服务
+import base64
+import hashlib
+import importlib
 import json
+import math
 import re
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+
+class _LazyModule:
+    """首次访问属性时才真正 import，管理命令和不做检索的 Web 进程不必加载重型依赖"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+torch = _LazyModule('torch')
+cv2 = _LazyModule('cv2')
+faiss = _LazyModule('faiss')  # 【新增】FAISS 内存索引引擎
 
 # ==========================================
 # 全局变量 (仅保留 CLIP 模型和 FAISS 索引)
@@ -18,14 +41,12 @@ _faiss_index = None
 
 # 【重要修改】已经删除了 _text_model 和 _text_tokenizer，不再占用显存
 
-def load_model_on_startup():
-    """
-    系统启动时预加载图片向量模型，并构建 FAISS 索引
-    """
+def _load_clip_model():
     global _model
+    from sentence_transformers import SentenceTransformer
+
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     
-    # 1. 加载 CLIP 模型 (用于以图搜图，必须保留)
     if _model is None:
         print(">>> [AI核心] 正在预加载 CLIP 模型...")
         try:
@@ -33,9 +54,22 @@ def load_model_on_startup():
             print(f">>> [AI核心] CLIP 模型加载完毕，运行设备: {device}")
         except Exception as e:
             print(f">>> [AI核心] ❌ 模型加载失败: {e}")
+
+
+def load_model_on_startup():
+    """
+    系统启动时预加载图片向量模型，并构建 FAISS 索引
+    """
+    # 配置了外部向量服务时，本进程只做瘦客户端，不加载模型和索引
+    if _get_embedding_service_url():
+        print(f">>> [AI核心] 使用外部向量服务 {_get_embedding_service_url()}，跳过本地模型与索引加载")
+        return
+
+    # 1. 加载 CLIP 模型 (用于以图搜图，必须保留)
+    _load_clip_model()
             
-    # 2. 构建 FAISS 内存索引
-    build_faiss_index()
+    # 2. 加载 FAISS 索引 (磁盘快照 + 增量日志)
+    load_faiss_index()
 
 # ==========================================
 # 标题生成模块 (Ollama 异步 API 化)
@@ -102,58 +136,148 @@ def generate_title_with_local_llm(prompt_text):
 def get_model():
     global _model
     if _model is None:
-        load_model_on_startup()
+        _load_clip_model()
     return _model
 
-def generate_image_embedding(image_path_or_file):
-    """生成图片特征向量 (Bytes)"""
-    model = get_model()
-    if model is None:
+# ==========================================
+# 外部向量服务客户端 (manage.py run_embedding_service)
+# 配置 GALLERY_EMBEDDING_SERVICE_URL 后编码 / 检索 / 索引变更都交给服务进程，
+# 服务不可用时自动退回进程内模式
+# ==========================================
+_EMBEDDING_SERVICE_RETRY_SECONDS = 30
+_embedding_service_local = False  # 本进程就是向量服务时为 True，避免自己调用自己
+_embedding_service_retry_at = 0.0
+
+
+def mark_embedding_service_local(local=True):
+    """run_embedding_service 启动时调用：本进程就是向量服务，编码 / 检索一律在进程内完成"""
+    global _embedding_service_local
+    _embedding_service_local = local
+
+
+def _get_embedding_service_url():
+    if _embedding_service_local or time.time() < _embedding_service_retry_at:
+        return ''
+    return str(getattr(settings, 'GALLERY_EMBEDDING_SERVICE_URL', '') or '').rstrip('/')
+
+
+def _call_embedding_service(path, payload=None, data=None, headers=None, params=None):
+    """调用向量服务，失败时返回 None 并在一段时间内改用进程内模式"""
+    global _embedding_service_retry_at
+    url = _get_embedding_service_url()
+    if not url:
         return None
-        
+    try:
+        response = requests.post(
+            f'{url}{path}',
+            json=payload,
+            data=data,
+            headers=headers,
+            params=params,
+            timeout=float(getattr(settings, 'GALLERY_EMBEDDING_SERVICE_TIMEOUT', 30)),
+        )
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        _embedding_service_retry_at = time.time() + _EMBEDDING_SERVICE_RETRY_SECONDS
+        print(f">>> [向量服务] 调用 {path} 失败，{_EMBEDDING_SERVICE_RETRY_SECONDS} 秒内改用进程内模式: {e}")
+        return None
+
+
+def _embedding_service_request(image_path_or_file):
+    """同机服务直接读路径；上传的文件对象发送原始字节"""
+    if isinstance(image_path_or_file, str):
+        return {'payload': {'path': os.path.abspath(image_path_or_file)}}
+    if hasattr(image_path_or_file, 'seek'):
+        image_path_or_file.seek(0)
+    data = image_path_or_file.read()
+    if hasattr(image_path_or_file, 'seek'):
+        image_path_or_file.seek(0)
+    filename = os.path.basename(getattr(image_path_or_file, 'name', '') or 'upload')
+    return {'data': data, 'headers': {'Content-Type': 'application/octet-stream', 'X-Filename': filename}}
+
+
+def _decode_service_vectors(encoded_vectors):
+    return [base64.b64decode(value) if value else None for value in encoded_vectors]
+
+
+_VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.webm', '.mkv']
+
+
+def get_embed_batch_size():
+    return max(1, int(getattr(settings, 'GALLERY_EMBED_BATCH_SIZE', 32)))
+
+
+def _get_embed_decode_workers():
+    return max(1, int(getattr(settings, 'GALLERY_EMBED_DECODE_WORKERS', 4)))
+
+
+def _get_video_embed_frames():
+    return max(1, int(getattr(settings, 'GALLERY_VIDEO_EMBED_FRAMES', 4)))
+
+
+def _read_video_keyframes(file_path, frame_count):
+    """按时间均匀 seek 取 frame_count 帧，只解码目标位置附近的数据，不必读完整个视频"""
+    cap = cv2.VideoCapture(file_path)
+    try:
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        if total_frames > 0:
+            positions = sorted({int(total_frames * (i + 0.5) / frame_count) for i in range(frame_count)})
+        else:
+            # 拿不到总帧数的流只取首帧
+            positions = [None]
+
+        frames = []
+        for position in positions:
+            if position is not None:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+            ret, frame = cap.read()
+            if ret:
+                frames.append(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+        return frames
+    finally:
+        cap.release()
+
+
+def _decode_media_for_embedding(image_path_or_file):
+    """
+    解码为待编码的 RGB 图像列表：图片返回 1 张，视频返回若干关键帧，失败返回空列表。
+    视频优先直接读磁盘上的现有文件（路径 / 上传临时文件 / 已保存的 FieldFile），
+    只有纯内存中的小上传才落一份临时文件。
+    """
     temp_video_path = None
     
     try:
-        img = None
-        is_video = False
-        file_path = ""
+        if isinstance(image_path_or_file, str):
+            file_name = image_path_or_file
+        else:
+            file_name = getattr(image_path_or_file, 'name', '') or ''
+        ext = os.path.splitext(file_name)[1].lower()
+
+        if ext not in _VIDEO_EXTENSIONS:
+            img = Image.open(image_path_or_file)
+            # PIL 是惰性解码，这里强制解码，保证耗时落在调用线程里
+            return [img.convert('RGB')]
 
         if isinstance(image_path_or_file, str):
             file_path = image_path_or_file
-            ext = os.path.splitext(file_path)[1].lower()
-            if ext in ['.mp4', '.mov', '.avi', '.webm', '.mkv']:
-                is_video = True
-        elif hasattr(image_path_or_file, 'name'):
-            ext = os.path.splitext(image_path_or_file.name)[1].lower()
-            if ext in ['.mp4', '.mov', '.avi', '.webm', '.mkv']:
-                is_video = True
+        elif hasattr(image_path_or_file, 'temporary_file_path'):
+            file_path = image_path_or_file.temporary_file_path()
+        else:
+            try:
+                file_path = image_path_or_file.path
+            except (AttributeError, NotImplementedError, ValueError):
                 with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
                     if hasattr(image_path_or_file, 'seek'): image_path_or_file.seek(0)
                     tmp.write(image_path_or_file.read())
                     temp_video_path = tmp.name
                     file_path = tmp.name
 
-        if is_video:
-            cap = cv2.VideoCapture(file_path)
-            ret, frame = cap.read()
-            cap.release()
-            if ret:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                img = Image.fromarray(frame)
-        
-        if img is None:
-            img = Image.open(image_path_or_file)
-        
-        embedding = model.encode(img)
-        norm = np.linalg.norm(embedding)
-        if norm > 0:
-            embedding = embedding / norm
-            
-        return embedding.astype(np.float32).tobytes()
+        return _read_video_keyframes(file_path, _get_video_embed_frames())
         
     except Exception as e:
-        print(f"生成特征向量失败: {e}")
-        return None
+        print(f"解码图片失败: {e}")
+        return []
     finally:
         if temp_video_path and os.path.exists(temp_video_path):
             try:
@@ -161,94 +285,1287 @@ def generate_image_embedding(image_path_or_file):
             except:
                 pass
 
+
+def _normalize_embeddings(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, FAISS_DIMENSION)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def _pool_frame_embeddings(embeddings):
+    """多帧向量取均值后重新归一化，作为视频的单一检索向量"""
+    return _normalize_embeddings(_normalize_embeddings(embeddings).mean(axis=0))[0]
+
+
+# ==========================================
+# 特征向量存储格式：带版本头的 float32 / float16 / int8（每个向量一个缩放系数）
+# 无头且长度为 512*4 的老数据按原始 float32 解析
+# ==========================================
+_VECTOR_MAGIC = b'FV'
+_VECTOR_FORMAT_VERSION = 1
+_VECTOR_HEADER = struct.Struct('<2sBB')
+_VECTOR_SCALE = struct.Struct('<f')
+_VECTOR_CODECS = {'float32': 0, 'float16': 1, 'int8': 2}
+
+
+def get_feature_vector_format():
+    vector_format = str(getattr(settings, 'GALLERY_FEATURE_VECTOR_FORMAT', 'float16')).lower()
+    return vector_format if vector_format in _VECTOR_CODECS else 'float32'
+
+
+def encode_feature_vector(vector, vector_format=None):
+    """把归一化后的向量编码成带版本头的字节串"""
+    vector_format = vector_format or get_feature_vector_format()
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    header = _VECTOR_HEADER.pack(_VECTOR_MAGIC, _VECTOR_FORMAT_VERSION, _VECTOR_CODECS[vector_format])
+    if vector_format == 'float16':
+        return header + vector.astype(np.float16).tobytes()
+    if vector_format == 'int8':
+        max_abs = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = max_abs / 127 if max_abs > 0 else 1.0
+        codes = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return header + _VECTOR_SCALE.pack(scale) + codes.tobytes()
+    return header + vector.tobytes()
+
+
+def get_feature_vector_codec(data):
+    """返回存储格式名；老的无头 float32 数据返回 None"""
+    data = bytes(data)
+    if len(data) == FAISS_DIMENSION * 4 or len(data) < _VECTOR_HEADER.size:
+        return None
+    magic, version, codec = _VECTOR_HEADER.unpack_from(data)
+    if magic != _VECTOR_MAGIC or version != _VECTOR_FORMAT_VERSION:
+        return None
+    for name, value in _VECTOR_CODECS.items():
+        if value == codec:
+            return name
+    return None
+
+
+def decode_feature_vector(data):
+    """解码任意存储格式的特征向量为 float32 数组，无法识别时返回 None"""
+    if data is None:
+        return None
+    data = bytes(data)
+    codec = get_feature_vector_codec(data)
+    offset = _VECTOR_HEADER.size
+    try:
+        if codec is None:
+            vector = np.frombuffer(data, dtype=np.float32)
+        elif codec == 'float16':
+            vector = np.frombuffer(data, dtype=np.float16, offset=offset).astype(np.float32)
+        elif codec == 'int8':
+            scale = _VECTOR_SCALE.unpack_from(data, offset)[0]
+            vector = np.frombuffer(data, dtype=np.int8, offset=offset + _VECTOR_SCALE.size).astype(np.float32) * scale
+        else:
+            vector = np.frombuffer(data, dtype=np.float32, offset=offset)
+    except ValueError:
+        return None
+    return vector if vector.size else None
+
+
+def generate_image_embedding(image_path_or_file):
+    """生成图片特征向量 (Bytes)"""
+    if _get_embedding_service_url():
+        result = _call_embedding_service('/embed', **_embedding_service_request(image_path_or_file))
+        if result is not None:
+            return _decode_service_vectors(result['vectors'])[0]
+
+    model = get_model()
+    if model is None:
+        return None
+
+    frames = _decode_media_for_embedding(image_path_or_file)
+    if not frames:
+        return None
+
+    try:
+        embeddings = model.encode(frames, batch_size=len(frames), convert_to_numpy=True)
+        return encode_feature_vector(_pool_frame_embeddings(embeddings))
+    except Exception as e:
+        print(f"生成特征向量失败: {e}")
+        return None
+
+
+def generate_text_embedding(text):
+    """用同一个 CLIP 模型编码文本，得到与图片同一空间的特征向量 (Bytes)"""
+    if _get_embedding_service_url():
+        result = _call_embedding_service('/embed', payload={'text': text})
+        if result is not None:
+            return _decode_service_vectors(result['vectors'])[0]
+
+    model = get_model()
+    if model is None:
+        return None
+
+    try:
+        embeddings = model.encode([text], convert_to_numpy=True)
+        return encode_feature_vector(_normalize_embeddings(embeddings)[0])
+    except Exception as e:
+        print(f"生成文本特征向量失败: {e}")
+        return None
+
+
+def generate_image_embeddings_batch(image_paths, batch_size=None):
+    """
+    批量生成特征向量：线程池并行解码，再按 batch_size 整批送入 CLIP 编码。
+    返回与 image_paths 一一对应的 Bytes 列表，失败的位置为 None。
+    """
+    results = [None] * len(image_paths)
+    if not image_paths:
+        return results
+    result = _call_embedding_service('/embed', payload={'paths': [os.path.abspath(path) for path in image_paths]})
+    if result is not None:
+        return _decode_service_vectors(result['vectors'])
+    model = get_model()
+    if model is None:
+        return results
+
+    batch_size = batch_size or get_embed_batch_size()
+    with ThreadPoolExecutor(max_workers=_get_embed_decode_workers()) as pool:
+        for start in range(0, len(image_paths), batch_size):
+            chunk = image_paths[start:start + batch_size]
+            # 视频会展开成多帧，和图片一起整批编码，再按所属文件池化
+            frames = []
+            owners = []
+            for offset, item_frames in enumerate(pool.map(_decode_media_for_embedding, chunk)):
+                frames.extend(item_frames)
+                owners.extend([start + offset] * len(item_frames))
+            if not frames:
+                continue
+            try:
+                embeddings = model.encode(frames, batch_size=batch_size, convert_to_numpy=True)
+            except Exception as e:
+                print(f"批量生成特征向量失败: {e}")
+                continue
+            embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, FAISS_DIMENSION)
+            owners = np.array(owners)
+            for position in np.unique(owners):
+                results[int(position)] = encode_feature_vector(_pool_frame_embeddings(embeddings[owners == position]))
+    return results
+
 # ==========================================
 # FAISS 高性能检索引擎模块
 # ==========================================
-def build_faiss_index():
-    """初始化并构建 FAISS 全局倒排索引"""
-    global _faiss_index
-    from .models import ImageItem  # 局部引入，避免循环依赖
-    
-    print(">>> [FAISS] 正在构建全局向量索引...")
-    dimension = 512
-    base_index = faiss.IndexFlatIP(dimension)
-    _faiss_index = faiss.IndexIDMap(base_index)
-    
-    # 分块读取数据库，防 OOM
-    qs = ImageItem.objects.exclude(feature_vector__isnull=True).values_list('id', 'feature_vector')
-    
+FAISS_DIMENSION = 512
+_FAISS_META_VERSION = 1
+_FAISS_WAL_OP_ADD = 1
+_FAISS_WAL_OP_DELETE = 2
+_FAISS_WAL_HEADER = struct.Struct('<Bq')
+_FAISS_TRAINED_INDEX_TYPES = {'ivf', 'ivfpq'}
+_faiss_lock = threading.RLock()
+_faiss_wal_entries = 0
+# 本进程索引基于的快照代数，以及已应用到的增量日志字节偏移（之后的记录由其他进程追加）
+_faiss_generation = 0
+_faiss_wal_offset = 0
+_faiss_file_lock_depth = 0
+# standalone 进程上次检查增量日志的时间
+_faiss_wal_checked_at = 0.0
+_faiss_background_thread = None
+# 已删除但尚未从索引中物理移除的 ID（墓碑），检索时跳过，累计过多时后台压缩
+_faiss_tombstones = set()
+# 只读进程 (reader) 当前映射的快照代数，以及上次检查新快照的时间
+_faiss_reader_generation = 0
+_faiss_reader_checked_at = 0.0
+# 不支持平铺 / SQ 编码 mmap 的告警只打印一次
+_faiss_mmap_warned = False
+_FAISS_ROLES = {'standalone', 'owner', 'reader'}
+
+
+def _get_faiss_index_dir():
+    return getattr(settings, 'GALLERY_FAISS_INDEX_DIR', os.path.join(settings.BASE_DIR, 'faiss_index'))
+
+
+def get_faiss_role():
+    """
+    standalone：本进程独占一份可写索引（默认）；
+    owner：唯一的写入进程（通常是 Huey consumer），负责发布快照；
+    reader：Web worker，以 mmap 只读方式共享 owner 发布的快照。
+    """
+    role = str(getattr(settings, 'GALLERY_FAISS_ROLE', 'standalone')).lower()
+    return role if role in _FAISS_ROLES else 'standalone'
+
+
+def _get_faiss_reload_interval():
+    return max(0.0, float(getattr(settings, 'GALLERY_FAISS_RELOAD_INTERVAL', 5)))
+
+
+def _get_faiss_wal_compact_entries():
+    return max(1, int(getattr(settings, 'GALLERY_FAISS_WAL_COMPACT_ENTRIES', 2000)))
+
+
+def _get_faiss_tombstone_threshold(ntotal):
+    ratio = float(getattr(settings, 'GALLERY_FAISS_TOMBSTONE_RATIO', 0.05))
+    minimum = int(getattr(settings, 'GALLERY_FAISS_TOMBSTONE_MIN', 200))
+    return max(1, minimum, int(ntotal * ratio))
+
+
+def _get_faiss_ann_type():
+    """配置的近似检索类型：flat / ivf / ivfpq / hnsw"""
+    index_type = str(getattr(settings, 'GALLERY_FAISS_ANN_TYPE', 'ivf')).lower()
+    if index_type in {'flat', 'ivf', 'ivfpq', 'hnsw'}:
+        return index_type
+    return 'flat'
+
+
+def _get_faiss_codec_suffix():
+    """索引内向量的存储精度：float32 -> Flat，float16 -> SQfp16，int8 -> SQ8"""
+    codec = str(getattr(settings, 'GALLERY_FAISS_CODEC', 'float16')).lower()
+    return {'float16': 'SQfp16', 'int8': 'SQ8'}.get(codec, 'Flat')
+
+
+def _get_faiss_ann_min_size():
+    return max(1, int(getattr(settings, 'GALLERY_FAISS_ANN_MIN_SIZE', 50000)))
+
+
+def _choose_faiss_index_type(vector_count):
+    """小图库直接精确检索，超过阈值后才切换到近似索引"""
+    if vector_count < _get_faiss_ann_min_size():
+        return 'flat'
+    return _get_faiss_ann_type()
+
+
+def _get_faiss_ivf_nlist(vector_count):
+    nlist = int(getattr(settings, 'GALLERY_FAISS_IVF_NLIST', 0) or 0)
+    if nlist <= 0:
+        nlist = int(4 * math.sqrt(max(vector_count, 1)))
+    # 每个聚类中心至少需要约 39 个训练样本
+    return max(1, min(nlist, 65536, max(vector_count // 39, 1)))
+
+
+def _get_faiss_index_type(index):
+    if index is None:
+        return None
+    if faiss.try_extract_index_ivf(index) is not None:
+        ivf_index = faiss.downcast_index(faiss.extract_index_ivf(index))
+        return 'ivfpq' if isinstance(ivf_index, faiss.IndexIVFPQ) else 'ivf'
+    base_index = faiss.downcast_index(index.index) if hasattr(index, 'index') else index
+    if isinstance(base_index, faiss.IndexHNSW):
+        return 'hnsw'
+    return 'flat'
+
+
+def _apply_faiss_search_params(index):
+    """将召回率/延迟旋钮 (nprobe / efSearch) 应用到索引"""
+    index_type = _get_faiss_index_type(index)
+    parameter_space = faiss.ParameterSpace()
+    if index_type in _FAISS_TRAINED_INDEX_TYPES:
+        parameter_space.set_index_parameter(index, 'nprobe', max(1, int(getattr(settings, 'GALLERY_FAISS_NPROBE', 16))))
+    elif index_type == 'hnsw':
+        parameter_space.set_index_parameter(index, 'efSearch', max(1, int(getattr(settings, 'GALLERY_FAISS_EF_SEARCH', 64))))
+
+
+def _faiss_supports_remove(index):
+    """HNSW 不支持物理删除，只能靠墓碑过滤 + 重建"""
+    return _get_faiss_index_type(index) != 'hnsw'
+
+
+def _purge_faiss_ids(index, ids):
+    """从索引中物理移除 ID；不支持删除的索引只清掉墓碑，旧条目等待重建"""
+    if not ids:
+        return
+    if _faiss_supports_remove(index):
+        index.remove_ids(np.array(list(ids), dtype=np.int64))
+    _faiss_tombstones.difference_update(ids)
+
+
+def _get_faiss_meta_path():
+    return os.path.join(_get_faiss_index_dir(), 'gallery.meta.json')
+
+
+def _get_faiss_wal_path():
+    return os.path.join(_get_faiss_index_dir(), 'gallery.wal')
+
+
+def _get_faiss_wal_size():
+    try:
+        return os.path.getsize(_get_faiss_wal_path())
+    except OSError:
+        return 0
+
+
+def _lock_file(lock_file):
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(lock_file):
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def _faiss_file_lock():
+    """
+    跨进程互斥：多个进程共用同一份增量日志和快照，"追上日志 -> 追加" 与 "追上日志 -> 写快照 -> 截断日志"
+    都在这把锁里完成，截断时快照里一定已经包含别的进程写过的全部记录。同一进程内可重入。
+    """
+    global _faiss_file_lock_depth
+    with _faiss_lock:
+        if _faiss_file_lock_depth:
+            _faiss_file_lock_depth += 1
+            try:
+                yield
+            finally:
+                _faiss_file_lock_depth -= 1
+            return
+
+        os.makedirs(_get_faiss_index_dir(), exist_ok=True)
+        with open(os.path.join(_get_faiss_index_dir(), 'gallery.lock'), 'a+b') as lock_file:
+            _lock_file(lock_file)
+            _faiss_file_lock_depth = 1
+            try:
+                yield
+            finally:
+                _faiss_file_lock_depth = 0
+                _unlock_file(lock_file)
+
+
+def _get_db_vector_watermark():
+    """数据库侧水位线：带向量的行数 / 最大 ID / ID 校验和"""
+    from django.db.models import Count, Max, Sum
+    from .models import ImageItem
+
+    stats = ImageItem.objects.exclude(feature_vector__isnull=True).aggregate(
+        count=Count('id'), max_id=Max('id'), id_sum=Sum('id')
+    )
+    return {
+        'count': stats['count'] or 0,
+        'max_id': stats['max_id'] or 0,
+        'id_sum': stats['id_sum'] or 0,
+    }
+
+
+def _get_faiss_index_ids(index):
+    """
+    索引里的全部 ID：平铺 / HNSW 套了 IDMap，直接读 id_map；
+    IVF 原生支持自定义 ID，逐个倒排表读出来
+    """
+    if not index.ntotal:
+        return np.empty(0, dtype=np.int64)
+    if hasattr(index, 'id_map'):
+        return faiss.vector_to_array(index.id_map)
+    ivf_index = faiss.extract_index_ivf(index)
+    invlists = ivf_index.invlists
+    chunks = []
+    for list_no in range(ivf_index.nlist):
+        list_size = invlists.list_size(list_no)
+        if not list_size:
+            continue
+        ids_ptr = invlists.get_ids(list_no)
+        chunks.append(np.array(faiss.rev_swig_ptr(ids_ptr, list_size), dtype=np.int64))
+        invlists.release_ids(list_no, ids_ptr)
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+
+def _is_legacy_idmap_ivf(index):
+    """
+    早期快照把 IVF 也套在 IDMap 里：IDMap.remove_ids 压缩 id_map 时倒排表里的内部偏移不会跟着变，
+    删除一次之后标签整体错位，这类快照只能全量重建
+    """
+    return hasattr(index, 'id_map') and _get_faiss_index_type(index) in _FAISS_TRAINED_INDEX_TYPES
+
+
+def _get_index_live_ids(index):
+    ids = _get_faiss_index_ids(index)
+    if _faiss_tombstones and ids.size:
+        ids = ids[~np.isin(ids, np.fromiter(_faiss_tombstones, dtype=np.int64))]
+    return ids
+
+
+def _get_index_watermark(index):
+    """索引侧水位线（不含墓碑），与 _get_db_vector_watermark 字段一一对应"""
+    ids = _get_index_live_ids(index)
+    return {
+        'count': int(ids.size),
+        'max_id': int(ids.max()) if ids.size else 0,
+        'id_sum': int(ids.sum()) if ids.size else 0,
+    }
+
+
+def _new_faiss_index(index_type='flat', vector_count=0):
+    codec = _get_faiss_codec_suffix()
+    if index_type == 'ivf':
+        description = f'IVF{_get_faiss_ivf_nlist(vector_count)},{codec}'
+    elif index_type == 'ivfpq':
+        pq_m = int(getattr(settings, 'GALLERY_FAISS_PQ_M', 64))
+        description = f'IVF{_get_faiss_ivf_nlist(vector_count)},PQ{pq_m}'
+    elif index_type == 'hnsw':
+        hnsw_m = int(getattr(settings, 'GALLERY_FAISS_HNSW_M', 32))
+        description = f'HNSW{hnsw_m}' if codec == 'Flat' else f'HNSW{hnsw_m}_{codec}'
+    else:
+        description = codec
+    if index_type not in _FAISS_TRAINED_INDEX_TYPES:
+        # 平铺 / HNSW 本身不支持自定义 ID，需要 IDMap；IVF 原生支持 add_with_ids / remove_ids，
+        # 再套 IDMap 的话 remove_ids 会让 id_map 与倒排表里的偏移错位
+        description = f'IDMap,{description}'
+    index = faiss.index_factory(FAISS_DIMENSION, description, faiss.METRIC_INNER_PRODUCT)
+    _apply_faiss_search_params(index)
+    return index
+
+
+def _sample_training_vectors(qs, vector_count):
+    """等间隔抽样训练集，避免一次性把全库向量读进内存"""
+    sample_size = min(vector_count, max(_get_faiss_ivf_nlist(vector_count) * 64, 10000))
+    step = max(1, vector_count // sample_size)
+    vectors = []
+    for position, vec_bytes in enumerate(qs.values_list('feature_vector', flat=True).iterator(chunk_size=5000)):
+        if position % step:
+            continue
+        vector = decode_feature_vector(vec_bytes)
+        if vector is not None and vector.size == FAISS_DIMENSION:
+            vectors.append(vector)
+        if len(vectors) >= sample_size:
+            break
+    if not vectors:
+        # 空库时 SQ8 仍需训练：向量已归一化，各分量落在 [-1, 1] 内
+        return np.array([[-1.0] * FAISS_DIMENSION, [1.0] * FAISS_DIMENSION], dtype=np.float32)
+    return np.array(vectors, dtype=np.float32)
+
+
+def _add_vector_rows_to_index(index, rows, chunk_size=5000):
+    """把 (id, 向量字节) 迭代器分块写入索引，返回写入条数"""
     chunk_ids = []
     chunk_vectors = []
-    
-    for obj_id, vec_bytes in qs.iterator(chunk_size=5000):
-        try:
-            chunk_ids.append(obj_id)
-            chunk_vectors.append(np.frombuffer(vec_bytes, dtype=np.float32))
-        except Exception:
+    added = 0
+
+    for obj_id, vec_bytes in rows:
+        vector = decode_feature_vector(vec_bytes)
+        if vector is None or vector.size != FAISS_DIMENSION:
             continue
-            
-        if len(chunk_ids) >= 5000:
-            _faiss_index.add_with_ids(
-                np.array(chunk_vectors), 
-                np.array(chunk_ids, dtype=np.int64)
-            )
+        chunk_ids.append(obj_id)
+        chunk_vectors.append(vector)
+
+        if len(chunk_ids) >= chunk_size:
+            index.add_with_ids(np.array(chunk_vectors), np.array(chunk_ids, dtype=np.int64))
+            added += len(chunk_ids)
             chunk_ids.clear()
             chunk_vectors.clear()
-            
+
     if chunk_ids:
-        _faiss_index.add_with_ids(
-            np.array(chunk_vectors), 
-            np.array(chunk_ids, dtype=np.int64)
-        )
-        
+        index.add_with_ids(np.array(chunk_vectors), np.array(chunk_ids, dtype=np.int64))
+        added += len(chunk_ids)
+
+    return added
+
+
+def _read_faiss_meta():
+    try:
+        with open(_get_faiss_meta_path(), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != _FAISS_META_VERSION or meta.get('dimension') != FAISS_DIMENSION:
+        return None
+    return meta
+
+
+def _read_faiss_wal():
+    """读取增量日志，返回 [(op, id, 向量或 None)]"""
+    return _read_faiss_wal_from(0)[0]
+
+
+def _read_faiss_wal_from(start_offset):
+    """
+    从 start_offset 字节处读取增量日志，返回 (记录列表, 读到的结束偏移)；
+    进程崩溃或正在写入的半条记录不计入，下次从它开头重新读
+    """
+    vector_size = FAISS_DIMENSION * 4
+    try:
+        with open(_get_faiss_wal_path(), 'rb') as f:
+            f.seek(start_offset)
+            data = f.read()
+    except OSError:
+        return [], start_offset
+
+    records = []
+    offset = 0
+    consumed = 0
+    while offset + _FAISS_WAL_HEADER.size <= len(data):
+        op, obj_id = _FAISS_WAL_HEADER.unpack_from(data, offset)
+        offset += _FAISS_WAL_HEADER.size
+        if op == _FAISS_WAL_OP_ADD:
+            if offset + vector_size > len(data):
+                break
+            records.append((op, obj_id, np.frombuffer(data, dtype=np.float32, count=FAISS_DIMENSION, offset=offset)))
+            offset += vector_size
+        elif op == _FAISS_WAL_OP_DELETE:
+            records.append((op, obj_id, None))
+        else:
+            break
+        consumed = offset
+    return records, start_offset + consumed
+
+
+def _append_faiss_wal(records):
+    """追加记录，返回追加后的日志末尾偏移；写入失败返回 None"""
+    try:
+        os.makedirs(_get_faiss_index_dir(), exist_ok=True)
+        with open(_get_faiss_wal_path(), 'ab') as f:
+            for op, obj_id, vector in records:
+                f.write(_FAISS_WAL_HEADER.pack(op, int(obj_id)))
+                if op == _FAISS_WAL_OP_ADD:
+                    f.write(np.ascontiguousarray(vector, dtype=np.float32).tobytes())
+            return f.tell()
+    except OSError as e:
+        print(f">>> [FAISS] 写入增量日志失败: {e}")
+        return None
+
+
+def _replay_faiss_records(index, records, upsert=False):
+    """
+    按顺序把增删记录应用到索引上，连续的新增合并成一次 add_with_ids。
+    upsert=True 用于重放其他进程写的日志：索引里已有的 ID 先移除旧向量再写入，避免重复条目。
+    """
+    if upsert:
+        add_ids = np.array([obj_id for op, obj_id, _ in records if op == _FAISS_WAL_OP_ADD], dtype=np.int64)
+        present_ids = add_ids[np.isin(add_ids, _get_faiss_index_ids(index))] if add_ids.size else add_ids
+        if present_ids.size:
+            _faiss_tombstones.update(int(obj_id) for obj_id in present_ids)
+            if not _faiss_supports_remove(index):
+                # HNSW 移除不了旧向量，检索按 ID 去重，后台重建后恢复干净
+                _schedule_faiss_rebuild()
+
+    pending_ids = []
+    pending_vectors = []
+    pending_purge = []
+
+    def flush():
+        if pending_purge:
+            _purge_faiss_ids(index, pending_purge)
+            pending_purge.clear()
+        if pending_ids:
+            index.add_with_ids(np.array(pending_vectors, dtype=np.float32), np.array(pending_ids, dtype=np.int64))
+            pending_ids.clear()
+            pending_vectors.clear()
+
+    for op, obj_id, vector in records:
+        if op == _FAISS_WAL_OP_ADD:
+            if obj_id in pending_ids:
+                flush()
+            if obj_id in _faiss_tombstones:
+                pending_purge.append(obj_id)
+            pending_ids.append(obj_id)
+            pending_vectors.append(vector)
+        else:
+            flush()
+            _faiss_tombstones.add(obj_id)
+    flush()
+
+
+def _catch_up_faiss_wal():
+    """
+    文件锁内调用：把其他进程追加到增量日志的记录补进本进程索引。
+    其他进程已经写出新一代快照（代数变化或日志被截断）时重新加载快照。返回是否重新加载过。
+    """
+    global _faiss_wal_offset, _faiss_wal_entries
+    if _faiss_index is None or get_faiss_role() == 'reader':
+        return False
+    meta = _read_faiss_meta() or {}
+    wal_size = _get_faiss_wal_size()
+    if int(meta.get('generation', 0)) != _faiss_generation or wal_size < _faiss_wal_offset:
+        load_faiss_index()
+        return True
+    if wal_size == _faiss_wal_offset:
+        return False
+    records, end_offset = _read_faiss_wal_from(_faiss_wal_offset)
+    if records:
+        _replay_faiss_records(_faiss_index, records, upsert=True)
+    _faiss_wal_offset = end_offset
+    _faiss_wal_entries += len(records)
+    return False
+
+
+def _commit_faiss_records(records):
+    """
+    把本进程的一批增删写入增量日志并应用到本进程索引：先追上其他进程追加的记录再写本批，
+    日志偏移随之前移，自己的记录不会在下次追日志时被重复应用
+    """
+    global _faiss_wal_offset, _faiss_wal_entries
+    with _faiss_file_lock():
+        reloaded = _catch_up_faiss_wal()
+        end_offset = _append_faiss_wal(records)
+        if _faiss_index is None:
+            return
+        # 刚重新加载的索引可能已经从数据库读到了本批向量，按 upsert 重放
+        _replay_faiss_records(_faiss_index, records, upsert=reloaded)
+        if end_offset is not None:
+            _faiss_wal_offset = end_offset
+        _faiss_wal_entries += len(records)
+
+
+def save_faiss_snapshot():
+    """将当前索引落盘为新一代快照，并清空增量日志"""
+    global _faiss_wal_entries, _faiss_wal_offset, _faiss_generation
+    with _faiss_file_lock():
+        if _faiss_index is None:
+            return False
+
+        index_dir = _get_faiss_index_dir()
+        try:
+            # 其他进程追加、本进程还没应用的记录先补进来，截断日志后它们只存在于快照里
+            _catch_up_faiss_wal()
+            # 快照落盘前顺带把墓碑物理移除；HNSW 移除不了的墓碑随元数据保存
+            if _faiss_supports_remove(_faiss_index):
+                _purge_faiss_ids(_faiss_index, set(_faiss_tombstones))
+            old_meta = _read_faiss_meta() or {}
+            generation = int(old_meta.get('generation', 0)) + 1
+            index_name = f'gallery.{generation}.index'
+            # 每一代写入独立文件，避免覆盖 Windows 下仍被映射的旧快照
+            faiss.write_index(_faiss_index, os.path.join(index_dir, index_name))
+
+            meta = {
+                'version': _FAISS_META_VERSION,
+                'dimension': FAISS_DIMENSION,
+                'generation': generation,
+                'index_file': index_name,
+                'created_at': time.time(),
+                'tombstones': sorted(_faiss_tombstones),
+                **_get_index_watermark(_faiss_index),
+            }
+            tmp_meta_path = _get_faiss_meta_path() + '.tmp'
+            with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_meta_path, _get_faiss_meta_path())
+
+            with open(_get_faiss_wal_path(), 'wb'):
+                pass
+            _faiss_wal_entries = 0
+            _faiss_wal_offset = 0
+            _faiss_generation = generation
+
+            # 保留上一代文件，正在切换的只读进程仍可能打开它
+            keep_names = {index_name, old_meta.get('index_file')}
+            for name in os.listdir(index_dir):
+                if name.startswith('gallery.') and name.endswith('.index') and name not in keep_names:
+                    try:
+                        os.remove(os.path.join(index_dir, name))
+                    except OSError:
+                        pass
+            return True
+        except Exception as e:
+            print(f">>> [FAISS] 保存索引快照失败: {e}")
+            return False
+
+
+def build_faiss_index():
+    """从数据库全量构建 FAISS 索引（超过阈值时自动训练近似索引），并写出快照"""
+    global _faiss_index, _faiss_generation, _faiss_wal_offset, _faiss_wal_entries
+    from .models import ImageItem  # 局部引入，避免循环依赖
+
+    # 开始读库前的日志位置：之前的记录数据库里都已经有了，之后其他进程追加的记录构建完再补
+    with _faiss_file_lock():
+        start_generation = int((_read_faiss_meta() or {}).get('generation', 0))
+        start_offset = _get_faiss_wal_size()
+
+    qs = ImageItem.objects.exclude(feature_vector__isnull=True)
+    vector_count = qs.count()
+    index_type = _choose_faiss_index_type(vector_count)
+
+    print(f">>> [FAISS] 正在全量构建全局向量索引 (类型: {index_type})...")
+    index = _new_faiss_index(index_type, vector_count)
+    if not index.is_trained:
+        index.train(_sample_training_vectors(qs, vector_count))
+
+    # 分块读取数据库，防 OOM
+    _add_vector_rows_to_index(index, qs.values_list('id', 'feature_vector').iterator(chunk_size=5000))
+
+    with _faiss_file_lock():
+        # 后台重建期间新增的行补读进来
+        max_id = _get_index_watermark(index)['max_id']
+        _add_vector_rows_to_index(index, qs.filter(id__gt=max_id).order_by('id').values_list('id', 'feature_vector'))
+        if _faiss_tombstones:
+            # 只保留构建期间被删掉、却已读进新索引的墓碑；行还在且有向量的是旧墓碑或 upsert 标记，留着会把活数据清掉
+            indexed_ids = _get_faiss_index_ids(index)
+            tombstones = np.fromiter(_faiss_tombstones, dtype=np.int64)
+            candidates = [int(obj_id) for obj_id in tombstones[np.isin(tombstones, indexed_ids)]]
+            live_ids = set()
+            for start in range(0, len(candidates), 500):
+                live_ids.update(qs.filter(id__in=candidates[start:start + 500]).values_list('id', flat=True))
+            _faiss_tombstones.clear()
+            _faiss_tombstones.update(obj_id for obj_id in candidates if obj_id not in live_ids)
+        # 构建期间其他进程追加的记录由写快照前的追日志按 upsert 补上；
+        # 若期间已有进程写出新一代快照，新一代的日志从头重放
+        generation = int((_read_faiss_meta() or {}).get('generation', 0))
+        _faiss_generation = generation
+        _faiss_wal_offset = start_offset if generation == start_generation else 0
+        _faiss_wal_entries = 0
+        _faiss_index = index
+        save_faiss_snapshot()
     print(f">>> [FAISS] 向量索引构建完成！当前库中包含 {_faiss_index.ntotal} 张可检索图片。")
 
-def add_to_faiss_index(db_id, vector_bytes):
-    """动态追加单张新图片到 FAISS 索引，用于后台任务"""
-    global _faiss_index
+
+def _schedule_faiss_background(target):
+    """在后台线程维护索引，期间继续使用旧索引提供检索"""
+    global _faiss_background_thread
+    with _faiss_lock:
+        if _faiss_background_thread is not None and _faiss_background_thread.is_alive():
+            return False
+        _faiss_background_thread = threading.Thread(target=target, daemon=True)
+        _faiss_background_thread.start()
+    return True
+
+
+def _schedule_faiss_rebuild():
+    return _schedule_faiss_background(build_faiss_index)
+
+
+def _schedule_faiss_compaction():
+    return _schedule_faiss_background(compact_faiss_index)
+
+
+def _maybe_upgrade_faiss_index():
+    """图库越过阈值后，平铺索引自动升级为训练好的近似索引"""
     if _faiss_index is None:
         return
+    if _get_faiss_index_type(_faiss_index) == 'flat' and _choose_faiss_index_type(_faiss_index.ntotal) != 'flat':
+        print(">>> [FAISS] 图库规模已超过近似检索阈值，后台训练近似索引...")
+        _schedule_faiss_rebuild()
+
+
+def _reconcile_faiss_index(index):
+    """
+    按 ID 集合对账：索引里多出的 ID 记为墓碑，缺失的 ID 从数据库补读。
+    差异过大或对账后仍不一致时返回 False，由调用方全量重建。
+    """
+    from .models import ImageItem
+
+    qs = ImageItem.objects.exclude(feature_vector__isnull=True)
+    db_ids = np.fromiter(qs.values_list('id', flat=True).iterator(chunk_size=20000), dtype=np.int64)
+    live_ids = _get_index_live_ids(index)
+    stale_ids = np.setdiff1d(live_ids, db_ids)
+    missing_ids = np.setdiff1d(db_ids, live_ids)
+
+    if stale_ids.size + missing_ids.size > max(1000, db_ids.size // 5):
+        return False
+
+    _faiss_tombstones.update(int(obj_id) for obj_id in stale_ids)
+    for start in range(0, missing_ids.size, 500):
+        chunk = [int(obj_id) for obj_id in missing_ids[start:start + 500]]
+        _add_vector_rows_to_index(index, qs.filter(id__in=chunk).values_list('id', 'feature_vector'))
+
+    return _get_index_watermark(index) == _get_db_vector_watermark()
+
+
+def load_faiss_index():
+    """
+    启动时加载索引：读取磁盘快照 -> 重放增量日志 -> 只补读数据库中超出水位线的新行。
+    水位线（行数 / 最大 ID / ID 校验和）对不上时按 ID 对账，差异过大才全量构建。
+    """
+    global _faiss_index, _faiss_wal_entries, _faiss_wal_offset, _faiss_generation
+    from .models import ImageItem
+
+    if get_faiss_role() == 'reader':
+        _load_faiss_reader_snapshot()
+        return
+
+    # 读快照与日志期间不允许其他进程写快照、截断日志
+    with _faiss_file_lock():
+        meta = _read_faiss_meta()
+        index_path = os.path.join(_get_faiss_index_dir(), meta['index_file']) if meta else ''
+        if not meta or not os.path.exists(index_path):
+            build_faiss_index()
+            return
+
+        try:
+            # 本进程需要继续追加向量，IVF 的 mmap 倒排表是只读的，这里整体读入内存
+            index = faiss.read_index(index_path)
+        except Exception as e:
+            print(f">>> [FAISS] 读取索引快照失败，改为全量构建: {e}")
+            build_faiss_index()
+            return
+        if _is_legacy_idmap_ivf(index):
+            print(">>> [FAISS] 快照是旧格式的 IDMap+IVF 索引，删除后会标签错位，改为全量构建")
+            build_faiss_index()
+            return
+
+        _apply_faiss_search_params(index)
+        _faiss_tombstones.clear()
+        _faiss_tombstones.update(meta.get('tombstones', []))
+        # 日志里可能有不持有索引的进程（如 Huey consumer）写的记录，按 upsert 重放
+        wal_records, wal_offset = _read_faiss_wal_from(0)
+        _replay_faiss_records(index, wal_records, upsert=True)
+
+        index_watermark = _get_index_watermark(index)
+        delta_rows = list(ImageItem.objects.exclude(feature_vector__isnull=True).filter(
+            id__gt=index_watermark['max_id']
+        ).order_by('id').values_list('id', 'feature_vector'))
+        _add_vector_rows_to_index(index, delta_rows)
+
+        if _get_index_watermark(index) != _get_db_vector_watermark() and not _reconcile_faiss_index(index):
+            print(">>> [FAISS] 快照与数据库差异过大，改为全量构建")
+            _faiss_tombstones.clear()
+            build_faiss_index()
+            return
+
+        _faiss_index = index
+        _faiss_generation = int(meta['generation'])
+        _faiss_wal_entries = len(wal_records)
+        _faiss_wal_offset = wal_offset
+        if delta_rows:
+            end_offset = _append_faiss_wal([
+                (_FAISS_WAL_OP_ADD, obj_id, decode_feature_vector(vec_bytes))
+                for obj_id, vec_bytes in delta_rows
+            ])
+            if end_offset is not None:
+                _faiss_wal_offset = end_offset
+            _faiss_wal_entries += len(delta_rows)
+        if _faiss_wal_entries >= _get_faiss_wal_compact_entries():
+            save_faiss_snapshot()
+    _maybe_upgrade_faiss_index()
+
+    print(f">>> [FAISS] 已加载索引快照 (第 {meta['generation']} 代)，重放日志 {len(wal_records)} 条，补读新增 {len(delta_rows)} 条，共 {_faiss_index.ntotal} 张可检索图片。")
+
+
+def _get_faiss_mmap_io_flags():
+    """
+    只读映射快照用的 IO 标志。IO_FLAG_MMAP 只覆盖 IVF 倒排表，平铺 / SQ 编码要靠 IO_FLAG_MMAP_IFC；
+    faiss 版本太旧没有这个标志时，每个 reader 都会读入一份私有拷贝，启动时明确告警
+    """
+    global _faiss_mmap_warned
+    ifc_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+    if ifc_flag is None:
+        ifc_flag = 0
+        if not _faiss_mmap_warned:
+            _faiss_mmap_warned = True
+            print(
+                f">>> [FAISS] 警告：当前 faiss {getattr(faiss, '__version__', '?')} 不支持 IO_FLAG_MMAP_IFC，"
+                "平铺 / SQ 索引无法 mmap 共享，每个 reader 进程都会载入完整副本；请升级 faiss 或改用 IVF 索引"
+            )
+    return faiss.IO_FLAG_MMAP | ifc_flag | faiss.IO_FLAG_READ_ONLY
+
+
+def _load_faiss_reader_snapshot():
+    """只读进程：以 mmap 方式打开 owner 发布的最新一代快照，多个进程共享同一份物理内存"""
+    global _faiss_index, _faiss_reader_generation, _faiss_reader_checked_at
+
+    _faiss_reader_checked_at = time.time()
+    meta = _read_faiss_meta()
+    if not meta:
+        with _faiss_lock:
+            if _faiss_index is None:
+                print(">>> [FAISS] 尚未发现 owner 发布的索引快照，暂以空索引提供检索")
+                _faiss_index = _new_faiss_index()
+        return False
+    if meta['generation'] == _faiss_reader_generation and _faiss_index is not None:
+        return False
+
+    index_path = os.path.join(_get_faiss_index_dir(), meta['index_file'])
+    io_flags = _get_faiss_mmap_io_flags()
     try:
-        vec = np.frombuffer(vector_bytes, dtype=np.float32).reshape(1, -1)
-        _faiss_index.add_with_ids(vec, np.array([db_id], dtype=np.int64))
+        index = faiss.read_index(index_path, io_flags)
     except Exception as e:
-        print(f"动态追加 FAISS 索引失败: {e}")
+        # 快照可能刚被下一代替换，等下次检查
+        print(f">>> [FAISS] 映射索引快照失败: {e}")
+        with _faiss_lock:
+            if _faiss_index is None:
+                _faiss_index = _new_faiss_index()
+        return False
 
-def search_similar_images(query_image_file, queryset, top_k=50):
-    """基于 FAISS 的极速以图搜图"""
-    global _faiss_index
-    
-    query_bytes = generate_image_embedding(query_image_file)
-    if query_bytes is None:
-        return []
+    _apply_faiss_search_params(index)
+    with _faiss_lock:
+        # 整体替换引用即完成切换，正在检索的线程继续使用旧对象
+        _faiss_index = index
+        _faiss_reader_generation = meta['generation']
+        _faiss_tombstones.clear()
+        _faiss_tombstones.update(meta.get('tombstones', []))
+    print(f">>> [FAISS] 已映射第 {meta['generation']} 代索引快照，共 {index.ntotal} 张可检索图片。")
+    return True
+
+
+def refresh_faiss_reader():
+    """只读进程定期检查是否有新一代快照（按 GALLERY_FAISS_RELOAD_INTERVAL 节流）"""
+    if get_faiss_role() != 'reader':
+        return False
+    if _faiss_index is not None and time.time() - _faiss_reader_checked_at < _get_faiss_reload_interval():
+        return False
+    return _load_faiss_reader_snapshot()
 
-    query_vec = np.frombuffer(query_bytes, dtype=np.float32).reshape(1, -1)
 
-    if _faiss_index is None or _faiss_index.ntotal == 0:
-        build_faiss_index()
+def _forward_faiss_change(db_ids):
+    """只读进程不改索引，把变更的 ID 交给 owner 进程按数据库现状同步"""
+    if _call_embedding_service('/sync', payload={'ids': list(db_ids)}) is not None:
+        return
+    from .tasks import sync_faiss_vectors_task
+    try:
+        sync_faiss_vectors_task(list(db_ids))
+    except Exception as e:
+        print(f">>> [FAISS] 提交索引同步任务失败: {e}")
+
+
+def sync_faiss_ids(db_ids):
+    """owner 侧：按数据库现状同步一批 ID（有向量则 upsert，没有则删除）"""
+    from .models import ImageItem
+
+    if get_faiss_role() == 'reader':
+        print(">>> [FAISS] 只读进程不能同步索引，请检查 GALLERY_FAISS_ROLE 配置")
+        return
+    if _faiss_index is None:
+        load_faiss_index()
+
+    rows = dict(ImageItem.objects.filter(id__in=db_ids).exclude(feature_vector__isnull=True).values_list('id', 'feature_vector'))
+    missing_ids = [db_id for db_id in db_ids if db_id not in rows]
+    if rows:
+        add_batch_to_faiss_index(list(rows.keys()), list(rows.values()), replace=True)
+    if missing_ids:
+        remove_from_faiss_index(missing_ids)
+
+
+def sync_faiss_with_database():
+    """有未落盘的变更或与数据库对不上时写出新一代快照；返回是否写出"""
+    if _faiss_index is None:
+        load_faiss_index()
+
+    with _faiss_lock:
+        meta = _read_faiss_meta() or {}
+        dirty = _faiss_wal_entries > 0 or sorted(_faiss_tombstones) != meta.get('tombstones', [])
+        needs_rebuild = False
+        if _get_index_watermark(_faiss_index) != _get_db_vector_watermark():
+            # 绕过信号的批量更新等变更，在这里按 ID 对账补齐
+            needs_rebuild = not _reconcile_faiss_index(_faiss_index)
+            dirty = True
+        if not needs_rebuild:
+            return save_faiss_snapshot() if dirty else False
+    build_faiss_index()
+    return True
+
+
+def publish_faiss_snapshot():
+    """owner 侧：发布新一代快照供只读进程切换"""
+    if get_faiss_role() != 'owner':
+        return False
+    return sync_faiss_with_database()
+
+
+def _append_faiss_records_without_index(records):
+    """
+    本进程没有加载索引（例如 standalone 模式下的 Huey consumer）：变更只写进增量日志，
+    持有索引的进程按 GALLERY_FAISS_RELOAD_INTERVAL 追日志时补进去，下次加载时也会重放
+    """
+    try:
+        _commit_faiss_records(records)
+    except Exception as e:
+        print(f">>> [FAISS] 写入增量日志失败: {e}")
+
+
+def refresh_faiss_from_wal():
+    """standalone 进程定期把其他进程追加到增量日志的记录补进本进程索引（按 GALLERY_FAISS_RELOAD_INTERVAL 节流）"""
+    global _faiss_wal_checked_at
+    if get_faiss_role() != 'standalone' or _faiss_index is None:
+        return False
+    now = time.time()
+    if now - _faiss_wal_checked_at < _get_faiss_reload_interval():
+        return False
+    _faiss_wal_checked_at = now
+
+    with _faiss_lock:
+        meta = _read_faiss_meta() or {}
+        if _get_faiss_wal_size() == _faiss_wal_offset and int(meta.get('generation', 0)) == _faiss_generation:
+            return False
+    with _faiss_file_lock():
+        _catch_up_faiss_wal()
+        needs_snapshot = _faiss_wal_entries >= _get_faiss_wal_compact_entries()
+    if needs_snapshot:
+        _schedule_faiss_background(save_faiss_snapshot)
+    return True
+
+
+def add_to_faiss_index(db_id, vector_bytes, replace=False):
+    """
+    动态追加单张图片到 FAISS 索引，并写入增量日志，用于后台任务。
+    replace=True 时先移除该 ID 的旧向量（重新编码后的 upsert）。
+    """
+    add_batch_to_faiss_index([db_id], [vector_bytes], replace=replace)
+
+
+def add_batch_to_faiss_index(db_ids, vectors, replace=False):
+    """整批追加向量：一次 add_with_ids，一次写增量日志"""
+    db_ids = [int(db_id) for db_id in db_ids]
+    if db_ids and _get_embedding_service_url() and _call_embedding_service('/sync', payload={'ids': db_ids}) is not None:
+        return
+    if get_faiss_role() == 'reader':
+        if db_ids:
+            _forward_faiss_change(db_ids)
+        return
+    needs_rebuild = False
+    with _faiss_lock:
+        if not db_ids:
+            return
+        if _faiss_index is None:
+            decoded = [(db_id, decode_feature_vector(vec)) for db_id, vec in zip(db_ids, vectors)]
+            _append_faiss_records_without_index([
+                (_FAISS_WAL_OP_ADD, db_id, vector) for db_id, vector in decoded
+                if vector is not None and vector.size == FAISS_DIMENSION
+            ])
+            return
+        try:
+            vecs = np.vstack([decode_feature_vector(vec) for vec in vectors]).reshape(len(db_ids), -1)
+            replaced_ids = [db_id for db_id in db_ids if replace or db_id in _faiss_tombstones]
+            needs_rebuild = bool(replaced_ids) and replace and not _faiss_supports_remove(_faiss_index)
+            records = [(_FAISS_WAL_OP_DELETE, db_id, None) for db_id in replaced_ids]
+            records.extend((_FAISS_WAL_OP_ADD, db_id, vec) for db_id, vec in zip(db_ids, vecs))
+            # 删除记录先记墓碑，随后的新增把旧向量物理移除再写入
+            _commit_faiss_records(records)
+        except Exception as e:
+            print(f"动态追加 FAISS 索引失败: {e}")
+            return
+        if _faiss_wal_entries >= _get_faiss_wal_compact_entries():
+            save_faiss_snapshot()
+    if needs_rebuild:
+        _schedule_faiss_rebuild()
+    _maybe_upgrade_faiss_index()
+
+
+def remove_from_faiss_index(db_ids):
+    """删除图片时记墓碑而不是立即移除，墓碑超过阈值后后台压缩"""
+    db_ids = [int(db_id) for db_id in db_ids]
+    if db_ids and _get_embedding_service_url() and _call_embedding_service('/sync', payload={'ids': db_ids}) is not None:
+        return
+    if get_faiss_role() == 'reader':
+        if db_ids:
+            # 本地先记墓碑，owner 发布新快照之前检索也不会返回已删除的图片
+            _faiss_tombstones.update(db_ids)
+            _forward_faiss_change(db_ids)
+        return
+    with _faiss_lock:
+        if not db_ids:
+            return
+        if _faiss_index is None:
+            _append_faiss_records_without_index([(_FAISS_WAL_OP_DELETE, db_id, None) for db_id in db_ids])
+            return
+        _commit_faiss_records([(_FAISS_WAL_OP_DELETE, db_id, None) for db_id in db_ids])
+        needs_compaction = len(_faiss_tombstones) >= _get_faiss_tombstone_threshold(_faiss_index.ntotal)
+    if needs_compaction:
+        _schedule_faiss_compaction()
+
+
+def compact_faiss_index():
+    """物理移除全部墓碑并写出新快照；不支持删除的索引改为全量重建"""
+    with _faiss_lock:
+        if _faiss_index is None or not _faiss_tombstones:
+            return
+        if _faiss_supports_remove(_faiss_index):
+            print(f">>> [FAISS] 正在压缩索引，移除 {len(_faiss_tombstones)} 条已删除向量...")
+            save_faiss_snapshot()
+            return
+    build_faiss_index()
+
+
+_SEARCH_SCORE_THRESHOLD = 0.45
+_FAISS_FILTER_MAX_ROUNDS = 8
+
+
+def _get_faiss_filter_brute_force_max():
+    return max(0, int(getattr(settings, 'GALLERY_FAISS_FILTER_BRUTE_FORCE_MAX', 5000)))
+
+
+def _make_faiss_search_params(index, selector, scale):
+    """组装带 ID 过滤器的检索参数；scale 用于逐轮放大 nprobe / efSearch"""
+    if selector is None and scale == 1:
+        return None
+    index_type = _get_faiss_index_type(index)
+    kwargs = {'sel': selector} if selector is not None else {}
+    if index_type in _FAISS_TRAINED_INDEX_TYPES:
+        nlist = faiss.extract_index_ivf(index).nlist
+        nprobe = max(1, int(getattr(settings, 'GALLERY_FAISS_NPROBE', 16)))
+        return faiss.SearchParametersIVF(nprobe=min(nlist, nprobe * scale), **kwargs)
+    if index_type == 'hnsw':
+        ef_search = max(1, int(getattr(settings, 'GALLERY_FAISS_EF_SEARCH', 64)))
+        return faiss.SearchParametersHNSW(efSearch=ef_search * scale, **kwargs)
+    return faiss.SearchParameters(**kwargs) if kwargs else None
+
+
+def search_faiss_vector(query_vec, top_k=50, allowed_ids=None, min_score=None):
+    """
+    用查询向量检索索引，返回 [(id, 分数 0-100)]，已过滤墓碑与低分结果。
+    allowed_ids 不为空时用 IDSelector 把过滤条件下推到索引里；
+    结果不够时逐轮放大 k 与 nprobe / efSearch，直到凑满 top_k 或后面已全是低分结果。
+    min_score 默认为图搜图的阈值；文本查询与图片的相似度整体偏低，需要单独传入。
+    """
+    min_score = _SEARCH_SCORE_THRESHOLD if min_score is None else min_score
+    if _faiss_index is None:
+        load_faiss_index()
+    else:
+        refresh_faiss_reader()
+        refresh_faiss_from_wal()
         
     if _faiss_index.ntotal == 0:
         return [] 
 
-    # 执行检索
-    distances, indices = _faiss_index.search(query_vec, top_k)
+    query_vec = np.asarray(query_vec, dtype=np.float32).reshape(1, -1)
+    selector = None
+    if allowed_ids is not None:
+        allowed_ids = np.asarray(allowed_ids, dtype=np.int64)
+        if allowed_ids.size == 0:
+            return []
+        selector = faiss.IDSelectorBatch(allowed_ids)
 
-    THRESHOLD = 0.45
-    target_ids = []
-    id_score_map = {}
-    
-    for i, db_id in enumerate(indices[0]):
-        if db_id == -1: 
-            continue 
-            
-        score = float(distances[0][i])
-        if score > THRESHOLD:
-            target_ids.append(int(db_id))
-            id_score_map[int(db_id)] = int(score * 100)
+    with _faiss_lock:
+        index = _faiss_index
+        tombstones = set(_faiss_tombstones)
+        limit = index.ntotal if allowed_ids is None else min(index.ntotal, int(allowed_ids.size) + len(tombstones))
+        # 按墓碑数量多取一些，保证过滤掉已删除向量后 top_k 仍然是满的
+        fetch_k = min(top_k + len(tombstones), limit)
+        is_exact = _get_faiss_index_type(index) == 'flat'
+        scale = 1
+
+        for _ in range(_FAISS_FILTER_MAX_ROUNDS):
+            params = _make_faiss_search_params(index, selector, scale)
+            if params is None:
+                distances, indices = index.search(query_vec, fetch_k)
+            else:
+                distances, indices = index.search(query_vec, fetch_k, params=params)
+
+            hits = []
+            seen_ids = set()
+            for score, db_id in zip(distances[0], indices[0]):
+                db_id = int(db_id)
+                if db_id == -1 or db_id in tombstones or db_id in seen_ids:
+                    continue
+                if score > min_score:
+                    seen_ids.add(db_id)
+                    hits.append((db_id, int(float(score) * 100)))
+                    if len(hits) >= top_k:
+                        break
+
+            valid = indices[0] != -1
+            reached_low_scores = bool(valid.any()) and float(distances[0][valid][-1]) <= min_score
+            if len(hits) >= top_k or reached_low_scores or (is_exact and fetch_k >= limit):
+                break
+            fetch_k = min(fetch_k * 2, limit)
+            scale *= 2
+    return hits
 
-    if not target_ids:
+
+def _search_vector_rows(query_vec, rows, top_k, min_score=None):
+    """过滤后的候选集很小时，直接用数据库里的向量做精确内积"""
+    min_score = _SEARCH_SCORE_THRESHOLD if min_score is None else min_score
+    ids = []
+    vectors = []
+    for obj_id, vec_bytes in rows:
+        vector = decode_feature_vector(vec_bytes)
+        if vector is not None and vector.size == FAISS_DIMENSION:
+            ids.append(obj_id)
+            vectors.append(vector)
+    if not ids:
         return []
 
+    scores = np.array(vectors, dtype=np.float32) @ np.asarray(query_vec, dtype=np.float32).reshape(-1)
+    order = np.argsort(-scores)[:top_k]
+    return [(ids[position], int(float(scores[position]) * 100)) for position in order if scores[position] > min_score]
+
+
+def _search_vector(query_vec, top_k, allowed_ids=None, min_score=None):
+    """配置了向量服务时交给服务检索，否则查本进程索引"""
+    if _get_embedding_service_url():
+        payload = {
+            'vector': base64.b64encode(encode_feature_vector(query_vec, 'float32')).decode('ascii'),
+            'top_k': top_k,
+        }
+        if allowed_ids is not None:
+            payload['ids'] = [int(db_id) for db_id in allowed_ids]
+        if min_score is not None:
+            payload['min_score'] = min_score
+        result = _call_embedding_service('/search', payload=payload)
+        if result is not None:
+            return [(int(db_id), int(score)) for db_id, score in result['hits']]
+    return search_faiss_vector(query_vec, top_k, allowed_ids=allowed_ids, min_score=min_score)
+
+
+def _search_filtered_vector(query_vec, filtered_qs, top_k, min_score=None):
+    """候选集较小走精确计算，否则把候选 ID 下推到索引"""
+    candidate_count = filtered_qs.count()
+    if candidate_count <= _get_faiss_filter_brute_force_max():
+        rows = filtered_qs.values_list('id', 'feature_vector').iterator(chunk_size=2000)
+        return _search_vector_rows(query_vec, rows, top_k, min_score=min_score)
+
+    allowed_ids = np.fromiter(filtered_qs.values_list('id', flat=True).iterator(chunk_size=20000), dtype=np.int64)
+    return _search_vector(query_vec, top_k, allowed_ids=allowed_ids, min_score=min_score)
+
+
+def _hash_query_file(query_image_file):
+    md5 = hashlib.md5()
+    if isinstance(query_image_file, str):
+        with open(query_image_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    if hasattr(query_image_file, 'seek'):
+        query_image_file.seek(0)
+    chunks = query_image_file.chunks() if hasattr(query_image_file, 'chunks') else iter(lambda: query_image_file.read(1024 * 1024), b'')
+    for chunk in chunks:
+        md5.update(chunk)
+    if hasattr(query_image_file, 'seek'):
+        query_image_file.seek(0)
+    return md5.hexdigest()
+
+
+def get_query_embedding(query_image_file):
+    """
+    以图搜图的查询向量，按文件 MD5 复用：
+    库里已有同一文件时直接用它存好的 feature_vector，其次查 Django 缓存，都没有才跑 CLIP。
+    """
+    from django.core.cache import cache
+    from .models import ImageItem
+
+    try:
+        file_hash = _hash_query_file(query_image_file)
+    except Exception as e:
+        print(f"计算查询图片哈希失败: {e}")
+        return generate_image_embedding(query_image_file)
+
+    stored_vector = ImageItem.objects.filter(image_hash=file_hash).exclude(
+        feature_vector__isnull=True
+    ).values_list('feature_vector', flat=True).first()
+    if stored_vector is not None:
+        return bytes(stored_vector)
+
+    cache_key = f'gallery:query_embedding:{file_hash}'
+    cached_vector = cache.get(cache_key)
+    if cached_vector is not None:
+        return cached_vector
+
+    query_bytes = generate_image_embedding(query_image_file)
+    if query_bytes is not None:
+        cache.set(cache_key, query_bytes, int(getattr(settings, 'GALLERY_QUERY_EMBEDDING_CACHE_TIMEOUT', 7 * 24 * 3600)))
+    return query_bytes
+
+
+def search_similar_images(query_image_file, queryset, top_k=50):
+    """
+    基于 FAISS 的极速以图搜图。
+    queryset 带过滤条件（如只看喜欢的图）时，过滤在检索阶段完成，而不是检索完再求交集。
+    """
+    query_bytes = get_query_embedding(query_image_file)
+    if query_bytes is None:
+        return []
+    return _search_images_by_vector(decode_feature_vector(query_bytes), queryset, top_k)
+
+
+def _search_images_by_vector(query_vec, queryset, top_k, exclude_id=None, min_score=None):
+    if queryset.query.has_filters():
+        hits = _search_filtered_vector(query_vec, queryset.exclude(feature_vector__isnull=True), top_k, min_score=min_score)
+    else:
+        hits = _search_vector(query_vec, top_k, min_score=min_score)
+
+    hits = [(db_id, score) for db_id, score in hits if db_id != exclude_id]
+    if not hits:
+        return []
+
+    id_score_map = dict(hits)
+    target_ids = [db_id for db_id, _ in hits]
     objects_dict = queryset.in_bulk(target_ids)
     
     results = []
@@ -258,4 +1575,105 @@ def search_similar_images(query_image_file, queryset, top_k=50):
             obj.similarity_score = id_score_map[obj_id]
             results.append(obj)
             
-    return results
\ No newline at end of file
+    return results
+
+
+def search_similar_to_item(item, queryset, top_k=50):
+    """
+    以库内已有图片找相似：直接用库里存的特征向量检索，不再解码和过 CLIP。
+    翻页时调用方逐页放大 top_k，返回结果不含 item 自身。
+    """
+    query_vec = decode_feature_vector(item.feature_vector)
+    if query_vec is None:
+        return []
+    # 多取一条，抵掉命中的自身
+    return _search_images_by_vector(query_vec, queryset, top_k + 1, exclude_id=item.pk)[:top_k]
+
+
+def get_text_search_min_score():
+    return float(getattr(settings, 'GALLERY_TEXT_SEARCH_MIN_SCORE', 0.2))
+
+
+def get_text_query_embedding(text):
+    """文本查询向量按规范化后的文本缓存，热门搜索词不用反复过 CLIP"""
+    from django.core.cache import cache
+
+    normalized_text = ' '.join(text.split()).lower()
+    if not normalized_text:
+        return None
+    cache_key = f"gallery:text_embedding:{hashlib.md5(normalized_text.encode('utf-8')).hexdigest()}"
+    cached_vector = cache.get(cache_key)
+    if cached_vector is not None:
+        return cached_vector
+
+    query_bytes = generate_text_embedding(normalized_text)
+    if query_bytes is not None:
+        cache.set(cache_key, query_bytes, int(getattr(settings, 'GALLERY_QUERY_EMBEDDING_CACHE_TIMEOUT', 7 * 24 * 3600)))
+    return query_bytes
+
+
+def search_images_by_text(text, queryset, top_k=100):
+    """以文搜图：CLIP 文本向量直接查图片索引，返回带 similarity_score 的对象列表"""
+    query_bytes = get_text_query_embedding(text)
+    if query_bytes is None:
+        return []
+    return _search_images_by_vector(decode_feature_vector(query_bytes), queryset, top_k, min_score=get_text_search_min_score())
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """RRF 融合多路排序：每路贡献 1 / (k + 名次)，返回按总分降序的 id 列表"""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    # 稳定排序：同分时保持首次出现的先后
+    return sorted(scores, key=lambda item_id: -scores[item_id])
+
+
+def get_near_duplicate_threshold():
+    return float(getattr(settings, 'GALLERY_NEAR_DUPLICATE_THRESHOLD', 0.95))
+
+
+def iter_near_duplicate_pairs(rows, threshold=None, chunk_size=None):
+    """
+    全库近似重复自连接：按块把 (id, 向量) 作为查询批量 range_search，
+    每块产出 (源 id 数组, 邻居 id 数组, 相似度数组)，已去掉自身与墓碑，全程只在 numpy 里处理。
+    """
+    if _faiss_index is None:
+        load_faiss_index()
+    else:
+        refresh_faiss_reader()
+
+    threshold = get_near_duplicate_threshold() if threshold is None else float(threshold)
+    chunk_size = max(1, int(chunk_size or getattr(settings, 'GALLERY_NEAR_DUPLICATE_CHUNK_SIZE', 1024)))
+
+    def search_chunk(ids, vectors):
+        with _faiss_lock:
+            index = _faiss_index
+            tombstones = np.fromiter(_faiss_tombstones, dtype=np.int64) if _faiss_tombstones else None
+            if index.ntotal == 0:
+                return None
+            lims, scores, neighbors = index.range_search(np.asarray(vectors, dtype=np.float32), threshold)
+        sources = np.repeat(np.asarray(ids, dtype=np.int64), np.diff(lims).astype(np.int64))
+        keep = neighbors != sources
+        if tombstones is not None:
+            keep &= ~np.isin(neighbors, tombstones)
+        return sources[keep], neighbors[keep], scores[keep]
+
+    ids = []
+    vectors = []
+    for obj_id, vec_bytes in rows:
+        vector = decode_feature_vector(vec_bytes)
+        if vector is None or vector.size != FAISS_DIMENSION:
+            continue
+        ids.append(obj_id)
+        vectors.append(vector)
+        if len(ids) >= chunk_size:
+            result = search_chunk(ids, vectors)
+            if result is not None:
+                yield result
+            ids, vectors = [], []
+    if ids:
+        result = search_chunk(ids, vectors)
+        if result is not None:
+            yield result
@@ -49,4 +49,25 @@ class GalleryConfig(AppConfig):
             if os.environ.get('RUN_MAIN') == 'true' or not is_runserver:
                 cleanup_thread = threading.Thread(target=run_cleanup_loop, daemon=True)
                 cleanup_thread.start()
-                print(">> 自动清理服务已启动 (后台线程)")
\ No newline at end of file
+                print(">> 自动清理服务已启动 (后台线程)")
+
+                # 3. 上次停机前没处理完的图片（缺哈希或向量）重新入队
+                try:
+                    from .tasks import enqueue_missing_image_processing
+                    enqueue_missing_image_processing()
+                except Exception as e:
+                    print(f">> [后台任务] 补录图片处理任务失败: {e}")
+
+                # 4. 提示词分组用的 LSH 桶补录（老数据首次启动时建立）
+                try:
+                    from .tasks import index_missing_prompt_lsh_task
+                    index_missing_prompt_lsh_task()
+                except Exception as e:
+                    print(f">> [后台任务] 补录提示词 LSH 桶失败: {e}")
+
+                # 5. 组上的文件数 / 视频标记 / 实际封面补算（老数据首次启动时回填）
+                try:
+                    from .tasks import fill_missing_media_stats_task
+                    fill_missing_media_stats_task()
+                except Exception as e:
+                    print(f">> [后台任务] 补算组媒体统计失败: {e}")
@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Value
+
+
+GLOBAL_FACETS_CACHE_KEY = 'gallery:facet_counts:v1'
+# get_tags_bar_data 的缓存，组 / 标签 / 模型变化时一并失效
+TAGS_BAR_CACHE_KEY = 'tags_bar_data_v2'
+
+
+def invalidate_facet_counts():
+    """
+    作品、标签、人物、模型有增删改时由信号调用，queryset.update / bulk_update 的批量路径需要手动调用。
+    默认的进程内缓存只能清掉本进程，其它进程靠 GALLERY_FACET_CACHE_TIMEOUT 过期兜底。
+    """
+    cache.delete_many([GLOBAL_FACETS_CACHE_KEY, TAGS_BAR_CACHE_KEY])
+
+
+def get_global_facet_counts():
+    """
+    全库筛选项计数：{'chars': [{name, use_count}], 'tags': [{name, use_count}], 'total_groups': 家族数}，
+    人物 / 标签按使用次数降序。模型名在首页按请求排除，这里不做截断。
+    """
+    cached = cache.get(GLOBAL_FACETS_CACHE_KEY)
+    if cached is not None:
+        return cached
+
+    from .models import Character, PromptGroupHead, Tag
+    PromptGroupHead.ensure_built()
+    facets = {
+        'chars': list(
+            Character.objects.annotate(use_count=Count('promptgroup')).filter(use_count__gt=0)
+            .order_by('-use_count', 'name').values('name', 'use_count')
+        ),
+        'tags': list(
+            Tag.objects.annotate(use_count=Count('promptgroup')).filter(use_count__gt=0)
+            .order_by('-use_count', 'name').values('name', 'use_count')
+        ),
+        'total_groups': PromptGroupHead.objects.count(),
+    }
+    cache.set(GLOBAL_FACETS_CACHE_KEY, facets, getattr(settings, 'GALLERY_FACET_CACHE_TIMEOUT', 300))
+    return facets
+
+
+def get_context_facet_counts(queryset):
+    """
+    当前筛选 / 搜索结果里各人物、标签出现的作品数：两张中间表 UNION 成一条 GROUP BY 查询。
+    返回 {'chars': {名称: 数量}, 'tags': {名称: 数量}}。
+    """
+    from .models import PromptGroup
+
+    group_ids = queryset.order_by().values('id')
+    char_counts = (
+        PromptGroup.characters.through.objects.filter(promptgroup_id__in=group_ids)
+        .annotate(kind=Value('chars'), name=F('character__name'))
+        .values('kind', 'name')
+        .annotate(use_count=Count('promptgroup_id', distinct=True))
+        .order_by()
+    )
+    tag_counts = (
+        PromptGroup.tags.through.objects.filter(promptgroup_id__in=group_ids)
+        .annotate(kind=Value('tags'), name=F('tag__name'))
+        .values('kind', 'name')
+        .annotate(use_count=Count('promptgroup_id', distinct=True))
+        .order_by()
+    )
+
+    counts = {'chars': {}, 'tags': {}}
+    for row in char_counts.union(tag_counts, all=True):
+        counts[row['kind']][row['name']] = row['use_count']
+    return counts
+
+
+def build_filter_facets(model_names, context_counts=None, selected_chars=(), selected_tags=(), tag_limit=50):
+    """
+    组装侧边栏的人物 / 标签列表。没有筛选上下文时用全库计数；
+    有上下文时按当前结果重新计数排序，已勾选的项即使计数为 0 也保留，方便取消。
+    """
+    facets = get_global_facet_counts()
+    model_names = set(model_names)
+    chars = [dict(item) for item in facets['chars']]
+    tags = [dict(item) for item in facets['tags'] if item['name'] not in model_names]
+
+    if context_counts is not None:
+        selected_chars, selected_tags = set(selected_chars), set(selected_tags)
+        for item in chars:
+            item['use_count'] = context_counts['chars'].get(item['name'], 0)
+        for item in tags:
+            item['use_count'] = context_counts['tags'].get(item['name'], 0)
+        chars = [item for item in chars if item['use_count'] or item['name'] in selected_chars]
+        tags = [item for item in tags if item['use_count'] or item['name'] in selected_tags]
+        chars.sort(key=lambda item: -item['use_count'])
+        tags.sort(key=lambda item: -item['use_count'])
+        pinned = [item for item in tags[tag_limit:] if item['name'] in selected_tags]
+        return {'chars': chars, 'tags': tags[:tag_limit] + pinned}
+
+    return {'chars': chars, 'tags': tags[:tag_limit]}
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gallery.services import index_prompt_groups
+
+
+class Command(BaseCommand):
+    help = '重建提示词 MinHash-LSH 桶表（新建作品自动归组时用它召回全库相似候选）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing-only', action='store_true', help='只补还没有桶的组，不清空重建')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        self.stdout.write("🚀 开始写入提示词 LSH 桶...")
+
+        def report(processed):
+            self.stdout.write(f"   已处理 {processed} 个组", ending='\r')
+            self.stdout.flush()
+
+        processed = index_prompt_groups(
+            missing_only=options['missing_only'],
+            batch_size=max(1, options['batch_size']),
+            progress=report,
+        )
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f"✅ 完成：{processed} 个组，耗时 {time.time() - start_time:.1f}s"))
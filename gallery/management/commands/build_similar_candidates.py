@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gallery.services import rebuild_similar_group_candidates
+
+
+class Command(BaseCommand):
+    help = '全库重算“关联版本”相似组候选表（rapidfuzz cdist 多线程批量打分，每组保留 top-20）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing-only', action='store_true', help='只补还没有候选记录的组，不清空重建')
+        parser.add_argument('--batch-size', type=int, default=256, help='每次 cdist 的源组数量')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        self.stdout.write("🚀 开始计算相似组候选...")
+
+        def report(processed, total):
+            self.stdout.write(f"   已处理 {processed}/{total} 个组", ending='\r')
+            self.stdout.flush()
+
+        processed = rebuild_similar_group_candidates(
+            missing_only=options['missing_only'],
+            batch_size=max(1, options['batch_size']),
+            progress=report,
+        )
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f"✅ 完成：{processed} 个组，耗时 {time.time() - start_time:.1f}s"))
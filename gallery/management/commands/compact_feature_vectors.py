@@ -0,0 +1,104 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from gallery.ai_utils import decode_feature_vector, encode_feature_vector, get_feature_vector_codec, get_feature_vector_format
+from gallery.models import ImageItem
+
+
+class Command(BaseCommand):
+    help = '把存量特征向量流式转换为紧凑存储格式 (float16 / int8)，可先做召回率校验'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['float32', 'float16', 'int8'], default=None, help='目标格式，默认取 GALLERY_FEATURE_VECTOR_FORMAT')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批读取 / 写回的行数')
+        parser.add_argument('--check-recall', type=int, default=0, metavar='N', help='转换前抽 N 个查询，与 float32 基线比较 recall@K')
+        parser.add_argument('--recall-k', type=int, default=10)
+        parser.add_argument('--min-recall', type=float, default=0.0, help='召回率低于该值时中止转换')
+        parser.add_argument('--dry-run', action='store_true', help='只统计与校验，不写库')
+
+    def handle(self, *args, **options):
+        vector_format = options['format'] or get_feature_vector_format()
+        batch_size = max(1, options['batch_size'])
+        qs = ImageItem.objects.exclude(feature_vector__isnull=True).order_by('id')
+
+        if options['check_recall']:
+            recall = self.measure_recall(qs, vector_format, options['check_recall'], options['recall_k'])
+            if recall < options['min_recall']:
+                raise CommandError(f'recall@{options["recall_k"]} = {recall:.4f} 低于 {options["min_recall"]}，已中止转换')
+
+        converted = skipped = failed = 0
+        bytes_before = bytes_after = 0
+        start_time = time.time()
+        pending = []
+
+        self.stdout.write(f"🚀 开始转换特征向量 -> {vector_format} (每批 {batch_size} 行)...")
+        # 按 id 分块读完一批再写回：SQLite 边迭代边改同一张表不安全
+        last_id = 0
+        while True:
+            rows = list(qs.filter(id__gt=last_id).values_list('id', 'feature_vector')[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for obj_id, vec_bytes in rows:
+                vec_bytes = bytes(vec_bytes)
+                bytes_before += len(vec_bytes)
+                if (get_feature_vector_codec(vec_bytes) or 'float32') == vector_format:
+                    bytes_after += len(vec_bytes)
+                    skipped += 1
+                    continue
+
+                vector = decode_feature_vector(vec_bytes)
+                if vector is None:
+                    bytes_after += len(vec_bytes)
+                    failed += 1
+                    continue
+
+                encoded = encode_feature_vector(vector, vector_format)
+                bytes_after += len(encoded)
+                pending.append(ImageItem(id=obj_id, feature_vector=encoded))
+            converted += self.flush(pending, options['dry_run'])
+
+        ratio = bytes_before / bytes_after if bytes_after else 1.0
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ 转换完成：{converted} 行已转换，{skipped} 行无需处理，{failed} 行无法解析；"
+            f"向量体积 {bytes_before / 1024 / 1024:.1f} MB -> {bytes_after / 1024 / 1024:.1f} MB ({ratio:.1f}x)，"
+            f"耗时 {time.time() - start_time:.1f}s"
+        ))
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING("（--dry-run：未写入数据库）"))
+
+    def flush(self, pending, dry_run):
+        count = len(pending)
+        if pending and not dry_run:
+            # bulk_update 不触发 post_save，量化误差很小，不必重写 FAISS 索引
+            ImageItem.objects.bulk_update(pending, ['feature_vector'])
+        pending.clear()
+        return count
+
+    def measure_recall(self, qs, vector_format, query_count, k, corpus_limit=20000):
+        """在前 corpus_limit 个向量上，用精确内积检索对比 float32 与量化后的 top-K 重合率"""
+        baseline = []
+        for vec_bytes in qs.values_list('feature_vector', flat=True).iterator(chunk_size=2000):
+            vector = decode_feature_vector(vec_bytes)
+            if vector is not None:
+                baseline.append(vector)
+            if len(baseline) >= corpus_limit:
+                break
+        if len(baseline) <= k:
+            self.stdout.write(self.style.WARNING("向量太少，跳过召回率校验"))
+            return 1.0
+
+        baseline = np.array(baseline, dtype=np.float32)
+        quantized = np.array([decode_feature_vector(encode_feature_vector(vector, vector_format)) for vector in baseline])
+        query_positions = np.linspace(0, len(baseline) - 1, num=min(query_count, len(baseline)), dtype=np.int64)
+
+        hits = 0
+        for position in query_positions:
+            expected = np.argpartition(-(baseline @ baseline[position]), k)[:k]
+            actual = np.argpartition(-(quantized @ quantized[position]), k)[:k]
+            hits += len(set(expected.tolist()) & set(actual.tolist()))
+        recall = hits / (len(query_positions) * k)
+        self.stdout.write(f"📏 {vector_format} recall@{k} = {recall:.4f} ({len(query_positions)} 个查询 / {len(baseline)} 个向量)")
+        return recall
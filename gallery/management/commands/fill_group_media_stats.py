@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gallery.services import fill_group_media_stats
+
+
+class Command(BaseCommand):
+    help = '回填提示词组的媒体统计字段（文件数 / 视频数 / 是否含视频 / 实际封面），首页视频、多图筛选直接读它们'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing-only', action='store_true', help='只补有文件但还没算过的组，不全表重算')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        self.stdout.write("🚀 开始回填组媒体统计...")
+
+        def report(processed):
+            self.stdout.write(f"   已处理 {processed} 个组", ending='\r')
+            self.stdout.flush()
+
+        processed = fill_group_media_stats(
+            missing_only=options['missing_only'],
+            batch_size=max(1, options['batch_size']),
+            progress=report,
+        )
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f"✅ 完成：{processed} 个组，耗时 {time.time() - start_time:.1f}s"))
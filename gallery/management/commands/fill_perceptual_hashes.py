@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gallery.models import ImageItem, ReferenceItem
+from gallery.perceptual_hash import add_perceptual_hashes, compute_dhash
+
+
+class Command(BaseCommand):
+    help = '为存量生成图 / 参考图补算感知哈希 (dHash)，用于上传查重时识别缩放、重新压缩过的同一张图'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每批写回的行数')
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        start_time = time.time()
+        for model in (ImageItem, ReferenceItem):
+            self.fill_model(model, batch_size)
+        self.stdout.write(self.style.SUCCESS(f"✅ 感知哈希补算完成，耗时 {time.time() - start_time:.1f}s"))
+
+    def fill_model(self, model, batch_size):
+        qs = model.objects.filter(perceptual_hash='').exclude(image='').order_by('id')
+        total = qs.count()
+        self.stdout.write(f"👉 {model._meta.verbose_name}: {total} 条缺少感知哈希")
+
+        filled = skipped = 0
+        hash_by_file = {}
+        pending = []
+        # 按 id 分块读完一批再写回：游标还开着时改写 perceptual_hash 会改变正在遍历的结果集
+        last_id = 0
+        while True:
+            chunk = list(qs.filter(id__gt=last_id).only('id', 'image')[:batch_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            for obj in chunk:
+                if obj.is_video:
+                    skipped += 1
+                    continue
+                # 参考图软引用共用文件，同一路径只算一次
+                if obj.image.name not in hash_by_file:
+                    try:
+                        hash_by_file[obj.image.name] = compute_dhash(obj.image.path)
+                    except Exception as e:
+                        self.stdout.write(self.style.WARNING(f"⚠️ 跳过 ID {obj.id}: {e}"))
+                        hash_by_file[obj.image.name] = ''
+                obj.perceptual_hash = hash_by_file[obj.image.name]
+                if not obj.perceptual_hash:
+                    skipped += 1
+                    continue
+                pending.append(obj)
+            filled += self.flush(model, pending)
+
+        self.stdout.write(f"   已补算 {filled} 条，跳过 {skipped} 条 (视频或无法解码)")
+
+    def flush(self, model, pending):
+        count = len(pending)
+        if pending:
+            model.objects.bulk_update(pending, ['perceptual_hash'])
+            # bulk_update 不触发信号，补算的哈希显式插进 BK 树
+            add_perceptual_hashes(model, [(obj.id, obj.perceptual_hash) for obj in pending])
+        pending.clear()
+        return count
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gallery.ai_utils import get_near_duplicate_threshold
+from gallery.services import rebuild_near_duplicate_clusters
+
+
+class Command(BaseCommand):
+    help = '基于 FAISS range_search 分块自连接，找出视觉近似重复的图片并写入近似重复簇表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=float, default=None, help='余弦相似度阈值，默认取 GALLERY_NEAR_DUPLICATE_THRESHOLD')
+        parser.add_argument('--chunk-size', type=int, default=None, help='每次 range_search 的查询向量数')
+        parser.add_argument('--async', dest='run_async', action='store_true', help='交给 Huey 后台任务执行')
+
+    def handle(self, *args, **options):
+        threshold = options['threshold'] if options['threshold'] is not None else get_near_duplicate_threshold()
+
+        if options['run_async']:
+            from gallery.tasks import rebuild_near_duplicates_task
+            rebuild_near_duplicates_task(threshold=threshold, chunk_size=options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(f"✅ 已入队近似重复检测任务 (阈值 {threshold})"))
+            return
+
+        start_time = time.time()
+        self.stdout.write(f"🚀 开始近似重复检测 (阈值 {threshold})...")
+
+        def report(chunk_count, pair_count):
+            self.stdout.write(f"   已扫描 {chunk_count} 块，发现 {pair_count} 对近似重复", ending='\r')
+            self.stdout.flush()
+
+        cluster_count = rebuild_near_duplicate_clusters(threshold=threshold, chunk_size=options['chunk_size'], progress=report)
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f"✅ 检测完成：共 {cluster_count} 个近似重复簇，耗时 {time.time() - start_time:.1f}s"))
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gallery.models import PromptGroupHead
+
+
+class Command(BaseCommand):
+    help = '整表重建家族代表表（代表版本 / 最新版本 / 版本数），用于原始 SQL 改过 group_id 之后校正'
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        family_count = PromptGroupHead.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"✅ 完成：{family_count} 个家族，耗时 {time.time() - start_time:.1f}s"))
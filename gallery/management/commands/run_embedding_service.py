@@ -0,0 +1,149 @@
+import base64
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from gallery import ai_utils
+
+
+def _encode_vectors(vectors):
+    return [base64.b64encode(vector).decode('ascii') if vector else None for vector in vectors]
+
+
+def _is_allowed_path(path):
+    """只允许读取 MEDIA_ROOT 下的文件，防止本机其他进程借服务读任意文件"""
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    real_path = os.path.realpath(path)
+    return os.path.commonpath([media_root, real_path]) == media_root and os.path.isfile(real_path)
+
+
+class EmbeddingServiceHandler(BaseHTTPRequestHandler):
+    server_version = 'GalleryEmbeddingService/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_request_image(self):
+        """请求体为 JSON {"path": ...} 时读本地文件，否则把原始字节当作上传文件"""
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body or b'{}')
+        filename = os.path.basename(self.headers.get('X-Filename') or 'upload')
+        return {'file': ContentFile(body, name=filename)}
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            return self.send_json({'error': 'not found'}, status=404)
+        index = ai_utils._faiss_index
+        self.send_json({'status': 'ok', 'ntotal': index.ntotal if index is not None else 0})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        close_old_connections()
+        try:
+            request = self.read_request_image()
+            if url.path == '/embed':
+                self.handle_embed(request)
+            elif url.path == '/search':
+                top_k = int(parse_qs(url.query).get('top_k', ['50'])[0])
+                self.handle_search(request, top_k)
+            elif url.path == '/sync':
+                ai_utils.sync_faiss_ids([int(db_id) for db_id in request.get('ids', [])])
+                self.send_json({'status': 'ok'})
+            else:
+                self.send_json({'error': 'not found'}, status=404)
+        except PermissionError as e:
+            self.send_json({'error': str(e)}, status=403)
+        except Exception as e:
+            self.send_json({'error': str(e)}, status=500)
+        finally:
+            close_old_connections()
+
+    def resolve_image(self, request):
+        if 'file' in request:
+            return request['file']
+        if not _is_allowed_path(request.get('path', '')):
+            raise PermissionError('path is outside MEDIA_ROOT')
+        return request['path']
+
+    def handle_embed(self, request):
+        if 'text' in request:
+            return self.send_json({'vectors': _encode_vectors([ai_utils.generate_text_embedding(request['text'])])})
+        if 'paths' in request:
+            paths = request['paths']
+            allowed = [path for path in paths if _is_allowed_path(path)]
+            vectors = dict(zip(allowed, ai_utils.generate_image_embeddings_batch(allowed)))
+            return self.send_json({'vectors': _encode_vectors([vectors.get(path) for path in paths])})
+        vector = ai_utils.generate_image_embedding(self.resolve_image(request))
+        self.send_json({'vectors': _encode_vectors([vector])})
+
+    def handle_search(self, request, top_k):
+        """按图片检索；也可直接传 {"vector": base64, "ids": [...], "min_score": ...}，ids 为过滤后的候选集"""
+        if 'vector' in request:
+            query_bytes = base64.b64decode(request['vector'])
+            top_k = int(request.get('top_k', top_k))
+        else:
+            query_bytes = ai_utils.generate_image_embedding(self.resolve_image(request))
+        if query_bytes is None:
+            return self.send_json({'hits': []})
+        hits = ai_utils.search_faiss_vector(
+            ai_utils.decode_feature_vector(query_bytes), top_k,
+            allowed_ids=request.get('ids'), min_score=request.get('min_score'),
+        )
+        self.send_json({'hits': hits})
+
+
+def run_database_sync_loop(interval):
+    """定期与数据库对账并写快照，兜底那些没能送达服务的索引变更"""
+    while True:
+        time.sleep(interval)
+        close_old_connections()
+        try:
+            ai_utils.sync_faiss_with_database()
+        except Exception as e:
+            print(f">>> [向量服务] 索引对账失败: {e}")
+        finally:
+            close_old_connections()
+
+
+class Command(BaseCommand):
+    help = '启动独立的向量编码 / 以图搜图服务 (本机 HTTP)，Web 进程配置 GALLERY_EMBEDDING_SERVICE_URL 后即不再加载 CLIP 与 FAISS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--sync-interval', type=int, default=60, help='与数据库对账的间隔（秒）')
+
+    def handle(self, *args, **options):
+        ai_utils.mark_embedding_service_local()
+        ai_utils.load_model_on_startup()
+
+        threading.Thread(target=run_database_sync_loop, args=(options['sync_interval'],), daemon=True).start()
+
+        server = ThreadingHTTPServer((options['host'], options['port']), EmbeddingServiceHandler)
+        self.stdout.write(self.style.SUCCESS(f"🚀 向量服务已启动: http://{options['host']}:{options['port']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            ai_utils.save_faiss_snapshot()
+            self.stdout.write("向量服务已停止，索引快照已保存。")
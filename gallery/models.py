@@ -2,7 +2,8 @@ import uuid
 import os
 import hashlib
 import difflib
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, IntegerField, Max, When
 from django.utils import timezone
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFit
@@ -10,6 +11,10 @@ from rapidfuzz import process, fuzz
 import meilisearch
 from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
+from .perceptual_hash import add_perceptual_hashes, compute_dhash, remove_perceptual_hashes
+from .facets import invalidate_facet_counts
+from .prompt_index import remove_prompt_group, sync_prompt_group
+from .prompt_lsh import get_lsh_buckets
 
 
 PROVIDER_CHOICES = [
@@ -31,7 +36,17 @@ GPT_IMAGE_CONVERSATION_SOURCE_CHOICES = [
     ('detail', '作品详情页'),
 ]
 
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.webm', '.mkv')
+
+# PromptGroup 上由 refresh_media_stats 维护的冗余字段
+MEDIA_STAT_FIELDS = ('has_video', 'image_count', 'video_count', 'resolved_cover')
+# 都由后台流程用 queryset.update 维护，整行保存前先从库里取回当前值
+BACKGROUND_MAINTAINED_FIELDS = MEDIA_STAT_FIELDS + ('similar_candidates_at',)
+
 # === 工具函数 ===
+def is_video_file_name(name):
+    return os.path.splitext(name or '')[1].lower() in VIDEO_EXTENSIONS
+
 def unique_file_path(instance, filename):
     """生成唯一的图片/视频存储路径"""
     ext = filename.split('.')[-1]
@@ -122,6 +137,8 @@ class PromptGroup(models.Model):
     tags = models.ManyToManyField(Tag, blank=True, verbose_name="关联标签")
     
     created_at = models.DateTimeField("创建时间", auto_now_add=True, db_index=True)
+    # 任何经 save() 的修改都会刷新，提示词全文索引据此发现其他进程改过的组
+    updated_at = models.DateTimeField("更新时间", auto_now=True, db_index=True)
     is_liked = models.BooleanField("是否喜欢", default=False)
     # 【新增】生成渠道字段
     provider = models.CharField(
@@ -142,6 +159,20 @@ class PromptGroup(models.Model):
     )
     is_main_variant = models.BooleanField("是否为主版本", default=False)
     group_id = models.UUIDField("组ID", default=uuid.uuid4, editable=True, db_index=True)
+    # 媒体统计冗余字段：由 ImageItem 保存 / 删除信号与 set_group_cover 维护，首页筛选与卡片直接读
+    has_video = models.BooleanField("包含视频", default=False, db_index=True)
+    image_count = models.PositiveIntegerField("文件数 (含视频)", default=0, db_index=True)
+    video_count = models.PositiveIntegerField("视频数", default=0)
+    resolved_cover = models.ForeignKey(
+        'ImageItem',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name="实际封面"
+    )
+    # 相似组候选上次为本组重算的时间；为空表示还没算过或提示词改过待重算（算完可能一条候选都没有）
+    similar_candidates_at = models.DateTimeField("相似候选计算时间", null=True, blank=True)
 
     def __str__(self): return self.title
     class Meta:
@@ -215,25 +246,91 @@ class PromptGroup(models.Model):
         self.prompt_text_zh = prompt_texts[1] if len(prompt_texts) >= 2 else ''
         self.negative_prompt = prompt_texts[2] if len(prompt_texts) >= 3 else ''
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读出时的检索文本，保存时据此判断是否需要重算 LSH 桶
+        if 'searchable_prompts' in field_names:
+            instance._loaded_searchable_prompts = instance.searchable_prompts
+        # 记录读出时的家族与主版本标记，保存时据此判断是否需要刷新家族代表表
+        if 'group_id' in field_names:
+            instance._loaded_group_id = instance.group_id
+        if 'is_main_variant' in field_names:
+            instance._loaded_is_main_variant = instance.is_main_variant
+        if 'cover_image_id' in field_names:
+            instance._loaded_cover_image_id = instance.cover_image_id
+        return instance
+
     def save(self, *args, **kwargs):
         self.sync_prompt_storage()
         is_new = self._state.adding
         if is_new:
             self.find_and_join_group()
+        elif kwargs.get('update_fields') is None and not kwargs.get('force_insert') and self.pk is not None:
+            self.reload_background_fields()
+        if kwargs.get('update_fields'):
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'updated_at'}
         super().save(*args, **kwargs)
 
+    def reload_background_fields(self):
+        """
+        媒体统计 / 相似候选标记只由后台流程用 queryset.update 写入。整行保存前取回库里的当前值，
+        避免早先读出的实例把它们覆盖回旧值；行已被删掉时什么都不取，保存照常重新插入。
+        """
+        attnames = [self._meta.get_field(name).attname for name in BACKGROUND_MAINTAINED_FIELDS]
+        current = type(self).objects.filter(pk=self.pk).values(*attnames).first()
+        for attname, value in (current or {}).items():
+            setattr(self, attname, value)
+
+    @classmethod
+    def refresh_media_stats(cls, group_ids):
+        """
+        按组重算 has_video / image_count / video_count / resolved_cover，用 queryset.update 写回。
+        封面优先取手动指定的 cover_image，其次第一张非视频，最后才是第一个视频。
+        """
+        group_ids = {group_id for group_id in group_ids if group_id}
+        if not group_ids:
+            return
+        stats = {group_id: [0, 0, None, None] for group_id in group_ids}
+        rows = ImageItem.objects.filter(group_id__in=group_ids).order_by('id').values_list('group_id', 'id', 'image')
+        for group_id, image_id, name in rows.iterator(chunk_size=2000):
+            entry = stats[group_id]
+            entry[0] += 1
+            if is_video_file_name(name):
+                entry[1] += 1
+                if entry[3] is None:
+                    entry[3] = image_id
+            elif entry[2] is None:
+                entry[2] = image_id
+
+        covers = dict(cls.objects.filter(id__in=group_ids).values_list('id', 'cover_image_id'))
+        for group_id, cover_image_id in covers.items():
+            image_count, video_count, first_still_id, first_video_id = stats[group_id]
+            cls.objects.filter(pk=group_id).update(
+                has_video=video_count > 0,
+                image_count=image_count,
+                video_count=video_count,
+                resolved_cover_id=cover_image_id or first_still_id or first_video_id,
+            )
+
     def find_and_join_group(self):
-        """查找最近的相似提示词组 (C++底层极速批处理版)"""
+        """查找相似提示词组：先用 MinHash-LSH 桶召回全库候选，再只对候选做模糊打分"""
         my_content = self.get_primary_prompt_text().strip().lower()
         
         if len(my_content) < 5:
             return
 
-        # 1. 内存优化：只取必须的字段，不要拉取整个模型实例
-        # 注意要转换成 list 触发 SQL 查询
-        candidates = list(PromptGroup.objects.order_by('-id').values_list(
+        # 1. LSH 召回：命中任一 band 桶的组才进入候选，覆盖全库且与库大小基本无关
+        # 同一模板被大量复用时按最新优先截断，保证单次插入的开销有上限
+        candidate_ids = list(
+            PromptGroupLSHBucket.objects.filter(bucket__in=get_lsh_buckets(my_content))
+            .values_list('prompt_group_id', flat=True)
+            .distinct()
+            .order_by('-prompt_group_id')[:2000]
+        )
+        candidates = list(PromptGroup.objects.filter(id__in=candidate_ids).order_by('-id').values_list(
             'group_id', 'title', 'searchable_prompts'
-        )[:2000])
+        ))
         
         # 2. 预过滤并构建待匹配字典 {文本: (group_id, title)}
         valid_candidates = {}
@@ -274,6 +371,120 @@ class PromptGroup(models.Model):
         else:
             print(f"DEBUG: 未找到相似度 > 0.8 的组，创建新组。")
 
+class PromptGroupLSHBucket(models.Model):
+    """提示词 MinHash-LSH 倒排表：每个组按检索文本写入 LSH_BANDS 个桶，供 find_and_join_group 召回候选"""
+    prompt_group = models.ForeignKey(PromptGroup, on_delete=models.CASCADE, related_name='lsh_buckets', verbose_name='提示词组')
+    bucket = models.BigIntegerField('LSH 桶', db_index=True)
+
+    class Meta:
+        verbose_name = '提示词 LSH 桶'
+        verbose_name_plural = '提示词 LSH 桶'
+
+    @classmethod
+    def index_groups(cls, rows, replace=True):
+        """rows 为 (组 id, 检索文本)；replace=True 时先清掉这些组的旧桶"""
+        rows = list(rows)
+        if replace:
+            cls.objects.filter(prompt_group_id__in=[group_id for group_id, _ in rows]).delete()
+        cls.objects.bulk_create([
+            cls(prompt_group_id=group_id, bucket=bucket)
+            for group_id, text in rows
+            for bucket in get_lsh_buckets(text)
+        ], batch_size=1000)
+
+class PromptGroupHead(models.Model):
+    """
+    每个家族 (group_id) 一行：代表版本（主版本，没有则取最新）、最新版本、版本数。
+    首页 / 详情导航 / 组列表按它折叠版本，不再每次对全表 GROUP BY。
+    """
+    group_id = models.UUIDField('组ID', unique=True)
+    representative = models.OneToOneField(PromptGroup, on_delete=models.CASCADE, related_name='group_head', verbose_name='代表版本')
+    latest = models.ForeignKey(PromptGroup, on_delete=models.CASCADE, related_name='+', verbose_name='最新版本')
+    variant_count = models.PositiveIntegerField('版本数', default=1)
+
+    # 本进程是否已按家族数核对过整表
+    _verified = False
+
+    class Meta:
+        verbose_name = '家族代表'
+        verbose_name_plural = '家族代表'
+
+    @staticmethod
+    def _family_stats(queryset):
+        return queryset.values('group_id').annotate(
+            main_id=Max(Case(When(is_main_variant=True, then='id'), output_field=IntegerField())),
+            latest_id=Max('id'),
+            count=Count('id'),
+        )
+
+    @classmethod
+    def _build_rows(cls, stats):
+        return [
+            cls(
+                group_id=item['group_id'],
+                representative_id=item['main_id'] or item['latest_id'],
+                latest_id=item['latest_id'],
+                variant_count=item['count'],
+            )
+            for item in stats
+        ]
+
+    @classmethod
+    def refresh(cls, group_ids):
+        """重算这些家族的代表行；queryset.update 改了 group_id / is_main_variant 后需要显式调用"""
+        group_ids = {group_id for group_id in group_ids if group_id}
+        if not group_ids:
+            return
+        # 表还没建全时只增量写这几个家族，会让空表变成"非空但不完整"
+        cls.ensure_built()
+        with transaction.atomic():
+            rows = cls._build_rows(cls._family_stats(PromptGroup.objects.filter(group_id__in=group_ids)))
+            representative_ids = [row.representative_id for row in rows]
+            # 代表版本是 OneToOne：被 queryset.update 挪过家族的组可能还占着旧家族的代表行
+            displaced_ids = set(cls.objects.filter(representative_id__in=representative_ids).exclude(
+                group_id__in=group_ids
+            ).values_list('group_id', flat=True))
+            cls.objects.filter(models.Q(group_id__in=group_ids) | models.Q(representative_id__in=representative_ids)).delete()
+            cls.objects.bulk_create(rows)
+        if displaced_ids:
+            cls.refresh(displaced_ids)
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """整表重建，返回家族数"""
+        rows = cls._build_rows(cls._family_stats(PromptGroup.objects.all()))
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rows, batch_size=batch_size)
+        return len(rows)
+
+    @classmethod
+    def ensure_built(cls):
+        """
+        老数据首次访问时整表建一次。表非空不代表已建全（可能只有信号写进来的零星几行），
+        所以每个进程第一次调用时按家族数核对一遍，对不上就整表重建；之后由信号与显式 refresh 维护。
+        """
+        if cls._verified:
+            if not cls.objects.exists() and PromptGroup.objects.exists():
+                cls.rebuild()
+            return
+        family_count = PromptGroup.objects.order_by().values('group_id').distinct().count()
+        if cls.objects.count() != family_count:
+            cls.rebuild()
+        cls._verified = True
+
+class SimilarGroupCandidate(models.Model):
+    """“关联版本”推荐的物化结果：每个组预存 fuzz.ratio 最高的 20 个其他家族最新版本"""
+    source = models.ForeignKey(PromptGroup, on_delete=models.CASCADE, related_name='similar_candidates', verbose_name='提示词组')
+    candidate = models.ForeignKey(PromptGroup, on_delete=models.CASCADE, related_name='+', verbose_name='候选组')
+    similarity = models.FloatField('相似度')
+
+    class Meta:
+        verbose_name = '相似组候选'
+        verbose_name_plural = '相似组候选'
+        unique_together = ('source', 'candidate')
+        indexes = [models.Index(fields=['source', '-similarity'])]
+
 # === 4. 生成图 (作品单图/视频) ===
 class ImageItem(models.Model):
     group = models.ForeignKey(PromptGroup, on_delete=models.CASCADE, related_name='images', verbose_name="所属提示词组")
@@ -282,6 +493,7 @@ class ImageItem(models.Model):
     is_liked = models.BooleanField("是否喜欢", default=False)
     feature_vector = models.BinaryField("特征向量", null=True, blank=True)
     image_hash = models.CharField("MD5哈希", max_length=32, blank=True, db_index=True)
+    perceptual_hash = models.CharField("感知哈希 (dHash)", max_length=16, blank=True, default='')
 
     thumbnail = ImageSpecField(source='image',
                                processors=[ResizeToFit(width=600, upscale=False)],
@@ -293,9 +505,21 @@ class ImageItem(models.Model):
         """判断是否为视频文件"""
         if not self.image or not self.image.name:
             return False
-        # 确保已导入 os
-        ext = os.path.splitext(self.image.name)[1].lower()
-        return ext in ['.mp4', '.mov', '.avi', '.webm', '.mkv']
+        return is_video_file_name(self.image.name)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读出时的向量，保存时据此判断是否需要更新 FAISS 索引
+        if 'feature_vector' in field_names:
+            instance._loaded_feature_vector = _vector_bytes(instance.feature_vector)
+        # 记录读出时的文件与所属组，保存时据此判断是否需要刷新组的媒体统计
+        if 'group_id' in field_names and 'image' in field_names:
+            instance._loaded_media_key = (instance.group_id, instance.image.name)
+        # 记录读出时的感知哈希，保存时据此判断能否增量插入 BK 树
+        if 'perceptual_hash' in field_names:
+            instance._loaded_perceptual_hash = instance.perceptual_hash
+        return instance
 
     def calculate_hash(self):
         md5 = hashlib.md5()
@@ -307,16 +531,24 @@ class ImageItem(models.Model):
             self.image_hash = md5.hexdigest()
             if hasattr(self.image, 'seek'):
                 self.image.seek(0)
+
+    def calculate_perceptual_hash(self):
+        if self.image and not self.is_video:
+            self.perceptual_hash = compute_dhash(self.image)
     
     def __str__(self): return f"生成文件 ID: {self.id}"
     class Meta: verbose_name = "生成图"; verbose_name_plural = "生成图集"
 
+def _vector_bytes(value):
+    return bytes(value) if value is not None else None
+
 # === 5. 参考图 (ReferenceItem) ===
 class ReferenceItem(models.Model):
     group = models.ForeignKey(PromptGroup, on_delete=models.CASCADE, related_name='references', verbose_name="所属提示词组")
     image = models.FileField("参考文件", upload_to=reference_file_path)
     # 【新增】增加哈希字段，用于去重
     image_hash = models.CharField("MD5哈希", max_length=32, blank=True, db_index=True)
+    perceptual_hash = models.CharField("感知哈希 (dHash)", max_length=16, blank=True, default='')
     
     thumbnail = ImageSpecField(source='image',
                                processors=[ResizeToFit(width=300, upscale=False)],
@@ -327,9 +559,15 @@ class ReferenceItem(models.Model):
     def is_video(self):
         if not self.image or not self.image.name:
             return False
-        ext = os.path.splitext(self.image.name)[1].lower()
-        return ext in ['.mp4', '.mov', '.avi', '.webm', '.mkv']
+        return is_video_file_name(self.image.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读出时的感知哈希，保存时据此判断能否增量插入 BK 树
+        if 'perceptual_hash' in field_names:
+            instance._loaded_perceptual_hash = instance.perceptual_hash
+        return instance
 
     # 【新增】哈希计算逻辑
     def calculate_hash(self):
@@ -356,6 +594,27 @@ class ReferenceItem(models.Model):
         # 将指针归零，并【显式关闭文件】释放 Windows 文件锁
         if hasattr(self.image, 'seek'):
             self.image.seek(0)
+
+    def calculate_perceptual_hash(self):
+        if not self.image or self.is_video:
+            return
+        # 软引用的参考图共用同一个文件，优先复用已算好的感知哈希
+        if self.image_hash:
+            known_hash = (
+                ReferenceItem.objects.filter(image_hash=self.image_hash)
+                .exclude(perceptual_hash='')
+                .values_list('perceptual_hash', flat=True)
+                .first()
+            )
+            if known_hash:
+                self.perceptual_hash = known_hash
+                return
+        self.perceptual_hash = compute_dhash(self.image)
+
+    def save(self, *args, **kwargs):
+        if kwargs.get('update_fields') is None and not self.perceptual_hash:
+            self.calculate_perceptual_hash()
+        super().save(*args, **kwargs)
         
     def __str__(self): return f"参考图 ID: {self.id}"
     class Meta: verbose_name = "参考图"; verbose_name_plural = "参考图集"
@@ -454,6 +713,35 @@ class GPTImageConversationTurn(models.Model):
     def __str__(self):
         return f"{self.conversation_id} - 第 {self.turn_index} 轮"
 
+class NearDuplicateCluster(models.Model):
+    """视觉近似重复簇 (重新编码、缩放、小改动的同一张图)，由 find_near_duplicates 全量重算"""
+    size = models.PositiveIntegerField('图片数', default=0, db_index=True)
+    max_similarity = models.FloatField('簇内最高相似度', default=0)
+    threshold = models.FloatField('判定阈值', default=0)
+    created_at = models.DateTimeField('生成时间', auto_now_add=True)
+
+    class Meta:
+        verbose_name = '近似重复簇'
+        verbose_name_plural = '近似重复簇'
+        ordering = ['-size', '-max_similarity', 'id']
+
+    def __str__(self):
+        return f"近似重复簇 #{self.pk} ({self.size} 张)"
+
+
+class NearDuplicateMember(models.Model):
+    cluster = models.ForeignKey(NearDuplicateCluster, on_delete=models.CASCADE, related_name='members', verbose_name='所属簇')
+    image = models.OneToOneField(ImageItem, on_delete=models.CASCADE, related_name='near_duplicate_member', verbose_name='图片')
+    similarity = models.FloatField('与最近邻的相似度', default=0)
+
+    class Meta:
+        verbose_name = '近似重复成员'
+        verbose_name_plural = '近似重复成员'
+        ordering = ['-similarity', 'image_id']
+
+    def __str__(self):
+        return f"{self.cluster_id} - {self.image_id}"
+
 # ==========================================
 # Meilisearch 搜索引擎自动同步机制
 # ==========================================
@@ -508,3 +796,155 @@ def on_promptgroup_delete(sender, instance, **kwargs):
         MEILI_CLIENT.index('prompts').delete_document(instance.id)
     except:
         pass
+
+
+# ==========================================
+# FAISS 向量索引同步：删除 / 重新编码时保持索引与数据库一致
+# ==========================================
+@receiver(post_save, sender=ImageItem)
+def on_imageitem_save_sync_faiss(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'feature_vector' not in update_fields:
+        return
+    from . import ai_utils  # 局部引入，避免加载模型时的循环依赖
+
+    new_vector = _vector_bytes(instance.feature_vector)
+    # 不是从数据库读出的实例无从比较，按 upsert 处理
+    loaded = created or hasattr(instance, '_loaded_feature_vector')
+    old_vector = None if created else getattr(instance, '_loaded_feature_vector', None)
+    if loaded and new_vector == old_vector:
+        return
+
+    if new_vector is None:
+        ai_utils.remove_from_faiss_index([instance.pk])
+    else:
+        ai_utils.add_to_faiss_index(instance.pk, new_vector, replace=not loaded or old_vector is not None)
+    instance._loaded_feature_vector = new_vector
+
+
+@receiver(post_delete, sender=ImageItem)
+def on_imageitem_delete_sync_faiss(sender, instance, **kwargs):
+    from . import ai_utils
+    ai_utils.remove_from_faiss_index([instance.pk])
+
+
+# ==========================================
+# 组媒体统计同步：文件新增、删除、换组或换文件时重算涉及的组
+# ==========================================
+@receiver(post_save, sender=ImageItem)
+def on_imageitem_save_sync_media_stats(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not {'image', 'group'} & set(update_fields):
+        return
+    media_key = (instance.group_id, instance.image.name)
+    old_key = getattr(instance, '_loaded_media_key', None)
+    if not created and old_key == media_key:
+        return
+    PromptGroup.refresh_media_stats({old_key[0] if old_key else None, instance.group_id})
+    instance._loaded_media_key = media_key
+
+
+@receiver(post_delete, sender=ImageItem)
+def on_imageitem_delete_sync_media_stats(sender, instance, **kwargs):
+    PromptGroup.refresh_media_stats({instance.group_id})
+
+
+# ==========================================
+# 感知哈希 BK 树同步：新算出的哈希增量插入，删除或改写只打墓碑
+# ==========================================
+@receiver(post_save, sender=ImageItem)
+@receiver(post_save, sender=ReferenceItem)
+def on_item_save_sync_perceptual_hash(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'perceptual_hash' not in update_fields:
+        return
+    old_hash = '' if created else getattr(instance, '_loaded_perceptual_hash', None)
+    if old_hash == instance.perceptual_hash:
+        return
+    add_perceptual_hashes(sender, [(instance.pk, instance.perceptual_hash)])
+    instance._loaded_perceptual_hash = instance.perceptual_hash
+
+
+@receiver(post_delete, sender=ImageItem)
+@receiver(post_delete, sender=ReferenceItem)
+def on_item_delete_sync_perceptual_hash(sender, instance, **kwargs):
+    remove_perceptual_hashes(sender, [instance.pk])
+
+
+@receiver(post_save, sender=PromptGroup)
+def on_promptgroup_save_sync_cover(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'cover_image' not in update_fields:
+        return
+    # 新建组还没有文件，默认值即正确，只有指定了封面才需要重算
+    if getattr(instance, '_loaded_cover_image_id', None) == instance.cover_image_id:
+        return
+    PromptGroup.refresh_media_stats({instance.pk})
+    instance._loaded_cover_image_id = instance.cover_image_id
+
+
+# ==========================================
+# 提示词 LSH 桶 / trigram 内存索引同步：新建组或检索文本变化时重算
+# ==========================================
+@receiver(post_save, sender=PromptGroup)
+def on_promptgroup_save_sync_lsh(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'searchable_prompts' not in update_fields:
+        return
+    if not created and getattr(instance, '_loaded_searchable_prompts', None) == instance.searchable_prompts:
+        return
+    PromptGroupLSHBucket.index_groups([(instance.pk, instance.searchable_prompts)], replace=not created)
+    instance._loaded_searchable_prompts = instance.searchable_prompts
+    sync_prompt_group(instance, created=created)
+
+    # 旧推荐立即作废（接口会先同步算一次），全库双向刷新交给后台任务
+    SimilarGroupCandidate.objects.filter(source_id=instance.pk).delete()
+    if not created:
+        PromptGroup.objects.filter(pk=instance.pk).update(similar_candidates_at=None)
+        instance.similar_candidates_at = None
+    group_pk = instance.pk
+    def enqueue_refresh():
+        from .tasks import refresh_similar_candidates_task
+        refresh_similar_candidates_task([group_pk])
+    transaction.on_commit(enqueue_refresh)
+
+
+@receiver(post_delete, sender=PromptGroup)
+def on_promptgroup_delete_sync_prompt_index(sender, instance, **kwargs):
+    remove_prompt_group(instance.pk)
+
+
+# ==========================================
+# 家族代表表同步：新建、删除、换家族、设主版本时重算涉及的家族
+# ==========================================
+@receiver(post_save, sender=PromptGroup)
+def on_promptgroup_save_sync_head(sender, instance, created, **kwargs):
+    old_group_id = getattr(instance, '_loaded_group_id', None)
+    old_main = getattr(instance, '_loaded_is_main_variant', None)
+    if not created and old_group_id == instance.group_id and old_main == instance.is_main_variant:
+        return
+    PromptGroupHead.refresh({old_group_id, instance.group_id})
+    instance._loaded_group_id = instance.group_id
+    instance._loaded_is_main_variant = instance.is_main_variant
+
+
+@receiver(post_delete, sender=PromptGroup)
+def on_promptgroup_delete_sync_head(sender, instance, **kwargs):
+    PromptGroupHead.refresh({instance.group_id})
+
+
+# ==========================================
+# 筛选项计数缓存：作品 / 标签 / 人物 / 模型有变化时显式失效
+# ==========================================
+@receiver(post_save, sender=PromptGroup)
+@receiver(post_delete, sender=PromptGroup)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Character)
+@receiver(post_save, sender=AIModel)
+@receiver(post_delete, sender=AIModel)
+def on_facet_source_change(sender, **kwargs):
+    invalidate_facet_counts()
+
+
+@receiver(m2m_changed, sender=PromptGroup.tags.through)
+@receiver(m2m_changed, sender=PromptGroup.characters.through)
+def on_promptgroup_facets_m2m_change(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_facet_counts()
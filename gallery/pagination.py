@@ -0,0 +1,175 @@
+import base64
+import binascii
+import hashlib
+import json
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+def get_count_cache_ttl():
+    return int(getattr(settings, 'GALLERY_PAGINATION_COUNT_TTL', 60))
+
+
+class CachedCountPaginator(Paginator):
+    """
+    总数按 SQL 缓存一小段时间：多表 JOIN + DISTINCT 的 COUNT(*) 翻页时不必每次都跑。
+    缓存的总数只用于页码条；每页内容多取一行判断有没有下一页，总数过期也不会截断结果。
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return super().count
+        try:
+            sql, params = query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        cache_key = 'gallery:page_count:' + hashlib.md5(f'{sql}|{params}'.encode('utf-8')).hexdigest()
+        count = cache.get(cache_key)
+        if count is None:
+            count = super().count
+            cache.set(cache_key, count, get_count_cache_ttl())
+        return count
+
+    def page(self, number):
+        try:
+            number = max(1, int(number))
+        except (TypeError, ValueError):
+            number = 1
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            # 页码超出范围：与 get_page 一样退回最后一页
+            self.__dict__['count'] = super().count
+            return self.page(self.num_pages)
+        return KeysetPage(rows[:self.per_page], number, self, len(rows) > self.per_page, number > 1)
+
+    def get_page(self, number):
+        return self.page(number)
+
+
+def encode_cursor(values, number, direction='next'):
+    payload = json.dumps({'k': values, 'n': number, 'd': direction}, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """解析失败返回 None，调用方按第一页处理"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        values, number, direction = payload['k'], int(payload['n']), payload['d']
+    except (binascii.Error, ValueError, TypeError, KeyError, UnicodeError):
+        return None
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        return None
+    return values, max(1, number), direction
+
+
+def _field_names(ordering):
+    return [name.lstrip('-') for name in ordering]
+
+
+def _cursor_values(obj, ordering):
+    return [getattr(obj, name) for name in _field_names(ordering)]
+
+
+def _keyset_filter(model, ordering, values, forward):
+    """(a, b) 之后的行：a 越过游标，或 a 相等且 b 越过游标，依次类推"""
+    clauses = []
+    equal = {}
+    for name, raw_value in zip(ordering, values):
+        field_name = name.lstrip('-')
+        value = model._meta.get_field(field_name).to_python(raw_value)
+        lookup = 'lt' if name.startswith('-') == forward else 'gt'
+        clauses.append(Q(**equal, **{f'{field_name}__{lookup}': value}))
+        equal[field_name] = value
+    return reduce(or_, clauses)
+
+
+class KeysetPage(Page):
+    """游标翻页得到的一页：是否有上下页由多取的一行判断，不需要 COUNT"""
+
+    def __init__(self, object_list, number, paginator, has_next, has_previous):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return max(1, self.number - 1)
+
+
+def _attach_cursors(page, ordering):
+    object_list = list(page.object_list)
+    page.next_cursor = encode_cursor(_cursor_values(object_list[-1], ordering), page.number + 1) if page.has_next() and object_list else ''
+    page.previous_cursor = (
+        encode_cursor(_cursor_values(object_list[0], ordering), page.number - 1, 'prev')
+        if page.has_previous() and object_list else ''
+    )
+    return page
+
+
+def keyset_page(queryset, ordering, cursor, per_page, paginator=None):
+    """
+    按 ordering（如 ('-created_at', '-id')，最后一列必须唯一）从游标处取一页。
+    cursor 为空或无法解析时返回第一页。返回的页对象带 next_cursor / previous_cursor。
+    """
+    paginator = paginator or CachedCountPaginator(queryset, per_page)
+    decoded = decode_cursor(cursor) if cursor else None
+    queryset = queryset.order_by(*ordering)
+
+    if decoded is None:
+        rows = list(queryset[:per_page + 1])
+        page = KeysetPage(rows[:per_page], 1, paginator, len(rows) > per_page, False)
+        return _attach_cursors(page, ordering)
+
+    values, number, direction = decoded
+    forward = direction == 'next'
+    filtered = queryset.filter(_keyset_filter(queryset.model, ordering, values, forward))
+    if forward:
+        rows = list(filtered[:per_page + 1])
+        page = KeysetPage(rows[:per_page], number, paginator, len(rows) > per_page, True)
+    else:
+        reverse_ordering = [name[1:] if name.startswith('-') else f'-{name}' for name in ordering]
+        rows = list(filtered.order_by(*reverse_ordering)[:per_page + 1])
+        has_previous = len(rows) > per_page
+        page = KeysetPage(rows[:per_page][::-1], number if has_previous else 1, paginator, True, has_previous)
+    return _attach_cursors(page, ordering)
+
+
+def paginate(request, queryset, per_page, ordering=None, paginator_class=CachedCountPaginator):
+    """
+    HTML 列表页通用分页：带 cursor 参数时走游标（深翻页与第一页同样快），
+    否则按 page 参数走普通分页（跳页、页码链接）。ordering 为空表示结果不是按固定列排序，只能走普通分页。
+    """
+    paginator = paginator_class(queryset, per_page)
+    cursor = request.GET.get('cursor')
+    if ordering and cursor:
+        return keyset_page(queryset, ordering, cursor, per_page, paginator)
+    page = paginator.get_page(request.GET.get('page'))
+    if ordering:
+        return _attach_cursors(page, ordering)
+    return page
+
+
+def get_elided_page_range(page, on_each_side=5, on_ends=1):
+    """游标页的页码来自 token，数据变动后可能超出总页数，这里夹紧再生成页码条"""
+    number = min(page.number, page.paginator.num_pages)
+    return page.paginator.get_elided_page_range(number, on_each_side=on_each_side, on_ends=on_ends)
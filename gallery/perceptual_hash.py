@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from PIL import Image
+
+
+DHASH_SIZE = 8
+_VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.webm', '.mkv')
+
+
+def get_perceptual_hash_max_distance():
+    return int(getattr(settings, 'GALLERY_PHASH_MAX_DISTANCE', 6))
+
+
+def get_perceptual_hash_check_interval():
+    return float(getattr(settings, 'GALLERY_PHASH_INDEX_CHECK_INTERVAL', 5))
+
+
+def compute_dhash(source):
+    """
+    计算 64 位 dHash（相邻像素亮度差），返回 16 位十六进制字符串。
+    source 可以是路径或文件对象；视频或无法解码的文件返回 ''。
+    """
+    name = source if isinstance(source, str) else getattr(source, 'name', '') or ''
+    if os.path.splitext(str(name))[1].lower() in _VIDEO_EXTENSIONS:
+        return ''
+
+    try:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        with Image.open(source) as img:
+            # JPEG 可以在解码阶段直接按 DCT 缩小，大图也只解出一个小图
+            img.draft('L', (DHASH_SIZE * 8, DHASH_SIZE * 8))
+            pixels = np.asarray(img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.LANCZOS), dtype=np.int16)
+    except Exception as e:
+        print(f"感知哈希计算失败: {e}")
+        return ''
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+
+class BKTree:
+    """按汉明距离组织的 BK 树，半径查询只需访问少量分支"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            distance = (value ^ node[0]).bit_count()
+            if distance == 0:
+                # 增量插入可能与刚重建的树重复，同一记录只保留一份
+                if item not in node[1]:
+                    node[1].append(item)
+                    self.size += 1
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value, radius):
+        """返回 [(距离, item)]，按距离升序"""
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = (value ^ node_value).bit_count()
+            if distance <= radius:
+                results.extend((distance, item) for item in items)
+            for child_distance in range(max(1, distance - radius), distance + radius + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    stack.append(child)
+        results.sort()
+        return results
+
+
+class PerceptualHashIndex:
+    """
+    BK 树加一层 id -> 哈希映射。删除或改写只打墓碑 (旧哈希, id)，查询时跳过；
+    墓碑多于存活记录时才整体重建。
+    """
+
+    def __init__(self):
+        self.tree = BKTree()
+        self.hashes = {}
+        self.dead = set()
+        self.watermark = None
+        self.checked_at = 0.0
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, obj_id, value):
+        old_value = self.hashes.get(obj_id)
+        if old_value == value:
+            return
+        if old_value is not None:
+            self.dead.add((old_value, obj_id))
+        self.hashes[obj_id] = value
+        self.dead.discard((value, obj_id))
+        self.tree.add(value, (obj_id, value))
+
+    def remove(self, obj_id):
+        value = self.hashes.pop(obj_id, None)
+        if value is not None:
+            self.dead.add((value, obj_id))
+
+    def search(self, value, radius):
+        return [
+            (distance, obj_id) for distance, (obj_id, item_value) in self.tree.search(value, radius)
+            if self.hashes.get(obj_id) == item_value
+        ]
+
+
+_index_lock = threading.Lock()
+_indexes = {}
+
+
+def _get_index_watermark(model):
+    """库里有哈希的 (行数, 最大 id)：其他进程新增、补算、删除都会让它与本进程的索引对不上"""
+    stats = model.objects.exclude(perceptual_hash='').aggregate(count=Count('id'), max_id=Max('id'))
+    return stats['count'], stats['max_id']
+
+
+def _local_watermark(index):
+    return len(index.hashes), max(index.hashes, default=None)
+
+
+def _build_index(model):
+    index = PerceptualHashIndex()
+    rows = model.objects.exclude(perceptual_hash='').values_list('id', 'perceptual_hash')
+    for obj_id, hash_hex in rows.iterator(chunk_size=5000):
+        index.add(obj_id, int(hash_hex, 16))
+    return index
+
+
+def _reconcile_index(model, index, watermark):
+    """
+    其他进程改过库：先补读 id 更大的新行；行数或最大 id 仍对不上时只比对 id 列表，
+    多出来的打墓碑、缺少的补读哈希，不重建整棵树。
+    """
+    rows = model.objects.exclude(perceptual_hash='')
+    known_max = max(index.hashes, default=0)
+    for obj_id, hash_hex in rows.filter(id__gt=known_max).values_list('id', 'perceptual_hash').iterator(chunk_size=5000):
+        index.add(obj_id, int(hash_hex, 16))
+    if _local_watermark(index) == watermark:
+        return
+
+    db_ids = set(rows.values_list('id', flat=True).iterator(chunk_size=5000))
+    for obj_id in set(index.hashes) - db_ids:
+        index.remove(obj_id)
+    missing_ids = list(db_ids - set(index.hashes))
+    for start in range(0, len(missing_ids), 5000):
+        for obj_id, hash_hex in rows.filter(id__in=missing_ids[start:start + 5000]).values_list('id', 'perceptual_hash'):
+            index.add(obj_id, int(hash_hex, 16))
+
+
+def get_perceptual_hash_index(model):
+    """按模型缓存一份索引；最多每 GALLERY_PHASH_INDEX_CHECK_INTERVAL 秒与数据库核对一次 (行数, 最大 id)"""
+    label = model._meta.label
+    now = time.monotonic()
+    with _index_lock:
+        index = _indexes.get(label)
+        if index is not None and now - index.checked_at < get_perceptual_hash_check_interval():
+            return index
+
+    watermark = _get_index_watermark(model)
+    with _index_lock:
+        index = _indexes.get(label)
+        if index is None or len(index.dead) > len(index):
+            index = _indexes[label] = _build_index(model)
+        elif index.watermark != watermark:
+            _reconcile_index(model, index, watermark)
+        index.watermark = watermark
+        index.checked_at = now
+        return index
+
+
+def add_perceptual_hashes(model, rows):
+    """新增 / 补算出的哈希 [(id, 十六进制哈希)] 直接插进本进程已建好的索引；索引还没建时等第一次查询再全量构建"""
+    with _index_lock:
+        index = _indexes.get(model._meta.label)
+        if index is None:
+            return
+        for obj_id, hash_hex in rows:
+            if hash_hex:
+                index.add(obj_id, int(hash_hex, 16))
+            else:
+                index.remove(obj_id)
+
+
+def remove_perceptual_hashes(model, obj_ids):
+    """删除记录或清空哈希时调用：只打墓碑，不重建"""
+    with _index_lock:
+        index = _indexes.get(model._meta.label)
+        if index is None:
+            return
+        for obj_id in obj_ids:
+            index.remove(obj_id)
+
+
+def find_visual_duplicates(model, hash_hex, max_distance=None):
+    """查找感知哈希在汉明半径内的记录，返回 [(距离, id)]"""
+    if not hash_hex:
+        return []
+    if max_distance is None:
+        max_distance = get_perceptual_hash_max_distance()
+    index = get_perceptual_hash_index(model)
+    with _index_lock:
+        return index.search(int(hash_hex, 16), max_distance)
@@ -0,0 +1,214 @@
+import threading
+import time
+from array import array
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from rapidfuzz import fuzz, process
+
+
+NGRAM_SIZE = 3
+# 单次查询最多读取的倒排条目数：先读稀有 trigram，逗号空格这类高频 trigram 超出预算就跳过
+POSTINGS_BUDGET = 200000
+# 按 trigram 重叠数取前 N 条，再交给 fuzz.ratio 精排
+RESCORE_LIMIT = 300
+MATCH_LIMIT = 120
+
+
+def normalize_prompt_item_text(text):
+    return (text or '').strip().lower()
+
+
+def get_ngrams(text):
+    """两端补空格，1~2 个字的短查询也能产生 trigram"""
+    padded = f' {text} '
+    return {padded[start:start + NGRAM_SIZE] for start in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+def build_prompt_item_meta(prompt_items):
+    """与接口返回一致的字段名 / 标签，缺省时按位置补齐"""
+    meta = []
+    for index, item in enumerate(prompt_items, start=1):
+        meta.append({
+            'field': item.get('id', f'prompt_{index}'),
+            'label': item.get('label', f'提示词{index}'),
+            'text': item.get('text', ''),
+        })
+    return meta
+
+
+class PromptTextIndex:
+    """
+    提示词条目的字符 trigram 倒排索引。每个组的每条提示词是一个条目；
+    条目只追加，删除 / 修改时旧条目打上失效标记，失效过多时整体重建。
+    """
+
+    def __init__(self):
+        self.entry_groups = array('i')
+        self.entry_meta = []
+        self.entry_texts = []
+        self.alive = bytearray()
+        self.postings = {}
+        self.group_entries = {}
+        # 已收录的组（包括没有任何提示词条目的组），与数据库比对行数 / 最大 id 用
+        self.group_ids = set()
+        self.dead_count = 0
+
+    def __len__(self):
+        return len(self.entry_texts) - self.dead_count
+
+    def add_group(self, group_pk, prompt_items):
+        self.remove_group(group_pk)
+        self.group_ids.add(group_pk)
+        entry_ids = []
+        for meta in build_prompt_item_meta(prompt_items):
+            text = normalize_prompt_item_text(meta['text'])
+            if not text:
+                continue
+            entry_id = len(self.entry_texts)
+            self.entry_groups.append(group_pk)
+            self.entry_meta.append((meta['field'], meta['label'], meta['text'].strip()))
+            self.entry_texts.append(text)
+            self.alive.append(1)
+            for gram in get_ngrams(text):
+                postings = self.postings.get(gram)
+                if postings is None:
+                    postings = self.postings[gram] = array('i')
+                postings.append(entry_id)
+            entry_ids.append(entry_id)
+        if entry_ids:
+            self.group_entries[group_pk] = entry_ids
+
+    def remove_group(self, group_pk):
+        self.group_ids.discard(group_pk)
+        for entry_id in self.group_entries.pop(group_pk, ()):
+            self.alive[entry_id] = 0
+            self.entry_texts[entry_id] = ''
+            self.dead_count += 1
+
+    def search(self, text, limit=MATCH_LIMIT):
+        """返回 [(分数 0~100, 组 id, 字段, 标签, 原文)]，按分数降序"""
+        text = normalize_prompt_item_text(text)
+        if not text or not self.entry_texts:
+            return []
+
+        gram_postings = sorted(
+            (self.postings[gram] for gram in get_ngrams(text) if gram in self.postings),
+            key=len,
+        )
+        chunks = []
+        budget = POSTINGS_BUDGET
+        for postings in gram_postings:
+            if chunks and len(postings) > budget:
+                break
+            chunks.append(np.frombuffer(postings, dtype=np.int32))
+            budget -= len(postings)
+        if not chunks:
+            return []
+
+        counts = np.bincount(np.concatenate(chunks), minlength=len(self.entry_texts))
+        counts *= np.frombuffer(self.alive, dtype=np.uint8)
+        candidate_ids = np.flatnonzero(counts)
+        if len(candidate_ids) > RESCORE_LIMIT:
+            candidate_ids = candidate_ids[np.argpartition(-counts[candidate_ids], RESCORE_LIMIT)[:RESCORE_LIMIT]]
+
+        choices = {int(entry_id): self.entry_texts[entry_id] for entry_id in candidate_ids.tolist()}
+        matches = process.extract(text, choices, scorer=fuzz.ratio, limit=min(len(choices), limit))
+        return [
+            (score, self.entry_groups[entry_id], *self.entry_meta[entry_id])
+            for _, score, entry_id in matches
+        ]
+
+
+_index_lock = threading.Lock()
+_index = None
+# 上次核对时数据库的 (行数, 最大 id, 最大 updated_at)
+_index_watermark = None
+_index_checked_at = 0.0
+
+
+def get_index_check_interval():
+    return float(getattr(settings, 'GALLERY_PROMPT_INDEX_CHECK_INTERVAL', 5))
+
+
+def _get_index_watermark():
+    """其他进程新增 / 删除组会改变行数或最大 id，经 save() 的修改会推后最大 updated_at"""
+    from .models import PromptGroup
+    stats = PromptGroup.objects.aggregate(count=Count('id'), max_id=Max('id'), updated_at=Max('updated_at'))
+    return stats['count'], stats['max_id'], stats['updated_at']
+
+
+def _load_groups(queryset):
+    return queryset.only('id', 'prompts', 'prompt_text', 'prompt_text_zh', 'negative_prompt').order_by('id')
+
+
+def _build_index():
+    from .models import PromptGroup
+    index = PromptTextIndex()
+    for group in _load_groups(PromptGroup.objects.all()).iterator(chunk_size=2000):
+        index.add_group(group.pk, group.get_prompt_items())
+    return index
+
+
+def _reconcile_index(index, old_watermark, watermark):
+    """
+    只补读上次核对之后新增或修改过的组；行数或最大 id 仍对不上（有组被删）时再比对 id 列表，
+    不重建整个索引。
+    """
+    from .models import PromptGroup
+    changed = PromptGroup.objects.filter(id__gt=max(index.group_ids, default=0))
+    if old_watermark[2] is not None:
+        # 同一时刻可能有多次修改，用 >= 宁可多读几行
+        changed |= PromptGroup.objects.filter(updated_at__gte=old_watermark[2])
+    for group in _load_groups(changed).iterator(chunk_size=2000):
+        index.add_group(group.pk, group.get_prompt_items())
+    if (len(index.group_ids), max(index.group_ids, default=None)) == watermark[:2]:
+        return
+
+    db_ids = set(PromptGroup.objects.values_list('id', flat=True).iterator(chunk_size=5000))
+    for group_pk in index.group_ids - db_ids:
+        index.remove_group(group_pk)
+    missing_ids = list(db_ids - index.group_ids)
+    for start in range(0, len(missing_ids), 2000):
+        for group in _load_groups(PromptGroup.objects.filter(id__in=missing_ids[start:start + 2000])):
+            index.add_group(group.pk, group.get_prompt_items())
+
+
+def get_prompt_text_index():
+    """最多每 GALLERY_PROMPT_INDEX_CHECK_INTERVAL 秒与数据库核对一次水位，对不上时增量补齐"""
+    global _index, _index_watermark, _index_checked_at
+    now = time.monotonic()
+    with _index_lock:
+        if _index is not None and now - _index_checked_at < get_index_check_interval():
+            return _index
+
+    watermark = _get_index_watermark()
+    with _index_lock:
+        if _index is None or _index.dead_count > len(_index):
+            _index = _build_index()
+        elif _index_watermark != watermark:
+            _reconcile_index(_index, _index_watermark, watermark)
+        _index_watermark, _index_checked_at = watermark, now
+        return _index
+
+
+def search_prompt_items(text, limit=MATCH_LIMIT):
+    index = get_prompt_text_index()
+    with _index_lock:
+        return index.search(text, limit=limit)
+
+
+def sync_prompt_group(group, created=False):
+    """PromptGroup 保存后调用：索引还没建时什么都不做，等第一次查询再全量构建"""
+    with _index_lock:
+        if _index is None:
+            return
+        _index.add_group(group.pk, group.get_prompt_items())
+
+
+def remove_prompt_group(group_pk):
+    with _index_lock:
+        if _index is None:
+            return
+        _index.remove_group(group_pk)
@@ -0,0 +1,50 @@
+import zlib
+
+import numpy as np
+
+
+# 32 个 band × 每 band 3 行：Jaccard 0.4 的两段提示词约 88% 概率落入同一个桶
+LSH_BANDS = 32
+LSH_ROWS = 3
+SHINGLE_SIZE = 3
+MIN_PROMPT_LENGTH = 5
+
+_MERSENNE_PRIME = (1 << 31) - 1
+# 固定种子：桶值要写进数据库，跨进程、跨重启必须一致
+_hash_rng = np.random.RandomState(20240517)
+_HASH_A = _hash_rng.randint(1, _MERSENNE_PRIME, size=LSH_BANDS * LSH_ROWS).astype(np.uint64)
+_HASH_B = _hash_rng.randint(0, _MERSENNE_PRIME, size=LSH_BANDS * LSH_ROWS).astype(np.uint64)
+
+
+def normalize_prompt_text(text):
+    return ' '.join((text or '').lower().split())
+
+
+def get_shingles(text):
+    """字符级 shingle，中英文提示词都适用"""
+    text = normalize_prompt_text(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[start:start + SHINGLE_SIZE] for start in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def compute_minhash(text):
+    shingles = get_shingles(text)
+    if not shingles:
+        return None
+    # crc32 是稳定哈希；Python 内置 hash() 每个进程加盐，不能用
+    values = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    values %= _MERSENNE_PRIME
+    # (a * x + b) mod p，a、x 都小于 2^31，乘积不会溢出 uint64
+    return ((np.outer(_HASH_A, values) + _HASH_B[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+
+def get_lsh_buckets(text):
+    """返回 LSH_BANDS 个桶值 (band 序号放在高 32 位)，太短的文本返回 []"""
+    if len(normalize_prompt_text(text)) < MIN_PROMPT_LENGTH:
+        return []
+    signature = compute_minhash(text)
+    if signature is None:
+        return []
+    bands = signature.reshape(LSH_BANDS, LSH_ROWS)
+    return [(band << 32) | zlib.crc32(bands[band].tobytes()) for band in range(LSH_BANDS)]
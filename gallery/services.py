@@ -1,12 +1,34 @@
 import os
+import re
 import shutil
 import hashlib
-import threading
 import uuid
+import numpy as np
 from django.conf import settings
 from django.core.files.base import ContentFile
-from .models import ImageItem
-from .ai_utils import generate_image_embedding, add_to_faiss_index
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rapidfuzz import fuzz, process
+from .models import (
+    ImageItem,
+    NearDuplicateCluster,
+    NearDuplicateMember,
+    PromptGroup,
+    PromptGroupHead,
+    PromptGroupLSHBucket,
+    SimilarGroupCandidate,
+)
+from .ai_utils import (
+    add_batch_to_faiss_index,
+    generate_image_embeddings_batch,
+    get_embed_batch_size,
+    get_near_duplicate_threshold,
+    iter_near_duplicate_pairs,
+)
+from .facets import invalidate_facet_counts
+from .perceptual_hash import add_perceptual_hashes, compute_dhash
+from .prompt_lsh import MIN_PROMPT_LENGTH, get_lsh_buckets
 
 def is_valid_uuid(val):
     """校验是否为合法的 UUID 字符串"""
@@ -60,58 +82,79 @@ def calculate_file_hash(file_obj):
         
     return md5.hexdigest()
 
+def _calculate_image_hash(img_item):
+    try:
+        # 直接读取文件计算，不依赖 request.FILES
+        if not os.path.exists(img_item.image.path):
+            raise FileNotFoundError(img_item.image.path)
+        return calculate_file_hash(img_item.image.path)
+    except Exception as e:
+        print(f"Hash calc error {img_item.id}: {e}")
+        return ''
+
+def process_image_batch(image_ids, batch_size=None):
+    """
+    处理一批图片：补算缺失的哈希与向量（解码、编码、写库、入索引）。
+    已经处理过的图片会被跳过，重复执行是安全的；出错直接抛出，交给任务队列重试。
+    """
+    from .models import ImageItem
+
+    items = list(
+        ImageItem.objects.filter(id__in=image_ids).exclude(image='')
+        .filter(Q(image_hash='') | Q(feature_vector__isnull=True))
+    )
+    if not items:
+        return 0
+
+    hashed = []
+    for img_item in items:
+        if not img_item.image_hash:
+            img_item.image_hash = _calculate_image_hash(img_item)
+            if not img_item.perceptual_hash and not img_item.is_video:
+                img_item.perceptual_hash = compute_dhash(img_item.image.path)
+                hashed.append(img_item)
+
+    pending = [img_item for img_item in items if img_item.feature_vector is None]
+    embeddings = generate_image_embeddings_batch(
+        [img_item.image.path for img_item in pending],
+        batch_size=batch_size or get_embed_batch_size(),
+    )
+    embedded = []
+    for img_item, embedding_bytes in zip(pending, embeddings):
+        if embedding_bytes:
+            img_item.feature_vector = embedding_bytes
+            embedded.append(img_item)
+        else:
+            print(f"Embedding error {img_item.id}")
+
+    # bulk_update 不触发 post_save，向量与感知哈希需要显式整批写入索引
+    ImageItem.objects.bulk_update(items, ['image_hash', 'perceptual_hash', 'feature_vector'])
+    add_perceptual_hashes(ImageItem, [(img_item.id, img_item.perceptual_hash) for img_item in hashed])
+    add_batch_to_faiss_index(
+        [img_item.id for img_item in embedded],
+        [img_item.feature_vector for img_item in embedded],
+    )
+    return len(items)
+
 def process_images_background(image_ids):
-    """后台任务：计算哈希与向量"""
+    """同步处理：计算哈希与向量（按批解码、编码、写库、入索引）"""
     if not image_ids:
         return
-    
-    # 重新引入 ImageItem 防止循环引用
-    # (在函数内部引用是安全的)
-    from .models import ImageItem
 
     print(f"Start background processing for {len(image_ids)} images...")
-    for img_id in image_ids:
+    batch_size = get_embed_batch_size()
+    for start in range(0, len(image_ids), batch_size):
+        chunk_ids = image_ids[start:start + batch_size]
         try:
-            img_item = ImageItem.objects.get(id=img_id)
-            save_needed = False
-            
-            if not img_item.image_hash and img_item.image:
-                try:
-                    # 直接读取文件计算，不依赖 request.FILES
-                    with open(img_item.image.path, 'rb') as f:
-                        hasher = hashlib.md5()
-                        for chunk in iter(lambda: f.read(4096), b""):
-                            hasher.update(chunk)
-                        img_item.image_hash = hasher.hexdigest()
-                        save_needed = True
-                except Exception as e:
-                    print(f"Hash calc error {img_id}: {e}")
-
-            if img_item.feature_vector is None and img_item.image:
-                try:
-                    embedding_bytes = generate_image_embedding(img_item.image.path)
-                    if embedding_bytes:
-                        img_item.feature_vector = embedding_bytes
-                        save_needed = True
-                        add_to_faiss_index(img_item.id, embedding_bytes)
-                except Exception as e:
-                    print(f"Embedding error {img_id}: {e}")
-            
-            if save_needed:
-                img_item.save(update_fields=['image_hash', 'feature_vector'])
-            
-        except ImageItem.DoesNotExist:
-            continue
+            process_image_batch(chunk_ids, batch_size=batch_size)
         except Exception as e:
-            print(f"Background task error {img_id}: {e}")
+            print(f"Background task error {chunk_ids}: {e}")
 
 def trigger_background_processing(image_ids):
-    """启动后台线程"""
+    """把新上传的图片交给 Huey 任务队列处理（上传请求优先级高于启动补录）"""
     if image_ids:
-        threading.Thread(
-            target=process_images_background, 
-            args=(image_ids,)
-        ).start()
+        from .tasks import enqueue_image_processing
+        enqueue_image_processing(image_ids)
 
 def confirm_upload_images(batch_id, file_names, group):
     """
@@ -155,4 +198,377 @@ def confirm_upload_images(batch_id, file_names, group):
     except Exception as e:
         print(f"Error cleaning temp dir: {e}")
 
-    return created_ids
\ No newline at end of file
+    return created_ids
+
+def _find_cluster_root(parent, node):
+    root = node
+    while parent[root] != root:
+        root = parent[root]
+    while parent[node] != root:
+        parent[node], node = root, parent[node]
+    return root
+
+
+def rebuild_near_duplicate_clusters(threshold=None, chunk_size=None, progress=None):
+    """
+    分块 range_search 做全库自连接，用并查集把近似重复对合并成簇，整体替换近似重复簇表。
+    只有命中过邻居的图片才进入并查集，库再大内存里也只有重复对。
+    progress(已扫描块数, 已发现重复对数) 用于命令行输出进度。
+    """
+    threshold = get_near_duplicate_threshold() if threshold is None else float(threshold)
+    rows = ImageItem.objects.exclude(feature_vector__isnull=True).order_by('id').values_list('id', 'feature_vector')
+
+    parent = {}
+    best_similarity = {}
+    chunk_count = pair_count = 0
+    for sources, neighbors, scores in iter_near_duplicate_pairs(rows.iterator(chunk_size=2000), threshold, chunk_size):
+        for source, neighbor, score in zip(sources.tolist(), neighbors.tolist(), scores.tolist()):
+            for node in (source, neighbor):
+                parent.setdefault(node, node)
+                if score > best_similarity.get(node, 0):
+                    best_similarity[node] = score
+            source_root = _find_cluster_root(parent, source)
+            neighbor_root = _find_cluster_root(parent, neighbor)
+            if source_root != neighbor_root:
+                parent[max(source_root, neighbor_root)] = min(source_root, neighbor_root)
+        chunk_count += 1
+        pair_count += len(sources)
+        if progress:
+            progress(chunk_count, pair_count)
+
+    clusters = {}
+    for node in parent:
+        clusters.setdefault(_find_cluster_root(parent, node), []).append(node)
+    # 索引里可能还留着数据库已删除的 id
+    existing_ids = set()
+    node_ids = list(parent)
+    for start in range(0, len(node_ids), 900):
+        existing_ids.update(ImageItem.objects.filter(id__in=node_ids[start:start + 900]).values_list('id', flat=True))
+    cluster_members = [
+        sorted(member for member in members if member in existing_ids)
+        for _, members in sorted(clusters.items())
+    ]
+    cluster_members = [members for members in cluster_members if len(members) > 1]
+
+    with transaction.atomic():
+        NearDuplicateCluster.objects.all().delete()
+        created = NearDuplicateCluster.objects.bulk_create([
+            NearDuplicateCluster(
+                size=len(members),
+                max_similarity=max(best_similarity[member] for member in members),
+                threshold=threshold,
+            )
+            for members in cluster_members
+        ], batch_size=500)
+        NearDuplicateMember.objects.bulk_create([
+            NearDuplicateMember(cluster=cluster, image_id=member, similarity=best_similarity[member])
+            for cluster, members in zip(created, cluster_members)
+            for member in members
+        ], batch_size=500)
+
+    return len(cluster_members)
+
+
+def index_prompt_groups(missing_only=False, batch_size=1000, progress=None):
+    """
+    批量写入提示词 LSH 桶。missing_only=True 时只补还没有桶的组（启动补录），
+    否则整表重建。返回处理的组数。
+    """
+    qs = PromptGroup.objects.order_by('id')
+    if missing_only:
+        qs = qs.filter(lsh_buckets__isnull=True)
+    else:
+        PromptGroupLSHBucket.objects.all().delete()
+
+    processed = 0
+    pending = []
+    for row in qs.values_list('id', 'searchable_prompts').iterator(chunk_size=batch_size):
+        pending.append(row)
+        if len(pending) >= batch_size:
+            PromptGroupLSHBucket.index_groups(pending, replace=False)
+            processed += len(pending)
+            pending = []
+            if progress:
+                progress(processed)
+    if pending:
+        PromptGroupLSHBucket.index_groups(pending, replace=False)
+        processed += len(pending)
+    return processed
+
+
+def fill_group_media_stats(missing_only=False, batch_size=1000, progress=None):
+    """
+    回填组上的媒体统计字段 (has_video / image_count / video_count / resolved_cover)。
+    missing_only=True 时只补有文件但计数仍为 0 的组（老数据启动补录），否则全表重算。返回处理的组数。
+    """
+    qs = PromptGroup.objects.order_by('id')
+    if missing_only:
+        qs = qs.filter(image_count=0, images__isnull=False).distinct()
+
+    processed = 0
+    pending = []
+    for group_pk in qs.values_list('id', flat=True).iterator(chunk_size=batch_size):
+        pending.append(group_pk)
+        if len(pending) >= batch_size:
+            PromptGroup.refresh_media_stats(pending)
+            processed += len(pending)
+            pending = []
+            if progress:
+                progress(processed)
+    if pending:
+        PromptGroup.refresh_media_stats(pending)
+        processed += len(pending)
+    return processed
+
+
+def recluster_prompt_groups(threshold=85.0, batch_size=2000, dry_run=False, progress=None):
+    """
+    全库重新计算 group_id：按 id 流式读取提示词，用 LSH 桶召回已有簇的代表提示词，
+    再用 rapidfuzz 在候选里挑 fuzz.ratio 最高且超过 threshold 的簇加入，否则自立新簇。
+    新簇优先沿用自己原来的 group_id（被前面的簇占用时才换新 UUID），重复运行基本不产生写入。
+    dry_run=True 只统计不写库。progress(阶段, 已处理数) 用于命令行输出进度。
+    返回统计 dict。
+    """
+    rows = PromptGroup.objects.order_by('id').values_list('id', 'prompt_text', 'group_id')
+
+    cluster_texts = []
+    cluster_group_ids = []
+    bucket_clusters = {}
+    used_group_ids = set()
+    changes = []
+    samples = []
+    total = merged = 0
+
+    for group_pk, prompt_text, old_group_id in rows.iterator(chunk_size=batch_size):
+        total += 1
+        content = (prompt_text or '').strip().lower()
+        buckets = get_lsh_buckets(content) if len(content) >= MIN_PROMPT_LENGTH else []
+
+        best_match = None
+        if buckets:
+            candidate_ids = set()
+            for bucket in buckets:
+                candidate_ids.update(bucket_clusters.get(bucket, ()))
+            # 长度相差超过 40% 的直接跳过，与旧版规则一致
+            candidates = {
+                index: cluster_texts[index] for index in candidate_ids
+                if abs(len(content) - len(cluster_texts[index])) <= len(cluster_texts[index]) * 0.4
+            }
+            if candidates:
+                best_match = process.extractOne(content, candidates, scorer=fuzz.ratio, score_cutoff=threshold)
+
+        if best_match:
+            _, score, cluster_index = best_match
+            new_group_id = cluster_group_ids[cluster_index]
+            merged += 1
+            if len(samples) < 10:
+                samples.append((group_pk, cluster_texts[cluster_index][:60], round(score, 1)))
+        else:
+            # 旧数据里可能很多组共用同一个 group_id，只有第一个簇能沿用
+            new_group_id = old_group_id if old_group_id and old_group_id not in used_group_ids else uuid.uuid4()
+            used_group_ids.add(new_group_id)
+            cluster_index = len(cluster_texts)
+            cluster_texts.append(content)
+            cluster_group_ids.append(new_group_id)
+            for bucket in buckets:
+                bucket_clusters.setdefault(bucket, []).append(cluster_index)
+
+        if new_group_id != old_group_id:
+            changes.append(PromptGroup(id=group_pk, group_id=new_group_id))
+
+        if progress and total % batch_size == 0:
+            progress('scan', total)
+
+    # 扫描完再统一写回：SQLite 边迭代边改同一张表不安全
+    if not dry_run:
+        for start in range(0, len(changes), batch_size):
+            with transaction.atomic():
+                PromptGroup.objects.bulk_update(changes[start:start + batch_size], ['group_id'])
+            if progress:
+                progress('write', min(start + batch_size, len(changes)))
+        # bulk_update 不触发信号，家族代表表整体重建，筛选项里的家族数随之失效
+        if changes:
+            PromptGroupHead.rebuild()
+            invalidate_facet_counts()
+            # 候选池（各家族最新版本）与同家族排除都变了：全部标记待重算，接口按需当场算，后台整体补齐
+            PromptGroup.objects.update(similar_candidates_at=None)
+            from .tasks import rebuild_similar_candidates_task
+            rebuild_similar_candidates_task(missing_only=True)
+
+    return {
+        'total': total,
+        'clusters': len(cluster_texts),
+        'merged': merged,
+        'changed': len(changes),
+        'samples': samples,
+    }
+
+
+SIMILAR_CANDIDATE_LIMIT = 20
+_SIMILAR_WORD_SPLIT = re.compile(r'[\s,，.。;；|()（）]+')
+
+
+def _similar_candidate_text(searchable_prompts, prompt_text):
+    return (searchable_prompts or prompt_text or '').strip().lower()
+
+
+def _similar_candidate_words(text):
+    return set(word for word in _SIMILAR_WORD_SPLIT.split(text) if len(word) > 2)
+
+
+def load_similar_candidate_pool():
+    """候选池：每个家族 (group_id) 只取最新的一个版本，按 id 倒序（同分时新的优先）"""
+    PromptGroupHead.ensure_built()
+    latest_ids = PromptGroupHead.objects.values('latest_id')
+    rows = PromptGroup.objects.filter(id__in=latest_ids).order_by('-id').values_list(
+        'id', 'group_id', 'searchable_prompts', 'prompt_text'
+    )
+    ids, families, texts = [], [], []
+    for group_pk, family, searchable, prompt_text in rows.iterator(chunk_size=5000):
+        text = _similar_candidate_text(searchable, prompt_text)
+        if text:
+            ids.append(group_pk)
+            families.append(family)
+            texts.append(text)
+    return {
+        'ids': np.asarray(ids, dtype=np.int64),
+        'families': families,
+        'texts': texts,
+        'lengths': np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts)),
+        'words': {},
+    }
+
+
+def compute_similar_group_candidates(sources, pool, limit=SIMILAR_CANDIDATE_LIMIT):
+    """
+    sources 为 (组 id, group_id, 文本)，对整个候选池做一次 rapidfuzz cdist（多线程），
+    再按旧接口的规则过滤：同家族、长度差超过 70%、关键词重叠低于 15%、相似度不超过 30%。
+    返回 {组 id: [(候选组 id, 相似度 0~1)]}，按相似度降序。
+    """
+    results = {}
+    sources = [(group_pk, family, text) for group_pk, family, text in sources if len(text) >= 5]
+    if not sources or not pool['texts']:
+        return results
+
+    family_codes = {}
+    pool_families = np.fromiter((family_codes.setdefault(family, len(family_codes)) for family in pool['families']), dtype=np.int64, count=len(pool['families']))
+    scores = process.cdist(
+        [text for _, _, text in sources], pool['texts'],
+        scorer=fuzz.ratio, score_cutoff=30, dtype=np.float32, workers=-1,
+    )
+
+    for row, (group_pk, family, text) in enumerate(sources):
+        row_scores = scores[row]
+        max_lengths = np.maximum(pool['lengths'], len(text))
+        mask = (row_scores > 30) & (np.abs(pool['lengths'] - len(text)) <= max_lengths * 0.7)
+        mask &= pool_families != family_codes.get(family, -1)
+        candidate_indexes = np.flatnonzero(mask)
+        # 稳定排序：同分时保持池里的 id 倒序
+        candidate_indexes = candidate_indexes[np.argsort(-row_scores[candidate_indexes], kind='stable')]
+
+        my_words = _similar_candidate_words(text)
+        picked = []
+        for index in candidate_indexes.tolist():
+            other_words = pool['words'].get(index)
+            if other_words is None:
+                other_words = pool['words'][index] = _similar_candidate_words(pool['texts'][index])
+            if my_words and other_words:
+                max_possible = min(len(my_words), len(other_words))
+                if max_possible > 0 and len(my_words & other_words) / max_possible < 0.15:
+                    continue
+            picked.append((int(pool['ids'][index]), float(row_scores[index]) / 100.0))
+            if len(picked) >= limit:
+                break
+        results[group_pk] = picked
+    return results
+
+
+def _load_similar_sources(group_ids):
+    rows = PromptGroup.objects.filter(id__in=group_ids).values_list('id', 'group_id', 'searchable_prompts', 'prompt_text')
+    return [(group_pk, family, _similar_candidate_text(searchable, prompt_text)) for group_pk, family, searchable, prompt_text in rows]
+
+
+def _store_similar_candidates(group_ids, computed):
+    SimilarGroupCandidate.objects.bulk_create([
+        SimilarGroupCandidate(source_id=source_id, candidate_id=candidate_id, similarity=similarity)
+        for source_id, picked in computed.items()
+        for candidate_id, similarity in picked
+    ], batch_size=500)
+    # 没有任何候选的组不落行，靠时间戳区分“算过但为空”和“还没算”
+    PromptGroup.objects.filter(id__in=group_ids).update(similar_candidates_at=timezone.now())
+
+
+def refresh_similar_group_candidates(group_ids, pool=None, reverse=True):
+    """
+    增量刷新：重算这些组自己的 top-20；reverse=True 时再把它们补进别的组的列表
+    (相似度是对称的，只需看对方当前第 20 名的分数)。返回刷新的组数。
+    """
+    group_ids = list(group_ids)
+    if not group_ids:
+        return 0
+    pool = pool or load_similar_candidate_pool()
+    sources = _load_similar_sources(group_ids)
+    computed = compute_similar_group_candidates(sources, pool)
+
+    with transaction.atomic():
+        SimilarGroupCandidate.objects.filter(source_id__in=group_ids).delete()
+        _store_similar_candidates(group_ids, computed)
+
+        if reverse:
+            # 只有家族最新版本才会被推荐，旧分数一律作废后重新插入
+            SimilarGroupCandidate.objects.filter(candidate_id__in=group_ids).delete()
+            pool_ids = set(pool['ids'].tolist())
+            incoming = {}
+            for source_id, picked in computed.items():
+                if source_id not in pool_ids:
+                    continue
+                for other_id, similarity in picked:
+                    incoming.setdefault(other_id, []).append((similarity, source_id))
+
+            existing = {}
+            for source_id, candidate_id, similarity in SimilarGroupCandidate.objects.filter(
+                source_id__in=list(incoming)
+            ).values_list('source_id', 'candidate_id', 'similarity'):
+                existing.setdefault(source_id, []).append((similarity, candidate_id))
+
+            to_create, to_delete = [], []
+            for other_id, additions in incoming.items():
+                current = existing.get(other_id, [])
+                ranked = sorted(current + additions, key=lambda item: item[0], reverse=True)
+                kept = ranked[:SIMILAR_CANDIDATE_LIMIT]
+                kept_ids = set(candidate_id for _, candidate_id in kept)
+                to_delete.extend((other_id, candidate_id) for _, candidate_id in current if candidate_id not in kept_ids)
+                to_create.extend(
+                    SimilarGroupCandidate(source_id=other_id, candidate_id=source_id, similarity=similarity)
+                    for similarity, source_id in additions if source_id in kept_ids
+                )
+            for other_id, candidate_id in to_delete:
+                SimilarGroupCandidate.objects.filter(source_id=other_id, candidate_id=candidate_id).delete()
+            SimilarGroupCandidate.objects.bulk_create(to_create, batch_size=500)
+
+    return len(sources)
+
+
+def rebuild_similar_group_candidates(missing_only=False, batch_size=256, progress=None):
+    """
+    全库重算相似组候选：候选池只加载一次，源组按 batch_size 一块做 cdist。
+    missing_only=True 时只补还没算过（similar_candidates_at 为空）的组。返回处理的组数。
+    """
+    pool = load_similar_candidate_pool()
+    qs = PromptGroup.objects.order_by('id')
+    if missing_only:
+        qs = qs.filter(similar_candidates_at__isnull=True)
+    else:
+        SimilarGroupCandidate.objects.all().delete()
+
+    # 先取 id 再分块读文本，避免 SQLite 边迭代边写同一个库
+    group_ids = list(qs.values_list('id', flat=True))
+    processed = 0
+    for start in range(0, len(group_ids), batch_size):
+        batch_ids = group_ids[start:start + batch_size]
+        sources = _load_similar_sources(batch_ids)
+        _store_similar_candidates(batch_ids, compute_similar_group_candidates(sources, pool))
+        processed += len(sources)
+        if progress:
+            progress(processed, len(group_ids))
+    return processed
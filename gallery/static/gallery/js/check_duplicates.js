@@ -179,6 +179,7 @@ function renderCheckResults(results, hasDuplicate, fileMap) {
 
     list.innerHTML = '';
     let duplicateCount = 0;
+    let similarCount = 0;
     const detailUrlPrefix = "/image/"; 
 
     // 在生成新的一批预览图前，清理上一批的内存
@@ -203,8 +204,9 @@ function renderCheckResults(results, hasDuplicate, fileMap) {
         
         // --- 2. 处理右侧（重复文件） ---
         let html = '';
-        if (item.status === 'duplicate') {
-            duplicateCount++;
+        if (item.status === 'duplicate' || item.status === 'similar') {
+            const isSimilar = item.status === 'similar';
+            if (isSimilar) similarCount++; else duplicateCount++;
             
             let existingThumbsHtml = '';
             if (item.duplicates && item.duplicates.length > 0) {
@@ -218,11 +220,13 @@ function renderCheckResults(results, hasDuplicate, fileMap) {
             }
 
             html = `
-                <div class="check-item bg-danger bg-opacity-10 mb-2 p-2 rounded d-flex align-items-center">
+                <div class="check-item ${isSimilar ? 'bg-warning' : 'bg-danger'} bg-opacity-10 mb-2 p-2 rounded d-flex align-items-center">
                     ${mainMediaHtml}
                     <div class="flex-grow-1 min-width-0">
                         <div class="d-flex justify-content-between align-items-center">
-                            <strong class="text-danger small"><i class="bi bi-exclamation-circle-fill me-1"></i>已存在</strong>
+                            ${isSimilar
+                                ? '<strong class="text-warning small"><i class="bi bi-intersect me-1"></i>视觉相同 (缩放/压缩过)</strong>'
+                                : '<strong class="text-danger small"><i class="bi bi-exclamation-circle-fill me-1"></i>已存在</strong>'}
                             <div class="d-flex align-items-center">${existingThumbsHtml}</div>
                         </div>
                         <div class="text-truncate small text-muted mt-1" title="${item.filename}">${item.filename}</div>
@@ -244,7 +248,7 @@ function renderCheckResults(results, hasDuplicate, fileMap) {
         list.insertAdjacentHTML('beforeend', html);
     });
 
-    summary.innerHTML = `本次共检测 <strong>${results.length}</strong> 个文件，发现 <strong><span class="text-danger">${duplicateCount}</span></strong> 个重复`;
+    summary.innerHTML = `本次共检测 <strong>${results.length}</strong> 个文件，发现 <strong><span class="text-danger">${duplicateCount}</span></strong> 个重复${similarCount ? `，<span class="text-warning">${similarCount}</span> 个视觉相同` : ''}`;
     if (resultsArea) resultsArea.style.display = 'block';
     
     // 更新底部按钮
@@ -5,6 +5,7 @@
 let mergeModal;
 let selectedMergeIds = new Set();
 let currentPage = 1;
+let mergeNextCursor = '';
 let currentQuery = '';
 let isLoading = false;
 let IS_LIKED_FILTER = false;
@@ -330,9 +331,11 @@ function loadMergeData(page, reset = false) {
     if (reset) {
         container.innerHTML = '<div class="text-center py-5 text-muted"><i class="bi bi-hourglass-split me-2"></i>加载中...</div>';
         currentPage = 1;
+        mergeNextCursor = '';
     }
 
-    fetch(`api/groups/?page=${page}&q=${encodeURIComponent(currentQuery)}`)
+    // 游标翻页：服务端返回的 next_cursor 原样带回，深翻页不会变慢
+    fetch(`api/groups/?cursor=${encodeURIComponent(reset ? '' : mergeNextCursor)}&q=${encodeURIComponent(currentQuery)}`)
         .then(res => res.json())
         .then(data => {
             if (reset) container.innerHTML = '';
@@ -386,6 +389,7 @@ function loadMergeData(page, reset = false) {
             if (data.has_next) {
                 loadMoreBtn.style.display = 'block';
                 currentPage = page;
+                mergeNextCursor = data.next_cursor || '';
             } else {
                 loadMoreBtn.style.display = 'none';
             }
@@ -0,0 +1,167 @@
+import threading
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db.models import Q
+from huey import crontab
+from huey.contrib.djhuey import HUEY, db_task, periodic_task
+from huey.exceptions import TaskLockedException
+
+from .ai_utils import get_embed_batch_size, publish_faiss_snapshot, sync_faiss_ids
+from .models import ImageItem
+from .services import (
+    fill_group_media_stats,
+    index_prompt_groups,
+    process_image_batch,
+    rebuild_near_duplicate_clusters,
+    rebuild_similar_group_candidates,
+    refresh_similar_group_candidates,
+)
+
+
+# 上传触发的任务优先于启动时的补录任务
+IMAGE_PROCESSING_PRIORITY_UPLOAD = 10
+IMAGE_PROCESSING_PRIORITY_BACKFILL = 0
+_IMAGE_LOCK_TTL = 1800
+# 相似组候选任务的全局锁：持锁进程意外退出后最多锁这么久；抢不到锁的任务隔几秒重新入队
+_SIMILAR_LOCK_TTL = 600
+_SIMILAR_REQUEUE_DELAY = 10
+
+
+def _get_embed_concurrency():
+    return max(1, int(getattr(settings, 'GALLERY_EMBED_CONCURRENCY', 1)))
+
+
+# 无论 consumer 开多少个线程 worker，同一进程里同时跑 CLIP 的批次数都受此限制
+_EMBEDDING_SLOTS = threading.BoundedSemaphore(_get_embed_concurrency())
+
+
+def _acquire_image_locks(stack, image_ids):
+    """按 ImageItem.id 加锁，已被其他 worker 处理中的图片直接跳过"""
+    acquired = []
+    for image_id in image_ids:
+        try:
+            stack.enter_context(HUEY.lock_task(f'gallery-image-{image_id}', ttl=_IMAGE_LOCK_TTL))
+        except TaskLockedException:
+            continue
+        acquired.append(image_id)
+    return acquired
+
+
+def run_image_processing(image_ids):
+    with ExitStack() as stack:
+        locked_ids = _acquire_image_locks(stack, image_ids)
+        if not locked_ids:
+            return 0
+        with _EMBEDDING_SLOTS:
+            return process_image_batch(locked_ids)
+
+
+@db_task(
+    retries=getattr(settings, 'GALLERY_EMBED_TASK_RETRIES', 3),
+    retry_delay=getattr(settings, 'GALLERY_EMBED_TASK_RETRY_DELAY', 30),
+    priority=IMAGE_PROCESSING_PRIORITY_UPLOAD,
+)
+def process_images_task(image_ids):
+    return run_image_processing(image_ids)
+
+
+def enqueue_image_processing(image_ids, priority=IMAGE_PROCESSING_PRIORITY_UPLOAD):
+    """按编码批大小切分后入队，返回入队的任务数"""
+    image_ids = list(image_ids)
+    batch_size = get_embed_batch_size()
+    queued = 0
+    for start in range(0, len(image_ids), batch_size):
+        process_images_task(image_ids[start:start + batch_size], priority=priority)
+        queued += 1
+    return queued
+
+
+def enqueue_missing_image_processing():
+    """启动时补录：哈希或向量为空的图片重新入队（低优先级，任务本身幂等）"""
+    missing_ids = list(
+        ImageItem.objects.exclude(image='')
+        .filter(Q(image_hash='') | Q(feature_vector__isnull=True))
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    if not missing_ids:
+        return 0
+    queued = enqueue_image_processing(missing_ids, priority=IMAGE_PROCESSING_PRIORITY_BACKFILL)
+    print(f">> [后台任务] {len(missing_ids)} 张图片缺少哈希或向量，已重新入队 ({queued} 个任务)")
+    return queued
+
+
+@db_task(retries=2, retry_delay=10)
+def sync_faiss_vectors_task(image_ids):
+    """只读 Web 进程转交过来的索引变更，由 owner 进程按数据库现状同步"""
+    sync_faiss_ids(image_ids)
+
+
+@periodic_task(crontab(minute='*'))
+def publish_faiss_index_task():
+    """owner 进程每分钟发布一次有变更的索引快照，只读进程随后切换到新一代"""
+    return publish_faiss_snapshot()
+
+
+@db_task()
+@HUEY.lock_task('gallery-near-duplicates')
+def rebuild_near_duplicates_task(threshold=None, chunk_size=None):
+    """全库近似重复簇重算，同一时间只跑一个"""
+    cluster_count = rebuild_near_duplicate_clusters(threshold=threshold, chunk_size=chunk_size)
+    print(f">> [后台任务] 近似重复簇已重算，共 {cluster_count} 个簇")
+    return cluster_count
+
+
+@db_task()
+@HUEY.lock_task('gallery-prompt-lsh')
+def index_missing_prompt_lsh_task():
+    """启动时补录：还没有 LSH 桶的提示词组（老数据或上次停机前的漏网之鱼）"""
+    processed = index_prompt_groups(missing_only=True)
+    if processed:
+        print(f">> [后台任务] 已为 {processed} 个提示词组补写 LSH 桶")
+    return processed
+
+
+@db_task()
+@HUEY.lock_task('gallery-media-stats')
+def fill_missing_media_stats_task():
+    """启动时补录：有文件但还没算过媒体统计的组（新增字段前的老数据）"""
+    processed = fill_group_media_stats(missing_only=True)
+    if processed:
+        print(f">> [后台任务] 已为 {processed} 个提示词组补算文件数 / 视频标记 / 封面")
+    return processed
+
+
+def run_similar_candidates_refresh(group_ids):
+    """同一时间只有一个任务改写候选表；锁被占用时延后重新入队，而不是靠有限的重试次数碰运气"""
+    try:
+        with HUEY.lock_task('gallery-similar-candidates', ttl=_SIMILAR_LOCK_TTL):
+            return refresh_similar_group_candidates(group_ids)
+    except TaskLockedException:
+        refresh_similar_candidates_task.schedule((list(group_ids),), delay=_SIMILAR_REQUEUE_DELAY)
+        return 0
+
+
+@db_task(retries=2, retry_delay=10)
+def refresh_similar_candidates_task(group_ids):
+    """提示词变化后刷新这些组的相似组候选，并把它们补进其他组的 top-20"""
+    return run_similar_candidates_refresh(group_ids)
+
+
+def run_similar_candidates_rebuild(missing_only=True):
+    """与增量刷新共用一把锁；锁被占用时同样延后重新入队"""
+    try:
+        with HUEY.lock_task('gallery-similar-candidates', ttl=_SIMILAR_LOCK_TTL):
+            processed = rebuild_similar_group_candidates(missing_only=missing_only)
+    except TaskLockedException:
+        rebuild_similar_candidates_task.schedule(kwargs={'missing_only': missing_only}, delay=_SIMILAR_REQUEUE_DELAY)
+        return 0
+    print(f">> [后台任务] 已为 {processed} 个提示词组重算相似组候选")
+    return processed
+
+
+@db_task()
+def rebuild_similar_candidates_task(missing_only=True):
+    """重新聚类等批量改动家族之后，补算所有被标记为待重算的组"""
+    return run_similar_candidates_rebuild(missing_only=missing_only)
@@ -0,0 +1,23 @@
+import shutil
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class GalleryTestRunner(DiscoverRunner):
+    """
+    整个测试过程把 FAISS 索引目录指到临时目录：没有加载索引的进程会把向量变更写进增量日志，
+    统一在这里覆盖，新加的测试类不用各自声明，也不会往项目里的 faiss_index/ 写东西。
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.faiss_index_dir = tempfile.mkdtemp(prefix='gallery_test_faiss_')
+        self.faiss_index_override = override_settings(GALLERY_FAISS_INDEX_DIR=self.faiss_index_dir)
+        self.faiss_index_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.faiss_index_override.disable()
+        shutil.rmtree(self.faiss_index_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
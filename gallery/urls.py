@@ -8,6 +8,8 @@ urlpatterns = [
     # 【新增】AI 独立创作页面
     path('create/', views.create_view, name='create'),
     path('image/<int:pk>/', views.detail, name='detail'),
+    # 库内找相似 (直接用已存向量检索)
+    path('similar/<int:pk>/', views.similar_images, name='similar_images'),
     path('upload/', views.upload, name='upload'),
     path('api/video-to-gif/', views.api_video_to_gif, name='api_video_to_gif'),
     # 删除相关
@@ -33,6 +35,8 @@ urlpatterns = [
     path('update-prompts/<int:pk>/', views.update_group_prompts, name='update_group_prompts'),
     # 查重接口
     path('check-duplicates/', views.check_duplicates, name='check_duplicates'),
+    # 视觉近似重复审查页
+    path('near-duplicates/', views.near_duplicates, name='near_duplicates'),
     # 合并功能相关接口
     path('api/groups/', views.group_list_api, name='group_list_api'),
     path('api/merge-groups/', views.merge_groups, name='merge_groups'),
@@ -40,6 +44,7 @@ urlpatterns = [
     path('api/link-group/<int:pk>/', views.link_group_relation, name='link_group'),
     path('api/batch-delete/', views.batch_delete_images, name='batch_delete_images'), 
     path('api/set-cover/<int:group_id>/<int:image_id>/', views.set_group_cover, name='set_group_cover'),
+    path('api/similar-images/<int:pk>/', views.api_similar_images, name='api_similar_images'),
     path('api/similar-groups/<int:pk>/', views.get_similar_candidates, name='get_similar_candidates'),
     path('api/detail-ratio-groups/<int:pk>/', views.detail_ratio_groups, name='detail_ratio_groups'),
     path('api/set-main/<int:pk>/', views.set_main_variant, name='set_main_variant'),
@@ -34,10 +34,14 @@ from django.core.cache import cache
 from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
-from .models import ImageItem, PromptGroup, Tag, AIModel, ReferenceItem, Character, CharacterIP, PROVIDER_CHOICES, GPTImageConversation, GPTImageConversationTurn, GPT_IMAGE_CONVERSATION_SOURCE_CHOICES
+from .models import ImageItem, PromptGroup, PromptGroupHead, Tag, AIModel, ReferenceItem, Character, CharacterIP, PROVIDER_CHOICES, GPTImageConversation, GPTImageConversationTurn, GPT_IMAGE_CONVERSATION_SOURCE_CHOICES, NearDuplicateCluster, NearDuplicateMember
 from .forms import PromptGroupForm
-from .ai_utils import search_similar_images, generate_title_with_local_llm
+from .ai_utils import decode_feature_vector, reciprocal_rank_fusion, search_images_by_text, search_similar_images, search_similar_to_item, generate_title_with_local_llm
 from .ai_providers import get_ai_provider
+from .facets import build_filter_facets, get_context_facet_counts, get_global_facet_counts, invalidate_facet_counts
+from .pagination import get_elided_page_range, keyset_page, paginate
+from .perceptual_hash import compute_dhash, find_visual_duplicates
+from .prompt_index import build_prompt_item_meta, search_prompt_items
 from .prompt_mediation import mediate_gpt_image_prompt
 from rapidfuzz import process, fuzz
 
@@ -46,7 +50,8 @@ from .services import (
     get_temp_dir, 
     calculate_file_hash, 
     trigger_background_processing,
-    confirm_upload_images
+    confirm_upload_images,
+    refresh_similar_group_candidates,
 )
 
 DETAIL_SORT_MODES = {'similar', 'latest'}
@@ -129,11 +134,11 @@ def _load_feature_vector(item):
         return None
 
     try:
-        vector = np.frombuffer(item.feature_vector, dtype=np.float32)
+        vector = decode_feature_vector(item.feature_vector)
     except (TypeError, ValueError):
         return None
 
-    if vector.size == 0:
+    if vector is None:
         return None
 
     norm = np.linalg.norm(vector)
@@ -143,10 +148,29 @@ def _load_feature_vector(item):
     return vector / norm
 
 
-def _order_images_by_similarity(images):
+def _get_similarity_order_cache_key(scope, images):
+    """按图片 id 与向量内容生成签名，组内增删图或向量变化后自然换 key"""
+    signature = hashlib.md5()
+    for image in images:
+        signature.update(str(image.pk).encode('ascii'))
+        signature.update(b':')
+        signature.update(bytes(image.feature_vector or b''))
+        signature.update(b';')
+    return f'detail-similar-order:{scope}:{signature.hexdigest()}'
+
+
+def _order_images_by_similarity(images, cache_scope=None):
     if len(images) < 2:
         return list(images)
 
+    cache_key = None
+    if cache_scope is not None:
+        cache_key = _get_similarity_order_cache_key(cache_scope, images)
+        cached_ids = cache.get(cache_key)
+        if cached_ids is not None:
+            images_by_id = {image.pk: image for image in images}
+            return [images_by_id[image_id] for image_id in cached_ids]
+
     vector_entries = []
     trailing_images = []
 
@@ -163,25 +187,23 @@ def _order_images_by_similarity(images):
     vectors = np.stack([entry[2] for entry in vector_entries]).astype(np.float32)
     similarity_matrix = vectors @ vectors.T
 
-    remaining = set(range(len(vector_entries)))
+    # 贪心链：每步在当前图那一行里屏蔽已走过的位置后取 argmax；
+    # 并列时 argmax 取最靠前的位置，与原顺序优先的规则一致
+    visited = np.zeros(len(vector_entries), dtype=bool)
     ordered_positions = [0]
-    remaining.remove(0)
+    visited[0] = True
     current_position = 0
 
-    while remaining:
-        next_position = max(
-            remaining,
-            key=lambda candidate: (
-                float(similarity_matrix[current_position, candidate]),
-                -vector_entries[candidate][0],
-            ),
-        )
-        ordered_positions.append(next_position)
-        remaining.remove(next_position)
-        current_position = next_position
+    for _ in range(len(vector_entries) - 1):
+        row = np.where(visited, -np.inf, similarity_matrix[current_position])
+        current_position = int(np.argmax(row))
+        visited[current_position] = True
+        ordered_positions.append(current_position)
 
     ordered_images = [vector_entries[position][1] for position in ordered_positions]
     ordered_images.extend(image for _, image in trailing_images)
+    if cache_key is not None:
+        cache.set(cache_key, [image.pk for image in ordered_images], timeout=60 * 60 * 24 * 30)
     return ordered_images
 
 
@@ -2050,6 +2072,44 @@ def get_prompt_summary_text(group, max_length=100):
     if len(text) > max_length:
         return text[:max_length] + '...'
     return text
+
+SIMILAR_IMAGES_PAGE_SIZE = 24
+SIMILAR_IMAGES_MAX_PAGE_SIZE = 100
+
+
+def _get_similar_images_page(request, pk):
+    """按库内图片的存量向量找相似，第 page 页检索 page * page_size + 1 条后切片（多出的一条用于判断是否有下一页）"""
+    item = get_object_or_404(ImageItem.objects.only('id', 'feature_vector'), pk=pk)
+    try:
+        page_number = max(1, int(request.GET.get('page', 1)))
+        page_size = int(request.GET.get('page_size', SIMILAR_IMAGES_PAGE_SIZE))
+    except (TypeError, ValueError):
+        page_number, page_size = 1, SIMILAR_IMAGES_PAGE_SIZE
+    page_size = min(max(1, page_size), SIMILAR_IMAGES_MAX_PAGE_SIZE)
+
+    offset = (page_number - 1) * page_size
+    results = search_similar_to_item(item, ImageItem.objects.select_related('group'), top_k=offset + page_size + 1)
+    return item, results[offset:offset + page_size], page_number, len(results) > offset + page_size
+
+
+def _semantic_search_images(query, queryset, top_k=100):
+    """CLIP 以文搜图，返回按相似度排序的图片（只取 id / group_id）；模型不可用时退化为空结果"""
+    try:
+        return search_images_by_text(query, queryset.only('id', 'group_id'), top_k=top_k)
+    except Exception as e:
+        print(f"⚠️ 语义搜索不可用: {e}")
+        return []
+
+
+def _preserve_id_order(queryset, ordered_ids):
+    if not ordered_ids:
+        return queryset.none()
+    preserved_order = Case(
+        *[When(pk=pk, then=pos) for pos, pk in enumerate(ordered_ids)],
+        output_field=IntegerField()
+    )
+    return queryset.filter(id__in=ordered_ids).order_by(preserved_order)
+
 # ==========================================
 # 视图函数
 # ==========================================
@@ -2060,6 +2120,7 @@ def home(request):
     query = request.GET.get('q')
     filter_type = request.GET.get('filter')
     search_id = request.GET.get('search_id')
+    semantic_search = request.GET.get('semantic') == '1'
     
     f_liked = request.GET.get('f_liked')
     f_video = request.GET.get('f_video')
@@ -2124,6 +2185,7 @@ def home(request):
 
     # === 常规文本搜索 ===
     if query:
+        hit_ids = None
         try:
             # 尝试向 Meilisearch 发起毫秒级搜索 (填入你的 Master Key)
             client = meilisearch.Client('http://127.0.0.1:7700', 'dq49aaqs-RYHbIfKGMOFJRrfco3jP-0Ubj4gcX9caBc')
@@ -2132,16 +2194,6 @@ def home(request):
             })
             
             hit_ids = [hit['id'] for hit in search_res['hits']]
-            
-            if hit_ids:
-                # 保持 Meilisearch 给出的智能排序顺序
-                preserved_order = Case(
-                    *[When(pk=pk, then=pos) for pos, pk in enumerate(hit_ids)], 
-                    output_field=IntegerField()
-                )
-                queryset = queryset.filter(id__in=hit_ids).order_by(preserved_order)
-            else:
-                queryset = queryset.none()
                 
         except Exception as e:
             print(f"⚠️ Meilisearch 搜索不可用，降级为原生数据库查询: {e}")
@@ -2152,25 +2204,27 @@ def home(request):
                 Q(characters__name__icontains=query) | 
                 Q(tags__name__icontains=query)
             ).distinct()
+
+        if semantic_search:
+            # 语义模式：关键词命中与 CLIP 以文搜图命中 (按图片所属作品去重) 做 RRF 融合
+            keyword_ids = hit_ids if hit_ids is not None else list(queryset.values_list('id', flat=True)[:100])
+            semantic_images = _semantic_search_images(query, ImageItem.objects.all())
+            semantic_group_ids = list(dict.fromkeys(img.group_id for img in semantic_images))
+            hit_ids = reciprocal_rank_fusion([keyword_ids, semantic_group_ids])
+            queryset = PromptGroup.objects.all()
+
+        if hit_ids is not None:
+            # 保持 Meilisearch / 融合后给出的排序
+            queryset = _preserve_id_order(queryset, hit_ids)
     
     # 基础状态筛选
     if f_liked == '1' or filter_type == 'liked':
         queryset = queryset.filter(is_liked=True)
+    # 视频 / 多图筛选直接读组上维护的统计字段，不再 JOIN 图片表做 LIKE
     if f_video == '1':
-        queryset = queryset.filter(
-            # 1. 检查多图列表里是否包含视频
-            Q(images__image__icontains='.mp4') |
-            Q(images__image__icontains='.mov') |
-            Q(images__image__icontains='.avi') |
-            Q(images__image__icontains='.webm') |
-            Q(images__image__icontains='.mkv') |
-            # 2. 修复：跨表检查 cover_image 外键里的 image 字段
-            Q(cover_image__image__icontains='.mp4') |
-            Q(cover_image__image__icontains='.mov') |
-            Q(cover_image__image__icontains='.webm')
-        ).distinct()
+        queryset = queryset.filter(has_video=True)
     if f_multi == '1':
-        queryset = queryset.annotate(img_count=Count('images')).filter(img_count__gt=1)
+        queryset = queryset.filter(image_count__gt=1)
         
     # 模型筛选 (OR 逻辑：选了A或B都展示)
     if f_models:
@@ -2186,24 +2240,14 @@ def home(request):
             queryset = queryset.filter(tags__name=t)
 
     # === 版本去重与计数逻辑 ===
-    version_counts = {}
-    
     # 判断当前是否处于“高级筛选”状态
     is_filtering = any([f_liked, filter_type == 'liked', f_video, f_multi, f_models, f_chars, f_tags])    
     # 只有在：没搜文字、没以图搜图、且【没有开启任何组合筛选】时，才折叠去重
-    if not query and not search_id and not is_filtering:
-        group_stats = PromptGroup.objects.values('group_id').annotate(
-            main_id=Max(Case(When(is_main_variant=True, then='id'), output_field=IntegerField())),
-            latest_id=Max('id'),
-            count=Count('id')
-        )
-        final_ids = []
-        for s in group_stats:
-            target_id = s['main_id'] if s['main_id'] else s['latest_id']
-            final_ids.append(target_id)
-            version_counts[target_id] = s['count']
-        
-        queryset = queryset.filter(id__in=final_ids)
+    collapse_variants = not query and not search_id and not is_filtering
+    PromptGroupHead.ensure_built()
+    if collapse_variants:
+        # 家族代表表里已经存好了代表版本和版本数，一次 JOIN 即可
+        queryset = queryset.filter(group_head__isnull=False).select_related('group_head')
 
     if not query and not search_id:
         queryset = queryset.order_by('-created_at', '-id')
@@ -2211,9 +2255,9 @@ def home(request):
     # === 统一执行 N+1 预加载 ===
     # 无论上面走了哪个分支，最后统一下达预加载指令，将首页原本的 40+ 次查询压缩到 4 次
     queryset = queryset.select_related(
-        'cover_image'
+        'resolved_cover'
     ).prefetch_related(
-        'images', 'tags', 'characters', 'references'
+        'tags', 'characters', 'references'
     )
     # === 收集提供给前端侧边栏的数据 ===
     tags_bar = get_tags_bar_data()
@@ -2222,29 +2266,31 @@ def home(request):
     model_names_list = list(_get_visible_model_suggestion_queryset().values_list('name', flat=True))
     
     # 获取各维度筛选项并统计卡片数量 (过滤掉没有作品被关联的空标签/人物)
+    # 全库计数走信号失效的缓存；搜索或筛选时按当前结果一条 GROUP BY 重新计数
+    # 最常用的前 50 个普通标签排除掉作为模型名的标签，防止和模型筛选重复
+    context_counts = get_context_facet_counts(queryset) if (query or is_filtering) else None
     filter_data = {
         'models': model_names_list,
-        'chars': Character.objects.annotate(use_count=Count('promptgroup')).filter(use_count__gt=0).order_by('-use_count'),
-        # 获取最常用的前 50 个普通标签（排除掉作为模型名的标签，防止和模型筛选重复）
-        'tags': Tag.objects.exclude(name__in=model_names_list).annotate(use_count=Count('promptgroup')).filter(use_count__gt=0).order_by('-use_count')[:50]
+        **build_filter_facets(model_names_list, context_counts, selected_chars=f_chars, selected_tags=f_tags),
     }
 
     # === 分页与数据组装 ===
-    paginator = Paginator(queryset, 12)
-    page_number = request.GET.get('page')
-    page = paginator.get_page(page_number)
-    page_obj = paginator.get_page(page_number)
-    page_range = page.paginator.get_elided_page_range(page.number, on_each_side=5, on_ends=1)
+    # 按时间倒序浏览时支持游标翻页；搜索结果按相关度排序，只能走普通分页
+    keyset_ordering = ('-created_at', '-id') if not query and not search_id else None
+    page = paginate(request, queryset, 12, ordering=keyset_ordering)
+    page_obj = page
+    page_range = get_elided_page_range(page)
     # 统计总卡片数量
-    total_groups_count = PromptGroup.objects.values('group_id').distinct().count()
+    total_groups_count = get_global_facet_counts()['total_groups']
     # 将计算好的版本数量绑定到每个对象上供前端展示
     for group in page_obj:
-        group.version_count = version_counts.get(group.id, 0)
+        group.version_count = group.group_head.variant_count if collapse_variants else 0
 
     # 复制一份当前的 GET 请求参数，把 'page' 剔除掉，剩下的打包成 url 字符串
     query_dict = request.GET.copy()
-    if 'page' in query_dict:
-        del query_dict['page']
+    for key in ('page', 'cursor'):
+        if key in query_dict:
+            del query_dict[key]
     url_params = query_dict.urlencode()
 
     return render(request, 'gallery/home.html', {
@@ -2263,6 +2309,7 @@ def home(request):
         'f_chars': f_chars,
         'f_tags': f_tags,
         'url_params': url_params,
+        'semantic_search': semantic_search,
     })
 
 
@@ -2271,6 +2318,7 @@ def liked_images_gallery(request):
     search_mode = 'text'
     query_text = request.GET.get('q')
     search_id = request.GET.get('search_id') 
+    semantic_search = request.GET.get('semantic') == '1'
     
     if request.method == 'POST' and request.FILES.get('image_query'):
         try:
@@ -2320,22 +2368,56 @@ def liked_images_gallery(request):
             Q(group__characters__name__icontains=query_text) | # 【新增】支持搜人物
             Q(group__tags__name__icontains=query_text)
         ).distinct()
+        if semantic_search:
+            # 语义模式：关键词命中与 CLIP 以文搜图命中做 RRF 融合
+            keyword_ids = list(queryset.values_list('id', flat=True)[:100])
+            semantic_ids = [img.id for img in _semantic_search_images(query_text, ImageItem.objects.filter(is_liked=True))]
+            queryset = _preserve_id_order(
+                ImageItem.objects.select_related('group'),
+                reciprocal_rank_fusion([keyword_ids, semantic_ids]),
+            )
     
     tags_bar = get_tags_bar_data()
-    paginator = Paginator(queryset, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    keyset_ordering = ('-id',) if not search_id and not semantic_search else None
+    page_obj = paginate(request, queryset, 20, ordering=keyset_ordering)
+
+    query_dict = request.GET.copy()
+    for key in ('page', 'cursor'):
+        if key in query_dict:
+            del query_dict[key]
     
     return render(request, 'gallery/liked_images.html', {
         'page_obj': page_obj,
+        'groups': page_obj,
+        'page_range': get_elided_page_range(page_obj),
+        'url_params': query_dict.urlencode(),
         'search_query': query_text,
         'search_mode': search_mode,
         'is_home_search': False,
         'current_search_id': search_id,
+        'semantic_search': semantic_search,
         'tags_bar': tags_bar
     })
 
 
+def similar_images(request, pk):
+    """详情页「找相似」：不重新编码，直接用该图已存的向量检索全库"""
+    item, results, page_number, has_next = _get_similar_images_page(request, pk)
+    if item.feature_vector is None:
+        messages.info(request, "这张图片还没有生成特征向量，请稍后再试")
+
+    return render(request, 'gallery/liked_images.html', {
+        'page_obj': results,
+        'search_query': '相似图片',
+        'search_mode': 'image',
+        'is_home_search': True,
+        'similar_source': item,
+        'similar_page': page_number,
+        'similar_has_next': has_next,
+        'tags_bar': get_tags_bar_data(),
+    })
+
+
 def detail(request, pk):
     ensure_ai_studio_model_labels_registered()
     sort_mode = _normalize_detail_sort_mode(request.GET.get('sort'))
@@ -2376,13 +2458,9 @@ def detail(request, pk):
     is_default_view = (not query and not filter_type)
     
     if is_default_view:
-        # 获取代表ID列表 (主版本 or 最新版本)
-        group_stats = PromptGroup.objects.values('group_id').annotate(
-            main_id=Max(Case(When(is_main_variant=True, then='id'), output_field=IntegerField())),
-            latest_id=Max('id')
-        )
-        target_ids = [ (s['main_id'] or s['latest_id']) for s in group_stats ]
-        nav_qs = nav_qs.filter(id__in=target_ids)
+        # 只在各家族的代表版本 (主版本 or 最新版本) 之间导航
+        PromptGroupHead.ensure_built()
+        nav_qs = nav_qs.filter(group_head__isnull=False)
 
     # 4. 计算 上一篇 (Previous = ID更的大 = 更晚创建)
     # 如果是默认视图，额外排除同 Group 的 ID (虽然 dedupe 理论上已处理，加一层保险)
@@ -2400,7 +2478,7 @@ def detail(request, pk):
     # 拆分图片和视频
     all_items = group.images.all()
     latest_images_list = [item for item in all_items if not item.is_video]
-    similar_images_list = _order_images_by_similarity(latest_images_list)
+    similar_images_list = _order_images_by_similarity(latest_images_list, cache_scope=group.pk)
 
     for index, item in enumerate(latest_images_list):
         item.detail_sort_latest_order = index
@@ -2842,6 +2920,7 @@ def check_duplicates(request):
             file_data_list.append({
                 'filename': file.name,
                 'hash': file_hash,
+                'perceptual_hash': compute_dhash(file_path),
                 'url': f"{settings.MEDIA_URL}{relative_path}"
             })
 
@@ -2857,27 +2936,46 @@ def check_duplicates(request):
             dup_map[dup.image_hash].append(dup)
 
         # ==========================================
-        # 4. 极速组装返回结果
+        # 优化 4：MD5 没命中的再查感知哈希 BK 树，找出缩放 / 重新压缩过的同一张图
+        # ==========================================
+        visual_matches = {}
+        for item in file_data_list:
+            if not dup_map.get(item['hash']):
+                visual_matches[item['filename']] = find_visual_duplicates(ImageItem, item['perceptual_hash'])
+        visual_ids = {obj_id for matches in visual_matches.values() for _, obj_id in matches}
+        visual_objects = ImageItem.objects.select_related('group').in_bulk(visual_ids) if visual_ids else {}
+
+        # ==========================================
+        # 5. 极速组装返回结果
         # ==========================================
         results = []
         for item in file_data_list:
             f_hash = item['hash']
-            dups = dup_map.get(f_hash, [])
-            is_duplicate = len(dups) > 0
+            dups = [(None, dup) for dup in dup_map.get(f_hash, [])]
+            if dups:
+                status = 'duplicate'
+            else:
+                dups = [
+                    (distance, visual_objects[obj_id])
+                    for distance, obj_id in visual_matches.get(item['filename'], [])
+                    if obj_id in visual_objects
+                ]
+                status = 'similar' if dups else 'pass'
             
             dup_info = []
-            for dup in dups:
+            for distance, dup in dups:
                 dup_info.append({
                     'id': dup.id,
                     'group_id': dup.group.id,
                     'group_title': dup.group.title, # 因为有 select_related，这里不再触发查询
                     'is_video': dup.is_video,
-                    'url': dup.thumbnail.url if dup.thumbnail else dup.image.url
+                    'url': dup.thumbnail.url if dup.thumbnail else dup.image.url,
+                    'distance': distance,
                 })
 
             results.append({
                 'filename': item['filename'],
-                'status': 'duplicate' if is_duplicate else 'pass',
+                'status': status,
                 'url': item['url'],
                 'thumbnail_url': item['url'],
                 'duplicates': dup_info
@@ -2893,9 +2991,46 @@ def check_duplicates(request):
         'status': 'success', 
         'batch_id': batch_id, 
         'results': results,
-        'has_duplicate': any(r['status'] == 'duplicate' for r in results)
+        'has_duplicate': any(r['status'] == 'duplicate' for r in results),
+        'has_similar': any(r['status'] == 'similar' for r in results),
     })
 
+
+def near_duplicates(request):
+    """视觉近似重复簇审查页，簇由 find_near_duplicates 命令 / 后台任务离线生成"""
+    page_size = 10
+    clusters = (
+        NearDuplicateCluster.objects
+        .annotate(member_count=Count('members'))
+        .filter(member_count__gt=1)
+        .order_by('-member_count', '-max_similarity', 'id')
+    )
+    paginator = Paginator(clusters, page_size)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    page_clusters = list(page_obj.object_list)
+
+    members_by_cluster = {cluster.id: [] for cluster in page_clusters}
+    if page_clusters:
+        for member in (
+            NearDuplicateMember.objects
+            .select_related('image__group')
+            .filter(cluster_id__in=list(members_by_cluster))
+            .order_by('cluster_id', 'image_id')
+        ):
+            members_by_cluster[member.cluster_id].append(member)
+
+    for index, cluster in enumerate(page_clusters, start=page_obj.start_index()):
+        cluster.display_index = index
+        cluster.member_list = members_by_cluster.get(cluster.id, [])
+
+    return render(request, 'gallery/near_duplicates.html', {
+        'clusters': page_clusters,
+        'groups': page_obj,
+        'total_clusters': paginator.count,
+        'page_range': paginator.get_elided_page_range(page_obj.number),
+    })
+
+
 @require_POST
 def toggle_like_group(request, pk):
     group = get_object_or_404(PromptGroup, pk=pk)
@@ -3224,7 +3359,8 @@ def remove_tag_from_group(request, pk):
 def group_list_api(request):
     """【升级版】提供去重后的列表，并附带组内数量"""
     query = request.GET.get('q', '').strip()
-    page_num = request.GET.get('page', 1)
+    page_num = request.GET.get('page')
+    cursor = request.GET.get('cursor', '')
     include_variants = request.GET.get('include_variants') == '1'
     
     qs = PromptGroup.objects.all()
@@ -3262,37 +3398,24 @@ def group_list_api(request):
             count_map = {(item['main_id'] or item['max_id']): item['count'] for item in group_stats}
             final_qs = PromptGroup.objects.filter(id__in=target_ids).order_by('-id')
     else:
-        group_stats = qs.values('group_id').annotate(
-            main_id=Max(Case(When(is_main_variant=True, then='id'), output_field=IntegerField())),
-            max_id=Max('id'),
-            count=Count('id')
-        )
-
-        target_ids = [(item['main_id'] or item['max_id']) for item in group_stats]
-        count_map = {(item['main_id'] or item['max_id']): item['count'] for item in group_stats}
-        final_qs = PromptGroup.objects.filter(id__in=target_ids).order_by('-id')
+        # 不搜索时直接读家族代表表
+        PromptGroupHead.ensure_built()
+        final_qs = PromptGroup.objects.filter(group_head__isnull=False).select_related('group_head').order_by('-id')
 
-    final_qs = final_qs.select_related('cover_image').prefetch_related('images', 'characters')
+    final_qs = final_qs.select_related('resolved_cover').prefetch_related('characters')
     
-    paginator = Paginator(final_qs, 20)
-    page = paginator.get_page(page_num)
+    if page_num and not cursor:
+        # 兼容旧的 ?page=N 调用
+        page = Paginator(final_qs, 20).get_page(page_num)
+    else:
+        # 无限滚动走游标：第 N 批与第一批一样只扫 21 行，也不需要 COUNT
+        page = keyset_page(final_qs, ('-id',), cursor, 20)
     
     data = []
     for group in page:
         cover_url = ""
-        ## 【修改逻辑】优先取指定的 cover_image，没有则按原逻辑找第一张图
-        cover_img = group.cover_image
-        
-        if not cover_img:
-            images = group.images.all()
-            # 优先找非视频图片
-            for img in images:
-                if not img.is_video:
-                    cover_img = img
-                    break
-            # 兜底
-            if not cover_img and images.exists():
-                cover_img = images.first()
+        # 实际封面已按 指定封面 → 第一张非视频 → 第一个视频 的顺序预先算好
+        cover_img = group.resolved_cover
 
         if cover_img:
             try:
@@ -3313,13 +3436,14 @@ def group_list_api(request):
             'model_info': group.model_info or '',
             'characters': [char.name for char in group.characters.all()],
             'group_id': str(group.group_id),
-            'count': count_map.get(group.group_id, count_map.get(group.id, 1))
+            'count': group.group_head.variant_count if not query else count_map.get(group.group_id, count_map.get(group.id, 1))
         })
         
     return JsonResponse({
         'results': data,
         'has_next': page.has_next(),
-        'next_page_number': page.next_page_number() if page.has_next() else None
+        'next_page_number': page.next_page_number() if page.has_next() else None,
+        'next_cursor': getattr(page, 'next_cursor', '') or None,
     })
 
 @require_POST
@@ -3339,7 +3463,12 @@ def merge_groups(request):
         
         target_group_id = involved_group_ids[0]
         
-        count = PromptGroup.objects.filter(group_id__in=involved_group_ids).update(group_id=target_group_id)
+        involved_group_ids = list(involved_group_ids)
+        with transaction.atomic():
+            count = PromptGroup.objects.filter(group_id__in=involved_group_ids).update(group_id=target_group_id)
+            # queryset.update 不触发信号，显式刷新家族代表表与筛选项计数
+            PromptGroupHead.refresh(involved_group_ids)
+        invalidate_facet_counts()
         
         return JsonResponse({
             'status': 'success', 
@@ -3375,7 +3504,11 @@ def link_group_relation(request, pk):
         # 将所有属于这些 group_id 的记录统一迁移
         groups_to_update = PromptGroup.objects.filter(group_id__in=target_group_ids).exclude(id=current_group.id)
         
-        count = groups_to_update.update(group_id=current_group.group_id)
+        target_group_ids = list(target_group_ids)
+        with transaction.atomic():
+            count = groups_to_update.update(group_id=current_group.group_id)
+            PromptGroupHead.refresh([*target_group_ids, current_group.group_id])
+        invalidate_facet_counts()
         
         return JsonResponse({'status': 'success', 'count': count})
     except Exception as e:
@@ -3420,9 +3553,32 @@ def set_group_cover(request, group_id, image_id):
     group.save()
     return JsonResponse({'status': 'success'})
 
+@require_GET
+def api_similar_images(request, pk):
+    item, results, page_number, has_next = _get_similar_images_page(request, pk)
+    items = []
+    for img in results:
+        items.append({
+            'id': img.id,
+            'group_id': img.group_id,
+            'group_title': img.group.title,
+            'url': img.image.url,
+            'thumbnail_url': img.image.url if img.is_video else img.thumbnail.url,
+            'is_video': img.is_video,
+            'score': img.similarity_score,
+        })
+    return JsonResponse({
+        'status': 'success',
+        'source_id': item.id,
+        'page': page_number,
+        'has_next': has_next,
+        'results': items,
+    })
+
+
 @require_GET
 def get_similar_candidates(request, pk):
-    """获取相似提示词的推荐候选 (用于关联版本) - ORM 极限优化版"""
+    """获取相似提示词的推荐候选 (用于关联版本)：读预计算的相似组候选表"""
     try:
         current_group = PromptGroup.objects.get(pk=pk)
     except PromptGroup.DoesNotExist:
@@ -3432,46 +3588,29 @@ def get_similar_candidates(request, pk):
     if len(my_content) < 5:
          return JsonResponse({'status': 'success', 'results': []})
 
-    my_words = set(w for w in re.split(r'[\s,，.。;；|()（）]+', my_content) if len(w) > 2)
-
-    group_stats = PromptGroup.objects.values('group_id').annotate(max_id=Max('id'))
-    latest_ids = [item['max_id'] for item in group_stats]
-    
-    # 【核心优化1】：用 values_list 只取 id 和 文本，不取完整对象
-    candidates_data = PromptGroup.objects.filter(id__in=latest_ids).exclude(
-        group_id=current_group.group_id
-    ).values_list('id', 'searchable_prompts').order_by('-id')[:1000]
-    
-    recommendations = []
-    
-    for other_id, other_content in candidates_data:
-        other_content = (other_content or "").strip().lower()
-        if not other_content: continue
-        
-        max_len = max(len(my_content), len(other_content))
-        if max_len == 0: continue
-        if abs(len(my_content) - len(other_content)) > max_len * 0.7: 
+    def load_candidates():
+        return list(current_group.similar_candidates.order_by('-similarity').values_list(
+            'candidate_id', 'candidate__group_id', 'similarity'
+        ))
+
+    if current_group.similar_candidates_at is None:
+        # 新组或提示词刚改过、后台任务还没跑：当场算一次并落表（算完没有候选也会记下时间，不再重算）
+        refresh_similar_group_candidates([current_group.pk], reverse=False)
+    candidate_rows = load_candidates()
+
+    # 表里的候选可能之后被合并进本家族，同一家族只保留分数最高的一个
+    top_recs = []
+    seen_families = {current_group.group_id}
+    for candidate_id, family, ratio in candidate_rows:
+        if family in seen_families:
             continue
-
-        other_words = set(w for w in re.split(r'[\s,，.。;；|()（）]+', other_content) if len(w) > 2)
-        if my_words and other_words:
-            overlap = len(my_words.intersection(other_words))
-            max_possible = min(len(my_words), len(other_words))
-            if max_possible > 0 and (overlap / max_possible) < 0.15:
-                continue
-
-        ratio = fuzz.ratio(my_content, other_content) / 100.0
-        
-        if ratio > 0.3: 
-            recommendations.append((ratio, other_id))
-            
-    recommendations.sort(key=lambda x: x[0], reverse=True)
-    top_recs = recommendations[:20]
+        seen_families.add(family)
+        top_recs.append((ratio, candidate_id))
     
     top_ids = [item[1] for item in top_recs]
     
-    # 【核心优化2】：一次性提取前 20 的完整对象并预加载图片
-    groups_dict = PromptGroup.objects.prefetch_related('images').in_bulk(top_ids)
+    # 【核心优化2】：一次性提取前 20 的完整对象，封面走预先算好的 resolved_cover
+    groups_dict = PromptGroup.objects.select_related('resolved_cover').in_bulk(top_ids)
     
     results = []
     for ratio, group_id in top_recs:
@@ -3480,16 +3619,7 @@ def get_similar_candidates(request, pk):
             
         group = groups_dict[group_id]
         cover_url = ""
-        cover_img = group.cover_image 
-        
-        if not cover_img:
-            images = group.images.all()
-            for img in images:
-                if not img.is_video:
-                    cover_img = img
-                    break
-            if not cover_img and images:
-                cover_img = images[0]
+        cover_img = group.resolved_cover
         
         if cover_img:
              try:
@@ -3515,12 +3645,14 @@ def set_main_variant(request, pk):
     """将指定 PromptGroup 设为该系列的‘主版本’ (首页展示)"""
     target = get_object_or_404(PromptGroup, pk=pk)
     
-    # 1. 将同组的其他版本标记取消
-    PromptGroup.objects.filter(group_id=target.group_id).update(is_main_variant=False)
-    
-    # 2. 将当前版本设为主版本
-    target.is_main_variant = True
-    target.save()
+    with transaction.atomic():
+        # 1. 将同组的其他版本标记取消
+        PromptGroup.objects.filter(group_id=target.group_id).update(is_main_variant=False)
+        
+        # 2. 将当前版本设为主版本
+        target.is_main_variant = True
+        target.save()
+        PromptGroupHead.refresh([target.group_id])
     
     return JsonResponse({'status': 'success'})
 
@@ -4140,79 +4272,52 @@ def api_publish_studio_creation(request):
 @csrf_exempt
 @require_POST
 def api_get_similar_groups_by_prompt(request):
-    """根据前端传来的 Prompt 文本，计算全库相似度 (C++ 底层批处理极速版)"""
+    """根据前端传来的 Prompt 文本，在全库提示词 trigram 索引里召回候选并打分"""
     try:
         data = json.loads(request.body)
         prompt_text = data.get('prompt', '').strip().lower()
-        def build_prompt_meta(prompt_items):
-            meta = []
-            for index, item in enumerate(prompt_items, start=1):
-                meta.append({
-                    'field': item.get('id', f'prompt_{index}'),
-                    'label': item.get('label', f'提示词{index}'),
-                    'text': item.get('text', ''),
-                })
-            return meta
-        
-        candidate_groups = list(
-            PromptGroup.objects.only('id', 'prompts', 'prompt_text', 'prompt_text_zh', 'negative_prompt')
-            .order_by('-id')[:2000]
-        )
-        
-        if not prompt_text:
-            # 如果没传提示词，直接按最新时间返回兜底数据
-            top_recs = []
-            for group in candidate_groups[:15]:
-                prompt_meta = build_prompt_meta(group.get_prompt_items())
+
+        def latest_fallback(exclude_ids, limit):
+            """按最新时间补齐兜底数据"""
+            recs = []
+            latest_groups = (
+                PromptGroup.objects.exclude(id__in=exclude_ids)
+                .only('id', 'prompts', 'prompt_text', 'prompt_text_zh', 'negative_prompt')
+                .order_by('-id')[:limit]
+            )
+            for group in latest_groups:
+                prompt_meta = build_prompt_item_meta(group.get_prompt_items())
                 matched_meta = prompt_meta[0] if prompt_meta else {
                     'field': 'prompt_1',
                     'label': '提示词1',
                     'text': '',
                 }
-                top_recs.append({
+                recs.append({
                     'ratio': 0.0,
                     'group_id': group.id,
                     'matched_field': matched_meta['field'],
                     'matched_label': matched_meta['label'],
                     'matched_text': matched_meta['text'],
                 })
+            return recs
+
+        if not prompt_text:
+            # 如果没传提示词，直接按最新时间返回兜底数据
+            top_recs = latest_fallback([], 15)
         else:
-            # 2. 将统一提示词列表里的每一项全部纳入匹配池
-            valid_choices = {}
-            choice_meta = {}
-            for group in candidate_groups:
-                for prompt_meta in build_prompt_meta(group.get_prompt_items()):
-                    raw_text = prompt_meta['text']
-                    normalized_text = raw_text.strip().lower()
-                    if normalized_text:
-                        choice_key = f'{group.id}:{prompt_meta["field"]}'
-                        valid_choices[choice_key] = normalized_text
-                        choice_meta[choice_key] = {
-                            'group_id': group.id,
-                            'field_name': prompt_meta['field'],
-                            'field_label': prompt_meta['label'],
-                            'raw_text': raw_text.strip(),
-                        }
-                    
-            # 3. 批量计算多个字段的相似度，再按组聚合取最高分
-            matches = process.extract(
-                prompt_text,
-                valid_choices,
-                scorer=fuzz.ratio,
-                limit=min(len(valid_choices), 120) if valid_choices else 0
-            )
-            
+            # 2. 索引里每个组的每条提示词都是一个条目，只对 trigram 有重叠的条目做 fuzz.ratio
+            matches = search_prompt_items(prompt_text)
+
+            # 3. 多个字段按组聚合取最高分
             best_scores = {}
-            for _, score, choice_key in matches:
-                meta = choice_meta[str(choice_key)]
-                group_id = meta['group_id']
+            for score, group_id, field_name, field_label, raw_text in matches:
                 old_score = best_scores.get(group_id)
                 if old_score is None or score > old_score['score']:
                     best_scores[group_id] = {
                         'score': score,
-                        'matched_field': meta['field_name'],
-                        'matched_label': meta['field_label'],
-                        'matched_text': meta['raw_text'],
+                        'matched_field': field_name,
+                        'matched_label': field_label,
+                        'matched_text': raw_text,
                     }
 
             top_recs = [
@@ -4231,28 +4336,11 @@ def api_get_similar_groups_by_prompt(request):
             
             # 4. 如果匹配结果不足 15 个（比如全被短路过滤了），用最新的 ID 补齐兜底
             if len(top_recs) < 15:
-                used_ids = {rec['group_id'] for rec in top_recs}
-                for group in candidate_groups:
-                    if group.id not in used_ids:
-                        prompt_meta = build_prompt_meta(group.get_prompt_items())
-                        matched_meta = prompt_meta[0] if prompt_meta else {
-                            'field': 'prompt_1',
-                            'label': '提示词1',
-                            'text': '',
-                        }
-                        top_recs.append({
-                            'ratio': 0.0,
-                            'group_id': group.id,
-                            'matched_field': matched_meta['field'],
-                            'matched_label': matched_meta['label'],
-                            'matched_text': matched_meta['text'],
-                        })
-                        if len(top_recs) >= 15:
-                            break
+                top_recs.extend(latest_fallback([rec['group_id'] for rec in top_recs], 15 - len(top_recs)))
 
         top_ids = [item['group_id'] for item in top_recs]
         
-        groups_dict = PromptGroup.objects.select_related('cover_image').prefetch_related('images', 'characters').in_bulk(top_ids)
+        groups_dict = PromptGroup.objects.select_related('resolved_cover').prefetch_related('characters').in_bulk(top_ids)
         
         results = []
         for rec in top_recs:
@@ -4263,16 +4351,7 @@ def api_get_similar_groups_by_prompt(request):
                 
             group = groups_dict[group_id]
             cover_url = ""
-            cover_img = group.cover_image
-            
-            if not cover_img:
-                images = group.images.all() 
-                for img in images:
-                    if not img.is_video:
-                        cover_img = img
-                        break
-                if not cover_img and images:
-                    cover_img = images[0]
+            cover_img = group.resolved_cover
             
             if cover_img:
                  try:
@@ -4414,6 +4493,8 @@ def edit_model_api(request):
             # ==========================================
             groups_to_update = PromptGroup.objects.filter(model_info__iexact=old_name)
             updated_count = groups_to_update.update(model_info=new_name)
+            # queryset.update 不触发信号
+            invalidate_facet_counts()
 
         return JsonResponse({
             'status': 'success', 
@@ -4551,6 +4632,9 @@ def merge_variants_api(request):
             # 3. 批量删除空壳组 (1 条 SQL 搞定全部删除)
             groups_to_merge.delete()
 
+            # 4. 批量 update 不触发信号，手动重算主卡片的文件数 / 视频标记 / 实际封面
+            PromptGroup.refresh_media_stats({main_group.pk})
+
         return JsonResponse({
             'status': 'success', 
             'message': f'成功合并了 {merged_count} 个版本！'